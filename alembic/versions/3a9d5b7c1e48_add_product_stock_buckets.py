@@ -0,0 +1,40 @@
+"""add product stock buckets
+
+Revision ID: 3a9d5b7c1e48
+Revises: f1c7a3e5b9d2
+Create Date: 2026-10-18 16:27:40.913552
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "3a9d5b7c1e48"
+down_revision: Union[str, None] = "f1c7a3e5b9d2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("product", sa.Column("stock_buckets", sa.SmallInteger, nullable=False, server_default="0"))
+    op.create_table(
+        "product_stock_bucket",
+        sa.Column("product_id", sa.BigInteger, sa.ForeignKey("product.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("bucket", sa.SmallInteger, primary_key=True),
+        sa.Column("stock", sa.Integer, sa.CheckConstraint("stock >= 0"), nullable=False, server_default="0"),
+    )
+
+
+def downgrade() -> None:
+    # Put the stock of split up products back in one place before the buckets go
+    op.execute(
+        "UPDATE product SET stock = totals.stock FROM "
+        "(SELECT product_id, sum(stock) AS stock FROM product_stock_bucket GROUP BY product_id) AS totals "
+        "WHERE product.id = totals.product_id"
+    )
+    op.drop_table("product_stock_bucket")
+    op.drop_column("product", "stock_buckets")
@@ -0,0 +1,43 @@
+"""add product search vector
+
+Revision ID: 5c1e9a7d3b24
+Revises: 2f3b23c0b1f0
+Create Date: 2026-10-18 10:12:41.518204
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5c1e9a7d3b24"
+down_revision: Union[str, None] = "2f3b23c0b1f0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # A stored generated column is computed for every existing row straight away,
+    # so this rewrites the table and blocks writes to it until it's done
+    op.add_column(
+        "product",
+        sa.Column(
+            "search_vector",
+            TSVECTOR,
+            sa.Computed(
+                "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+                "setweight(to_tsvector('english', coalesce(description, '')), 'B')",
+                persisted=True,
+            ),
+        ),
+    )
+    op.create_index("ix_product_search_vector", "product", ["search_vector"], postgresql_using="gin")
+
+
+def downgrade() -> None:
+    op.drop_index("ix_product_search_vector", table_name="product")
+    op.drop_column("product", "search_vector")
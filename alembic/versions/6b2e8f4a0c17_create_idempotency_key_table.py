@@ -0,0 +1,36 @@
+"""create idempotency key table
+
+Revision ID: 6b2e8f4a0c17
+Revises: 3a9d5b7c1e48
+Create Date: 2026-10-18 18:05:33.620418
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "6b2e8f4a0c17"
+down_revision: Union[str, None] = "3a9d5b7c1e48"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "idempotency_key",
+        sa.Column("scope", sa.String(255), primary_key=True),
+        sa.Column("key", sa.String(255), primary_key=True),
+        sa.Column("request_hash", sa.String(64), nullable=False),
+        sa.Column("status_code", sa.SmallInteger),
+        sa.Column("response", sa.LargeBinary),
+        sa.Column("created_at", sa.TIMESTAMP, server_default=sa.text("CURRENT_TIMESTAMP")),
+        sa.Column("expires_at", sa.TIMESTAMP, nullable=False, index=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("idempotency_key")
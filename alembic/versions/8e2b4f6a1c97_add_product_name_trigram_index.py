@@ -0,0 +1,44 @@
+"""add product name trigram index
+
+Revision ID: 8e2b4f6a1c97
+Revises: 5c1e9a7d3b24
+Create Date: 2026-10-18 10:26:03.042877
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "8e2b4f6a1c97"
+down_revision: Union[str, None] = "5c1e9a7d3b24"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _trigrams_available() -> bool:
+    # pg_trgm ships with PostgreSQL, but some managed databases leave it out
+    result = op.get_bind().execute(sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"))
+    return result.scalar() is not None
+
+
+def upgrade() -> None:
+    # Only needed for SEARCH_FUZZY_ENABLED, so we skip it when the database can't do it
+    if not _trigrams_available():
+        return
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index(
+        "ix_product_name_trigram",
+        "product",
+        ["name"],
+        postgresql_using="gin",
+        postgresql_ops={"name": "gin_trgm_ops"},
+    )
+
+
+def downgrade() -> None:
+    # The extension is left in place, something else may be using it
+    op.drop_index("ix_product_name_trigram", table_name="product", if_exists=True)
@@ -0,0 +1,33 @@
+"""add product name prefix index
+
+Revision ID: b7d3e9f1a2c5
+Revises: 8e2b4f6a1c97
+Create Date: 2026-10-18 11:02:17.730415
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b7d3e9f1a2c5"
+down_revision: Union[str, None] = "8e2b4f6a1c97"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The existing index on name is ordered by the database's collation, which LIKE can't use.
+    # text_pattern_ops compares character by character, so LIKE 'abc%' becomes a range scan.
+    op.create_index(
+        "ix_product_name_prefix",
+        "product",
+        [sa.text("lower(name) text_pattern_ops")],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_product_name_prefix", table_name="product")
@@ -0,0 +1,37 @@
+"""add order customer history index
+
+Revision ID: d4a8c2e6f0b3
+Revises: b7d3e9f1a2c5
+Create Date: 2026-10-18 13:40:52.187093
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d4a8c2e6f0b3"
+down_revision: Union[str, None] = "b7d3e9f1a2c5"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The order table can be big, so the index is built without blocking writes.
+    # CONCURRENTLY can't run inside a transaction, hence the autocommit block.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_order_customer_name_created_at_id",
+            "order",
+            ["customer_name", "created_at", "id"],
+            postgresql_concurrently=True,
+        )
+        # Every lookup by customer_name can use the new index, so the old one only slows down writes
+        op.drop_index("ix_order_customer_name", table_name="order", postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index("ix_order_customer_name", "order", ["customer_name"], postgresql_concurrently=True)
+        op.drop_index("ix_order_customer_name_created_at_id", table_name="order", postgresql_concurrently=True)
@@ -0,0 +1,34 @@
+"""create order item table
+
+Revision ID: f1c7a3e5b9d2
+Revises: d4a8c2e6f0b3
+Create Date: 2026-10-18 15:02:17.441906
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "f1c7a3e5b9d2"
+down_revision: Union[str, None] = "d4a8c2e6f0b3"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "order_item",
+        sa.Column("id", sa.BigInteger, primary_key=True, autoincrement=True),
+        sa.Column("order_id", sa.BigInteger, sa.ForeignKey("order.id", ondelete="CASCADE"), index=True, nullable=False),
+        sa.Column("product_id", sa.BigInteger, sa.ForeignKey("product.id", ondelete="SET NULL"), index=True),
+        sa.Column("quantity", sa.Integer, sa.CheckConstraint("quantity > 0"), nullable=False),
+        sa.Column("unit_price", sa.Numeric(12, 2)),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("order_item")
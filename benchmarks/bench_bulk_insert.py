@@ -0,0 +1,74 @@
+"""
+Compares creating products one at a time, like POST /products does,
+with Repository.insert_many, like POST /products/bulk does.
+
+Run it against a local database (docker compose up -d && alembic upgrade head):
+
+    python benchmarks/bench_bulk_insert.py --rows 5000
+
+The products it creates are deleted again at the end.
+"""
+
+import argparse
+import asyncio
+import time
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.database import SqlAlchemyRepository
+from app.models.product import product_table
+from app.settings import Settings
+
+
+def make_products(count: int, prefix: str) -> list[dict]:
+    return [
+        {
+            "name": "{prefix} {index}".format(prefix=prefix, index=index),
+            "description": "benchmark product",
+            "image": None,
+            "price": 1000 + index % 2000,
+            "stock": index % 100,
+        }
+        for index in range(count)
+    ]
+
+
+async def main(rows: int, chunk_size: int):
+    settings = Settings()
+    engine = create_async_engine(settings.get_db_url())
+    created_ids: list[int] = []
+
+    async with engine.connect() as connection:
+        repository = SqlAlchemyRepository(db=connection, table=product_table)
+
+        # One statement and one commit per product
+        started = time.perf_counter()
+        for product in make_products(rows, "single"):
+            record = await repository.insert(product)
+            await repository.commit()
+            created_ids.append(record["id"])
+        single_seconds = time.perf_counter() - started
+
+        # Multi-row INSERT ... RETURNING in chunks, one commit
+        started = time.perf_counter()
+        records = await repository.insert_many(make_products(rows, "bulk"), chunk_size=chunk_size)
+        await repository.commit()
+        bulk_seconds = time.perf_counter() - started
+        created_ids.extend(record["id"] for record in records)
+
+        await connection.execute(product_table.delete().where(product_table.c.id.in_(created_ids)))
+        await connection.commit()
+
+    await engine.dispose()
+
+    print("single-row: {seconds:8.3f}s {rate:10.0f} rows/s".format(seconds=single_seconds, rate=rows / single_seconds))
+    print("insert_many: {seconds:7.3f}s {rate:10.0f} rows/s".format(seconds=bulk_seconds, rate=rows / bulk_seconds))
+    print("speed-up: {ratio:.1f}x".format(ratio=single_seconds / bulk_seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--chunk-size", type=int, default=Settings().bulk_insert_chunk_size)
+    arguments = parser.parse_args()
+    asyncio.run(main(arguments.rows, arguments.chunk_size))
@@ -0,0 +1,104 @@
+"""
+Compares checkouts racing for one popular product, with its stock in the product row
+and with its stock split into buckets (PUT /products/{id}/inventory).
+
+Every checkout reserves one unit in its own transaction, holds on to it for --hold-ms
+(standing in for writing the order and its items), then commits.
+Run it against a local database (docker compose up -d && alembic upgrade head):
+
+    python benchmarks/bench_inventory.py --checkouts 5000 --concurrency 200 --buckets 16
+
+There is less stock than checkouts, so some of them sell out, and the stock must end at exactly 0.
+The product it creates is deleted again at the end.
+"""
+
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from app.database.inventory import SqlAlchemyInventoryRepository
+from app.models.product import product_stock_bucket_table, product_table
+from app.settings import Settings
+
+
+async def checkout(engine: AsyncEngine, product_id: int, hold_seconds: float) -> bool:
+    async with engine.connect() as connection:
+        repository = SqlAlchemyInventoryRepository(db=connection)
+        reserved = await repository.reserve({product_id: 1})
+        if product_id not in reserved:
+            await connection.rollback()
+            return False
+        await asyncio.sleep(hold_seconds)
+        await repository.commit()
+        return True
+
+
+async def run(engine: AsyncEngine, buckets: int, stock: int, checkouts: int, concurrency: int, hold_seconds: float):
+    async with engine.connect() as connection:
+        result = await connection.execute(
+            product_table.insert()
+            .values(name="inventory benchmark", description="benchmark product", price=1000, stock=stock)
+            .returning(product_table.c.id)
+        )
+        product_id = result.scalar_one()
+        await SqlAlchemyInventoryRepository(db=connection).set_buckets(product_id, buckets=buckets)
+        await connection.commit()
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def limited_checkout() -> bool:
+        async with slots:
+            return await checkout(engine, product_id, hold_seconds)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[limited_checkout() for _ in range(checkouts)])
+    seconds = time.perf_counter() - started
+
+    async with engine.connect() as connection:
+        repository = SqlAlchemyInventoryRepository(db=connection)
+        _, remaining = await repository.get_stock(product_id)
+        lowest = (
+            await connection.execute(
+                select(func.min(product_stock_bucket_table.c.stock)).where(
+                    product_stock_bucket_table.c.product_id == product_id
+                )
+            )
+        ).scalar_one_or_none()
+        await connection.execute(product_table.delete().where(product_table.c.id == product_id))
+        await connection.commit()
+
+    sold = sum(results)
+    # Nothing sold twice, nothing left over, and no bucket below 0
+    assert sold == stock and remaining == 0, (sold, remaining)
+    assert lowest is None or lowest >= 0, lowest
+    return seconds, sold
+
+
+async def main(checkouts: int, concurrency: int, buckets: int, hold_ms: float):
+    settings = Settings()
+    # One connection per concurrent checkout, so the pool isn't what they queue on
+    engine = create_async_engine(settings.get_db_url(), pool_size=concurrency, max_overflow=0)
+    stock = checkouts * 9 // 10
+
+    for label, bucket_count in (("row update", 0), ("{buckets} buckets".format(buckets=buckets), buckets)):
+        seconds, sold = await run(engine, bucket_count, stock, checkouts, concurrency, hold_ms / 1000)
+        print(
+            "{label:>12}: {seconds:7.3f}s {rate:8.0f} checkouts/s ({sold} sold, {failed} sold out)".format(
+                label=label, seconds=seconds, rate=checkouts / seconds, sold=sold, failed=checkouts - sold
+            )
+        )
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkouts", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--buckets", type=int, default=16)
+    parser.add_argument("--hold-ms", type=float, default=2.0)
+    arguments = parser.parse_args()
+    asyncio.run(main(arguments.checkouts, arguments.concurrency, arguments.buckets, arguments.hold_ms))
@@ -0,0 +1,92 @@
+"""
+Measures the CPU time SQLAlchemy spends on a statement before anything is sent to the database,
+for statements built on every call (like the repository used to) and statements built once (TableStatements).
+
+This is the work behind every execute(): build the statement, work out its cache key,
+then find its compiled SQL in the compiled cache. No database is needed:
+
+    python benchmarks/bench_statements.py --calls 20000
+"""
+
+import argparse
+import time
+from typing import Callable
+
+from sqlalchemy import Executable, select
+from sqlalchemy.dialects.postgresql.asyncpg import PGDialect_asyncpg
+from sqlalchemy.util import LRUCache
+
+from app.database import get_table_statements
+from app.models import readable_columns
+from app.models.product import product_table
+from app.services.product import PRODUCT_SELECT
+
+dialect = PGDialect_asyncpg()
+# The same kind of cache the engine keeps, see create_engine(query_cache_size=...)
+compiled_cache = LRUCache(500)
+
+PRODUCT = {"name": "benchmark", "description": "benchmark product", "image": None, "price": 1000, "stock": 10}
+
+
+def prepare(statement: Executable, column_keys: list[str] | None = None) -> None:
+    # What Connection.execute() does with a statement before handing the SQL to asyncpg
+    statement._compile_w_cache(dialect, compiled_cache=compiled_cache, column_keys=column_keys or [])
+
+
+def time_per_call(calls: int, function: Callable[[], None]) -> float:
+    # Once first, so the compiled cache is warm like it is on a running server
+    function()
+    started = time.process_time()
+    for _ in range(calls):
+        function()
+    return (time.process_time() - started) / calls * 1_000_000
+
+
+def main(calls: int):
+    statements = get_table_statements(product_table)
+    columns = readable_columns(product_table)
+    product_keys = list(PRODUCT)
+    cases = {
+        "get_one": (
+            lambda: prepare(select(*columns).where(product_table.c.id == 42)),
+            lambda: prepare(statements.get_one, ["target_id"]),
+        ),
+        "insert": (
+            lambda: prepare(product_table.insert().values(PRODUCT).returning(*columns)),
+            lambda: prepare(statements.insert, product_keys),
+        ),
+        "update": (
+            lambda: prepare(product_table.update().where(product_table.c.id == 42).values(PRODUCT).returning(*columns)),
+            lambda: prepare(statements.update, product_keys + ["target_id"]),
+        ),
+        # The filters change from request to request, so only the base select is shared
+        "paginate": (
+            lambda: prepare(
+                select(*columns).where(product_table.c.price >= 10).order_by(product_table.c.id).offset(40).limit(21)
+            ),
+            lambda: prepare(
+                PRODUCT_SELECT.where(product_table.c.price >= 10).order_by(product_table.c.id).offset(40).limit(21)
+            ),
+        ),
+    }
+
+    print(
+        "{name:>10} {before:>12} {after:>12} {saved:>12}".format(
+            name="", before="per call", after="built once", saved="saved"
+        )
+    )
+    for name, (built_every_call, built_once) in cases.items():
+        before = time_per_call(calls, built_every_call)
+        after = time_per_call(calls, built_once)
+        print(
+            "{name:>10} {before:10.1f}us {after:10.1f}us {saved:10.1f}us".format(
+                name=name, before=before, after=after, saved=before - after
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000)
+    arguments = parser.parse_args()
+    main(arguments.calls)
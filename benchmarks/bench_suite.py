@@ -0,0 +1,501 @@
+"""
+Measures how fast the repository and the HTTP routes are under concurrent load,
+and catches regressions by comparing the results with a saved baseline.
+
+Run it against a local database (docker compose up -d && alembic upgrade head).
+Generate a dataset once, start the server, then run the suite as often as you like:
+
+    seed --products 100000 --orders 100000
+    run  # the server, in another terminal
+    python benchmarks/bench_suite.py run --concurrency 32 --duration 10 --output results.json
+    python benchmarks/bench_suite.py compare results.json benchmarks/baseline.json
+
+Every scenario runs for --duration seconds with --concurrency requests in flight, and reports
+its requests per second and p50/p95/p99 latency. compare exits with 1 when a scenario got slower
+than the baseline by more than --tolerance, so it can fail a CI job.
+Only compare results taken on the same machine, with the same dataset and settings.
+
+Every /products and /orders route has a scenario. The ones that would change the generated rows work on
+products of their own, made at the start of the run: the checkouts of POST /orders, the products
+PUT /products/{id}/inventory splits up, and the ones DELETE /products/{id} deletes.
+GET /products/export reads the whole catalog every time, and POST /products/import sends 10 products.
+
+The generated rows, and the ones the runs create, are deleted again with:
+
+    seed --delete
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, Awaitable, Callable
+from urllib.parse import quote
+
+import httpx
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+
+from app.counting import CountStrategy
+from app.database import SqlAlchemyRepository
+from app.models import readable_columns
+from app.models.order import order_table
+from app.models.product import product_table
+from app.services.seed import ADJECTIVES, NOUNS, SEED_MARKER
+from app.settings import Settings
+
+# A scenario is one call (or request) made over and over.
+# It gets the random number generator of its worker, and returns whether the call went well.
+Operation = Callable[[random.Random], Awaitable[bool]]
+
+
+# The dataset
+
+
+def make_products(rng: random.Random, count: int) -> list[dict]:
+    # Marked like the generated ones, so seed --delete cleans up what the runs create too
+    return [
+        {
+            "name": "{adjective} {noun} {index}".format(
+                adjective=rng.choice(ADJECTIVES), noun=rng.choice(NOUNS), index=index
+            ),
+            "description": "{marker} A {adjective} {noun} made for the benchmark.".format(
+                marker=SEED_MARKER, adjective=rng.choice(ADJECTIVES), noun=rng.choice(NOUNS)
+            ),
+            "image": None,
+            "price": Decimal(rng.randint(100, 50000)) / 100,
+            # Plenty, so the checkouts of a run never sell anything out
+            "stock": 1_000_000,
+        }
+        for index in range(count)
+    ]
+
+
+# Products made just to be deleted by DELETE /products/{id}. Once a run has used them all up,
+# the rest of its deletes find nothing to delete, which is quicker, so keep --duration short enough.
+DELETE_POOL_SIZE = 20_000
+
+
+class Dataset:
+    # The ids and names the scenarios pick from, read from the database before the run
+    def __init__(
+        self,
+        product_ids: list[int],
+        order_ids: list[int],
+        customers: list[str],
+        checkout_ids: list[int],
+        inventory_ids: list[int],
+        deletable_ids: list[int],
+    ):
+        self.product_ids = product_ids
+        self.order_ids = order_ids
+        self.customers = customers
+        # Many generated products are sold out, so the orders of the run are for these instead
+        self.checkout_ids = checkout_ids
+        # Split into buckets and back again, apart from the checkouts, so the orders keep going the same way
+        self.inventory_ids = inventory_ids
+        self.deletable_ids = deletable_ids
+
+    @classmethod
+    async def load(cls, engine: AsyncEngine, seed: int) -> "Dataset":
+        async with engine.connect() as connection:
+            product_ids = (
+                await connection.scalars(
+                    select(product_table.c.id).where(product_table.c.description.startswith(SEED_MARKER))
+                )
+            ).all()
+            order_ids = (
+                await connection.scalars(select(order_table.c.id).where(order_table.c.address.startswith(SEED_MARKER)))
+            ).all()
+            customers = (
+                await connection.scalars(
+                    select(order_table.c.customer_name).where(order_table.c.address.startswith(SEED_MARKER)).distinct()
+                )
+            ).all()
+            if not product_ids or not order_ids:
+                raise SystemExit("There's nothing to measure yet. Run seed first.")
+            rng = random.Random(seed)
+            repository = SqlAlchemyRepository(db=connection, table=product_table)
+            checkouts = await repository.insert_many(make_products(rng, 100))
+            inventory = await repository.insert_many(make_products(rng, 100))
+            deletable = await repository.insert_many(make_products(rng, DELETE_POOL_SIZE))
+            await connection.commit()
+        return cls(
+            list(product_ids),
+            list(order_ids),
+            list(customers),
+            [record["id"] for record in checkouts],
+            [record["id"] for record in inventory],
+            [record["id"] for record in deletable],
+        )
+
+
+# Measuring
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    # Nearest rank: the smallest value with at least this fraction of the values at or below it
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+async def measure(operation: Operation, concurrency: int, duration: float, warmup: float, seed: int) -> dict:
+    """
+    Runs the operation from this many workers at once. Calls made during the warmup aren't counted,
+    so connections get opened and statements prepared before the clock starts.
+    """
+    latencies: list[float] = []
+    errors = 0
+    started = time.perf_counter()
+    counting_from = started + warmup
+    stop_at = counting_from + duration
+
+    async def worker(number: int):
+        nonlocal errors
+        rng = random.Random(seed * 1000 + number)
+        while (now := time.perf_counter()) < stop_at:
+            try:
+                ok = await operation(rng)
+            except Exception:
+                ok = False
+            finished = time.perf_counter()
+            if now >= counting_from:
+                latencies.append(finished - now)
+                if not ok:
+                    errors += 1
+
+    await asyncio.gather(*[worker(number) for number in range(concurrency)])
+    # Calls still running when the time was up are counted, so use the real end
+    elapsed = max(time.perf_counter() - counting_from, 1e-9)
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def repository_scenarios(engine: AsyncEngine, dataset: Dataset) -> dict[str, Operation]:
+    product_select = select(*readable_columns(product_table))
+    order_select = select(*readable_columns(order_table))
+
+    def on_connection(call: Callable[[AsyncConnection, random.Random], Awaitable[Any]]) -> Operation:
+        # Each call gets a connection from the pool, like a request does.
+        # Nothing is committed, so the writes leave the dataset as it was.
+        async def operation(rng: random.Random) -> bool:
+            async with engine.connect() as connection:
+                await call(connection, rng)
+                await connection.rollback()
+            return True
+
+        return operation
+
+    def products(connection: AsyncConnection) -> SqlAlchemyRepository:
+        return SqlAlchemyRepository(db=connection, table=product_table)
+
+    def orders(connection: AsyncConnection) -> SqlAlchemyRepository:
+        return SqlAlchemyRepository(db=connection, table=order_table)
+
+    return {
+        "repository.product.get_one": on_connection(
+            lambda connection, rng: products(connection).get_one(rng.choice(dataset.product_ids))
+        ),
+        "repository.product.paginate_offset": on_connection(
+            lambda connection, rng: products(connection).paginate(
+                product_select, [], [product_table.c.id.asc()], offset=rng.randrange(0, 200) * 20, size=20
+            )
+        ),
+        "repository.product.paginate_keyset": on_connection(
+            lambda connection, rng: products(connection).paginate_keyset(
+                product_select,
+                [product_table.c.price >= 100],
+                [product_table.c.price, product_table.c.id],
+                # Somewhere in the middle of the catalog, like a client following next links
+                after=[str(Decimal(rng.randint(100, 50000)) / 100), 0],
+                size=20,
+            )
+        ),
+        "repository.product.get_count_exact": on_connection(
+            lambda connection, rng: products(connection).get_count(
+                select(product_table.c.id), [product_table.c.stock > 0], CountStrategy.EXACT
+            )
+        ),
+        "repository.product.get_count_estimated": on_connection(
+            lambda connection, rng: products(connection).get_count(
+                select(product_table.c.id), [product_table.c.stock > 0], CountStrategy.ESTIMATED
+            )
+        ),
+        "repository.product.insert": on_connection(
+            lambda connection, rng: products(connection).insert(make_products(rng, 1)[0])
+        ),
+        "repository.product.insert_many_100": on_connection(
+            lambda connection, rng: products(connection).insert_many(make_products(rng, 100))
+        ),
+        "repository.product.update": on_connection(
+            lambda connection, rng: products(connection).update(
+                rng.choice(dataset.product_ids), {"price": Decimal(rng.randint(100, 50000)) / 100}
+            )
+        ),
+        "repository.order.get_one": on_connection(
+            lambda connection, rng: orders(connection).get_one(rng.choice(dataset.order_ids))
+        ),
+        "repository.order.customer_history": on_connection(
+            lambda connection, rng: orders(connection).paginate_keyset(
+                order_select,
+                [order_table.c.customer_name == rng.choice(dataset.customers)],
+                [order_table.c.created_at, order_table.c.id],
+                after=None,
+                size=20,
+                descending=True,
+            )
+        ),
+    }
+
+
+def http_scenarios(client: httpx.AsyncClient, dataset: Dataset) -> dict[str, Operation]:
+    def request(method: str, make_url: Callable[[random.Random], str], make_body=None, content_type=None) -> Operation:
+        # The body is sent as JSON, or as it is when there's a content type
+        async def operation(rng: random.Random) -> bool:
+            body = make_body(rng) if make_body is not None else None
+            if content_type is None:
+                response = await client.request(method, make_url(rng), json=body)
+            else:
+                response = await client.request(
+                    method, make_url(rng), content=body, headers={"content-type": content_type}
+                )
+            return response.is_success
+
+        return operation
+
+    def stream(make_url: Callable[[random.Random], str]) -> Operation:
+        # Reads the whole response, as that's what the time goes into
+        async def operation(rng: random.Random) -> bool:
+            async with client.stream("GET", make_url(rng)) as response:
+                async for _ in response.aiter_raw():
+                    pass
+            return response.is_success
+
+        return operation
+
+    def new_product(rng: random.Random) -> dict:
+        product = make_products(rng, 1)[0]
+        return {**product, "price": str(product["price"])}
+
+    def new_order(rng: random.Random) -> dict:
+        return {
+            "customer_name": rng.choice(dataset.customers),
+            "address": "{marker} 1 Benchmark Street".format(marker=SEED_MARKER),
+            "items": [{"product_id": product_id, "quantity": 1} for product_id in rng.sample(dataset.checkout_ids, 3)],
+        }
+
+    def product_id(rng: random.Random) -> int:
+        return rng.choice(dataset.product_ids)
+
+    def deletable_id(rng: random.Random) -> int:
+        # Each product is only deleted once. After the pool runs out, the id of one already deleted.
+        return dataset.deletable_ids.pop() if len(dataset.deletable_ids) > 1 else dataset.deletable_ids[0]
+
+    def import_body(rng: random.Random) -> bytes:
+        # A small catalog update: 10 new products, one JSON object per line
+        return "\n".join(json.dumps(new_product(rng)) for _ in range(10)).encode()
+
+    return {
+        "http.GET /products/{id}": request("GET", lambda rng: "/products/{id}".format(id=product_id(rng))),
+        "http.GET /products/{id}?fields": request(
+            "GET", lambda rng: "/products/{id}?fields=name,price".format(id=product_id(rng))
+        ),
+        "http.GET /products/": request("GET", lambda rng: "/products/?size=20"),
+        "http.GET /products/ (deep offset)": request(
+            "GET", lambda rng: "/products/?size=20&page={page}".format(page=rng.randrange(0, 200))
+        ),
+        "http.GET /products/ (filtered)": request(
+            "GET", lambda rng: "/products/?size=20&sort=price&in_stock=true&count=estimated"
+        ),
+        "http.GET /products/search": request(
+            "GET", lambda rng: "/products/search?q={word}".format(word=rng.choice(ADJECTIVES + NOUNS))
+        ),
+        "http.GET /products/{id}/inventory": request(
+            "GET", lambda rng: "/products/{id}/inventory".format(id=product_id(rng))
+        ),
+        "http.PUT /products/{id}/inventory": request(
+            "PUT",
+            lambda rng: "/products/{id}/inventory".format(id=rng.choice(dataset.inventory_ids)),
+            lambda rng: {"buckets": rng.choice([0, 4, 8])},
+        ),
+        # The whole catalog in every request, so it's measured with only the ids and prices
+        "http.GET /products/export": stream(lambda rng: "/products/export?fields=id,price"),
+        "http.POST /products/": request("POST", lambda rng: "/products/", new_product),
+        "http.POST /products/bulk (10)": request(
+            "POST", lambda rng: "/products/bulk", lambda rng: [new_product(rng) for _ in range(10)]
+        ),
+        "http.PATCH /products/{id}": request(
+            "PATCH",
+            lambda rng: "/products/{id}".format(id=product_id(rng)),
+            lambda rng: {"price": str(Decimal(rng.randint(100, 50000)) / 100)},
+        ),
+        "http.POST /products/import (10)": request(
+            "POST", lambda rng: "/products/import", import_body, content_type="application/x-ndjson"
+        ),
+        "http.DELETE /products/{id}": request("DELETE", lambda rng: "/products/{id}".format(id=deletable_id(rng))),
+        "http.GET /orders/": request("GET", lambda rng: "/orders/?size=20"),
+        "http.GET /orders/?customer_name": request(
+            "GET", lambda rng: "/orders/?size=20&customer_name={name}".format(name=quote(rng.choice(dataset.customers)))
+        ),
+        "http.GET /orders/{id}": request("GET", lambda rng: "/orders/{id}".format(id=rng.choice(dataset.order_ids))),
+        "http.POST /orders/": request("POST", lambda rng: "/orders/", new_order),
+    }
+
+
+async def run(
+    engine: AsyncEngine,
+    base_url: str,
+    concurrency: int,
+    duration: float,
+    warmup: float,
+    seed: int,
+    only: str | None,
+) -> dict:
+    dataset = await Dataset.load(engine, seed)
+    results: dict[str, dict] = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        scenarios = {**repository_scenarios(engine, dataset), **http_scenarios(client, dataset)}
+        for name, operation in scenarios.items():
+            if only is not None and only not in name:
+                continue
+            results[name] = await measure(operation, concurrency, duration, warmup, seed)
+            print_result(name, results[name])
+
+    return {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "products": len(dataset.product_ids),
+            "orders": len(dataset.order_ids),
+            "concurrency": concurrency,
+            "duration_seconds": duration,
+        },
+        "results": results,
+    }
+
+
+def print_result(name: str, result: dict) -> None:
+    print(
+        "{name:<42} {rps:>9.1f} req/s  p50 {p50:>8.2f}ms  p95 {p95:>8.2f}ms  p99 {p99:>8.2f}ms  {errors} errors".format(
+            name=name,
+            rps=result["rps"],
+            p50=result["p50_ms"],
+            p95=result["p95_ms"],
+            p99=result["p99_ms"],
+            errors=result["errors"],
+        )
+    )
+
+
+# Comparing
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    The scenarios that got slower than the baseline: fewer requests per second, or a higher p95,
+    by more than the tolerance (0.1 is 10%). Scenarios missing from either side are skipped.
+    """
+    regressions = []
+    for name, result in results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        rps_change = result["rps"] / before["rps"] - 1 if before["rps"] else 0.0
+        p95_change = result["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0.0
+        regressed = rps_change < -tolerance or p95_change > tolerance or result["errors"] > before["errors"]
+        print(
+            "{flag} {name:<42} req/s {rps:+7.1%}  p95 {p95:+7.1%}  errors {before_errors} -> {errors}".format(
+                flag="!" if regressed else " ",
+                name=name,
+                rps=rps_change,
+                p95=p95_change,
+                before_errors=before["errors"],
+                errors=result["errors"],
+            )
+        )
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+async def with_engine(concurrency: int, use: Callable[[AsyncEngine], Awaitable[Any]]) -> Any:
+    settings = Settings()
+    # One connection per worker, so the pool isn't what the repository scenarios queue on
+    engine = create_async_engine(settings.get_db_url(), pool_size=concurrency, max_overflow=0)
+    try:
+        return await use(engine)
+    finally:
+        await engine.dispose()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Measure every scenario")
+    run_parser.add_argument("--url", default="http://localhost:8000", help="Where the server is running")
+    run_parser.add_argument("--concurrency", type=int, default=32)
+    run_parser.add_argument("--duration", type=float, default=10, help="Seconds to measure each scenario for")
+    run_parser.add_argument("--warmup", type=float, default=2, help="Seconds to run each scenario before measuring")
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--only", help="Only run the scenarios with this in their name, like http.GET")
+    run_parser.add_argument("--output", help="Write the results to this JSON file")
+    run_parser.add_argument("--baseline", help="Compare the results with this JSON file")
+    run_parser.add_argument("--tolerance", type=float, default=0.1)
+
+    compare_parser = commands.add_parser("compare", help="Compare two results files")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("--tolerance", type=float, default=0.1)
+
+    arguments = parser.parse_args()
+
+    if arguments.command == "run":
+        results = asyncio.run(
+            with_engine(
+                arguments.concurrency,
+                lambda engine: run(
+                    engine,
+                    arguments.url,
+                    arguments.concurrency,
+                    arguments.duration,
+                    arguments.warmup,
+                    arguments.seed,
+                    arguments.only,
+                ),
+            )
+        )
+        if arguments.output:
+            with open(arguments.output, "w") as file:
+                json.dump(results, file, indent=2)
+        if not arguments.baseline:
+            return 0
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+        return 1 if compare(results, baseline, arguments.tolerance) else 0
+
+    with open(arguments.results) as file:
+        results = json.load(file)
+    with open(arguments.baseline) as file:
+        baseline = json.load(file)
+    return 1 if compare(results, baseline, arguments.tolerance) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+import abc
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Hashable
+
+from app.redis import RedisClient, RedisError
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Stored for keys we know have no value, like ids that don't exist.
+# This is different from None, which get() returns when it doesn't know.
+NOT_FOUND = object()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Entries thrown away to make room for new ones
+    evictions: int = 0
+    # Entries thrown away because they were too old
+    expirations: int = 0
+
+
+class TTLCache:
+    """
+    A small in-process cache where entries expire after a number of seconds.
+    When the cache is full, the least recently used entry is thrown away to make room.
+
+    This isn't shared between worker processes, so only use it for values that are okay to be a little stale.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        # key -> (expiry time, value). OrderedDict keeps the least recently used entry first for us.
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class CacheBackend(abc.ABC):
+    """Somewhere to keep cached bytes, which may be shared between worker processes."""
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> bytes | None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def incr(self, key: str) -> int:
+        raise NotImplementedError()
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Keeps everything in this process. Good for tests and single worker setups."""
+
+    def __init__(self, max_entries: int):
+        self.entries = TTLCache(max_entries=max_entries, ttl=0)
+        # Counters are kept apart so they are never evicted
+        self.counters: dict[str, int] = {}
+
+    async def get(self, key: str) -> bytes | None:
+        if key in self.counters:
+            return str(self.counters[key]).encode()
+        return self.entries.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        self.entries.set(key, value, ttl=ttl)
+
+    async def incr(self, key: str) -> int:
+        self.counters[key] = self.counters.get(key, 0) + 1
+        return self.counters[key]
+
+
+class RedisCacheBackend(CacheBackend):
+    """Keeps everything in a Redis compatible server, so every worker shares the same cache."""
+
+    def __init__(self, url: str):
+        self.client = RedisClient(url)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        await self.client.set(key, value, ttl=ttl)
+
+    async def incr(self, key: str) -> int:
+        return await self.client.incr(key)
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+# Problems talking to the cache server. The cache is only there to save work, so these never fail a request.
+BACKEND_ERRORS = (OSError, EOFError, asyncio.TimeoutError, RedisError)
+
+
+class PageCache:
+    """
+    Caches whole, already serialized responses, keyed by the request parameters.
+
+    Every table has a version number that is part of each key. Changing the table bumps its version,
+    which makes every page cached for the old version unreachable at once, without having to find and delete them.
+    The old entries are left to expire on their own.
+
+    Pages can be read from a replica that hasn't caught up with the change yet. So for settle_seconds after
+    a table changes, pages of the new version are only kept for settle_seconds, instead of being served for
+    the whole ttl as if they were fresh.
+    """
+
+    def __init__(self, backend: CacheBackend | None, ttl: int, namespace: str = "pages", settle_seconds: float = 0):
+        self.backend = backend
+        self.ttl = ttl
+        self.namespace = namespace
+        self.settle_ttl = math.ceil(settle_seconds)
+        self.stats = CacheStats()
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "PageCache":
+        url = settings.list_cache_url
+        if not url:
+            backend = None
+        elif url.startswith("memory:"):
+            backend = MemoryCacheBackend(max_entries=settings.list_cache_max_entries)
+        elif url.startswith(("redis:", "rediss:")):
+            backend = RedisCacheBackend(url)
+        else:
+            raise ValueError("Unsupported cache url: {url}".format(url=url))
+        # How far behind the replicas can be is the same window read-your-writes assumes
+        settle_seconds = settings.db_read_your_writes_seconds if settings.db_replica_urls else 0
+        return cls(backend=backend, ttl=settings.list_cache_ttl_seconds, settle_seconds=settle_seconds)
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def _version_key(self, table: str) -> str:
+        return "{namespace}:{table}:version".format(namespace=self.namespace, table=table)
+
+    def _settling_key(self, table: str) -> str:
+        # Only there for settle_seconds after the table changed
+        return "{namespace}:{table}:settling".format(namespace=self.namespace, table=table)
+
+    async def key(self, table: str, params: dict[str, Any]) -> str | None:
+        """
+        Works out the key for a page. Get the key before querying the database:
+        if the table changes while we're querying, the page then ends up under the old version, where nobody looks.
+
+        Returns None when the cache can't be used right now.
+        """
+        if self.backend is None:
+            return None
+        try:
+            version = await self.backend.get(self._version_key(table))
+        except BACKEND_ERRORS as error:
+            logger.warning("Page cache unavailable: %r", error)
+            return None
+        # The parameters are sorted so the same request always gives the same key
+        digest = hashlib.blake2b(
+            json.dumps(params, sort_keys=True, default=str).encode(),
+            digest_size=16,
+        ).hexdigest()
+        return "{namespace}:{table}:v{version}:{digest}".format(
+            namespace=self.namespace,
+            table=table,
+            version=int(version or 0),
+            digest=digest,
+        )
+
+    async def get(self, key: str | None) -> bytes | None:
+        if self.backend is None or key is None:
+            return None
+        try:
+            value = await self.backend.get(key)
+        except BACKEND_ERRORS as error:
+            logger.warning("Page cache unavailable: %r", error)
+            value = None
+        if value is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return value
+
+    async def set(self, key: str | None, value: bytes, table: str | None = None) -> None:
+        # With the table, a page filled in while the table is settling after a change is kept for less time.
+        # That costs one more round trip, but pages are only set after a trip to the database anyway.
+        if self.backend is None or key is None:
+            return
+        try:
+            ttl = self.ttl
+            if table is not None and 0 < self.settle_ttl < ttl:
+                if await self.backend.get(self._settling_key(table)) is not None:
+                    ttl = self.settle_ttl
+            await self.backend.set(key, value, ttl=ttl)
+        except BACKEND_ERRORS as error:
+            logger.warning("Page cache unavailable: %r", error)
+
+    async def invalidate(self, table: str) -> None:
+        if self.backend is None:
+            return
+        try:
+            await self.backend.incr(self._version_key(table))
+            if self.settle_ttl > 0:
+                await self.backend.set(self._settling_key(table), b"1", ttl=self.settle_ttl)
+        except BACKEND_ERRORS as error:
+            # Cached pages stay around until they expire
+            logger.warning("Couldn't invalidate cached %s pages: %r", table, error)
+
+    async def close(self) -> None:
+        if self.backend is not None:
+            await self.backend.close()
@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import AsyncIterator
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.database import SqlAlchemyRepository, connection_provider
+from app.models.product import product_table
+from app.services.product_import import ImportFormat, ProductImportService, parse_rows
+from app.services.seed import delete_seeded, seed_database
+from app.settings import Settings
+
+
+async def read_chunks(path: str, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    # Read the file a piece at a time, so big files don't have to fit in memory
+    file = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        while chunk := file.read(chunk_size):
+            yield chunk
+    finally:
+        if file is not sys.stdin.buffer:
+            file.close()
+
+
+def print_progress(received: int, failed: int) -> None:
+    print("{received} rows read, {failed} failed".format(received=received, failed=failed), file=sys.stderr)
+
+
+async def run_import(path: str, format: ImportFormat) -> int:
+    engine = connection_provider.get_engine()
+    try:
+        async with engine.connect() as connection:
+            repository = SqlAlchemyRepository(db=connection, table=product_table)
+            service = ProductImportService(repository=repository)
+            result = await service.import_products(parse_rows(format, read_chunks(path)), on_progress=print_progress)
+    finally:
+        await connection_provider.dispose_engine()
+
+    print(result.model_dump_json(indent=2))
+    return 1 if result.failed else 0
+
+
+# From our pyproject.toml, we define this as the import-products command.
+def import_products():
+    parser = argparse.ArgumentParser(description="Loads a product catalog from a CSV or NDJSON file.")
+    parser.add_argument("path", help="The file to import, or - to read from standard input")
+    parser.add_argument(
+        "--format",
+        choices=[format.value for format in ImportFormat],
+        help="The format of the file. Worked out from the file name when not given.",
+    )
+    arguments = parser.parse_args()
+
+    format = arguments.format
+    if format is None:
+        format = ImportFormat.CSV if arguments.path.endswith(".csv") else ImportFormat.NDJSON
+    sys.exit(asyncio.run(run_import(arguments.path, ImportFormat(format))))
+
+
+def print_seed_progress(table: str, loaded: int) -> None:
+    print("{table}: {loaded} rows".format(table=table, loaded=loaded), file=sys.stderr)
+
+
+async def run_seed(arguments: argparse.Namespace) -> int:
+    settings = Settings()
+    # One connection for each worker process, as each copies its batches in on its own
+    engine = create_async_engine(settings.get_db_url(), pool_size=arguments.jobs, max_overflow=0)
+    try:
+        if arguments.delete:
+            await delete_seeded(engine)
+            return 0
+        started = time.perf_counter()
+        loaded = await seed_database(
+            engine,
+            products=arguments.products,
+            orders=arguments.orders,
+            customers=arguments.customers,
+            seed=arguments.seed,
+            batch_size=arguments.batch_size,
+            jobs=arguments.jobs,
+            on_progress=print_seed_progress,
+        )
+    finally:
+        await engine.dispose()
+
+    print(
+        "{loaded} in {seconds:.1f}s".format(
+            loaded=", ".join("{count} {table}".format(count=count, table=table) for table, count in loaded.items()),
+            seconds=time.perf_counter() - started,
+        )
+    )
+    return 0
+
+
+# From our pyproject.toml, we define this as the seed command.
+def seed():
+    parser = argparse.ArgumentParser(
+        description="Fills the database with generated products and orders, for trying things out at scale."
+    )
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--orders", type=int, default=100_000)
+    # Customer names are shared between orders, so some of them have a long order history
+    parser.add_argument("--customers", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=42, help="The same seed generates the same rows")
+    parser.add_argument("--batch-size", type=int, default=50_000, help="Rows generated and copied in at a time")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Batches generated and loaded at once")
+    parser.add_argument("--delete", action="store_true", help="Delete the generated rows instead")
+    arguments = parser.parse_args()
+    sys.exit(asyncio.run(run_seed(arguments)))
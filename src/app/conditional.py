@@ -0,0 +1,66 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any
+
+from fastapi import Request
+
+# Conditional requests let clients (and CDNs) ask "has this changed since I last fetched it?".
+# When it hasn't, we answer 304 Not Modified with no body.
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Conditional_requests
+
+
+def make_etag(*parts: Any) -> str:
+    """
+    A weak ETag built from whatever identifies a version of a response, like an id and its updated_at.
+    Weak means two responses with the same ETag mean the same thing, not that they are byte for byte the same.
+    """
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+    return 'W/"{digest}"'.format(digest=digest)
+
+
+def _as_utc(value: datetime) -> datetime:
+    # Our timestamps are stored without a time zone, but they are in UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def validator_headers(etag: str, last_modified: datetime | None = None) -> dict[str, str]:
+    headers = {"ETag": etag}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(_as_utc(last_modified), usegmt=True)
+    return headers
+
+
+def is_conditional(request: Request) -> bool:
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison, so W/"x" and "x" are the same tag
+    if if_none_match.strip() == "*":
+        return True
+    wanted = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == wanted for tag in if_none_match.split(","))
+
+
+def not_modified(request: Request, etag: str, last_modified: datetime | None = None) -> bool:
+    """
+    Whether the client already has this version of the response.
+    Pass last_modified only when a newer timestamp is the only way the response can change.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    # If-None-Match wins when both are sent, as it's the more precise of the two
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    # HTTP dates only go down to the second
+    return _as_utc(last_modified).replace(microsecond=0) <= since
@@ -0,0 +1,23 @@
+from enum import StrEnum
+from typing import NamedTuple
+
+# How list endpoints count their results. It's picked by the client (?count=) and carried out by the repository,
+# so it lives here, where both the schemas and the database can use it without depending on each other.
+
+
+class CountStrategy(StrEnum):
+    # Run count(*). Always correct, but has to visit every matching row.
+    EXACT = "exact"
+    # Ask PostgreSQL's planner how many rows it expects. Practically free, but only a guess.
+    ESTIMATED = "estimated"
+    # Run count(*) and re-use the result for the same filters until it expires
+    CACHED = "cached"
+    # Don't count at all
+    NONE = "none"
+
+
+class Count(NamedTuple):
+    # None when nothing was counted
+    value: int | None
+    # True when the value is the planner's estimate or was re-used from an earlier count, not counted just now
+    estimated: bool = False
@@ -1,35 +1,143 @@
 import abc
-from typing import Any, Sequence, Tuple
+import json
+import uuid
+from datetime import datetime
+from functools import cache, lru_cache
+from typing import Any, AsyncIterator, Sequence, Tuple
 
 from sqlalchemy import (
+    Column,
     ColumnElement,
     CursorResult,
     Delete,
     Insert,
+    MetaData,
     RowMapping,
     Select,
     Table,
     UnaryExpression,
     Update,
+    and_,
+    bindparam,
+    column,
     func,
-    literal_column,
+    not_,
     select,
+    table,
+    true,
+    tuple_,
 )
 from sqlalchemy.ext.asyncio import AsyncConnection
 from sqlalchemy.sql.dml import ReturningInsert, ReturningUpdate
 
+from app.cache import TTLCache
+
+# Re-exported, as the repositories are where counts are made
+from app.counting import Count, CountStrategy  # noqa: F401
+from app.models import readable_columns
+from app.settings import Settings
+
+settings = Settings()
+
+# Just the columns of PostgreSQL's catalog that we need for estimating counts
+pg_class = table("pg_class", column("oid"), column("reltuples"))
+
+# Counts are shared by every request in this process, keyed by the counted SQL
+count_cache = TTLCache(max_entries=settings.count_cache_max_entries, ttl=settings.count_cache_ttl_seconds)
+
+
+def coerce_key_value(key: ColumnElement[Any], value: Any) -> Any:
+    # Cursor values come back from JSON, so turn them back into the type of their key.
+    # Raises ValueError or TypeError when the value doesn't fit.
+    if value is None:
+        return None
+    python_type = key.type.python_type
+    if python_type is datetime and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return python_type(value)
+
+
+# The estimate for a whole table, which is the same statement whatever the table
+table_estimate_statement: Select = select(pg_class.c.reltuples).where(
+    pg_class.c.oid == func.to_regclass(bindparam("table_name"))
+)
+
+
+class TableStatements:
+    """
+    The statements a repository runs that always have the same shape, built once per table.
+
+    Building a statement and working out its cache key costs far more than running it through
+    SQLAlchemy's compiled cache, so these are made once and only their parameters change from call to call.
+    Every call also sends the exact same SQL, which asyncpg has already prepared on that connection.
+    https://docs.sqlalchemy.org/en/20/core/connections.html#sql-compilation-caching
+    """
+
+    def __init__(self, table: Table):
+        self.table = table
+        columns = readable_columns(table)
+        self.select: Select = select(*columns)
+        # The parameter can't be called id, as UPDATE uses the column names for the values to set
+        self.get_one: Select = self.select.where(table.c.id == bindparam("target_id"))
+        # Without values(), the columns to insert or set come from the keys of the parameters
+        self.insert: ReturningInsert[Tuple] = table.insert().returning(*columns)
+        # sort_by_parameter_order makes sure the returned rows line up with the rows we passed in
+        self.insert_many: ReturningInsert[Tuple] = table.insert().returning(*columns, sort_by_parameter_order=True)
+        self.update: ReturningUpdate[Tuple] = (
+            table.update().where(table.c.id == bindparam("target_id")).returning(*columns)
+        )
+        self.delete: Delete = table.delete().where(table.c.id == bindparam("target_id"))
+
+    @lru_cache(maxsize=64)
+    def get_one_with(self, columns: tuple[ColumnElement[Any], ...]) -> Select:
+        # For reads of only some of the columns. There are only so many sets of columns asked for.
+        return select(*columns).where(self.table.c.id == bindparam("target_id"))
+
+
+@cache
+def get_table_statements(table: Table) -> TableStatements:
+    return TableStatements(table)
+
 
 class Repository(abc.ABC):
     @abc.abstractmethod
     async def commit(self):
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    async def rollback(self):
+        raise NotImplementedError()
+
     @abc.abstractmethod
     async def insert(self, data: dict) -> RowMapping:
         raise NotImplementedError()
 
     @abc.abstractmethod
-    async def update(self, id: int, data: dict) -> RowMapping:
+    async def insert_many(self, data: list[dict], chunk_size: int = 1000) -> Sequence[RowMapping]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def create_staging_table(self, columns: list[str]) -> Table:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def copy_records(self, table: Table, columns: list[str], records: list[tuple]) -> None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def delete_duplicate_ids(self, staging_table: Table) -> int:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def merge_staging_table(
+        self, staging_table: Table, columns: list[str], conditions: list[ColumnElement[bool]] | None = None
+    ) -> tuple[int, int, int]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def update(
+        self, id: int, data: dict, conditions: list[ColumnElement[bool]] | None = None
+    ) -> RowMapping | None:
         raise NotImplementedError()
 
     @abc.abstractmethod
@@ -37,11 +145,26 @@ class Repository(abc.ABC):
         raise NotImplementedError()
 
     @abc.abstractmethod
-    async def get_one(self, id: int) -> RowMapping | None:
+    async def get_one(self, id: int, columns: list[ColumnElement[Any]] | None = None) -> RowMapping | None:
         raise NotImplementedError()
 
     @abc.abstractmethod
-    async def get_count(self, select_statement: Select, filters: list) -> int:
+    def stream(
+        self,
+        select_statement: Select,
+        filters: list[ColumnElement[bool]],
+        ordering: list[UnaryExpression[Any]],
+        batch_size: int,
+    ) -> AsyncIterator[Sequence[RowMapping]]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def get_count(
+        self,
+        select_statement: Select,
+        filters: list,
+        strategy: CountStrategy = CountStrategy.EXACT,
+    ) -> Count:
         raise NotImplementedError()
 
     @abc.abstractmethod
@@ -55,27 +178,44 @@ class Repository(abc.ABC):
     ) -> Sequence[RowMapping]:
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    async def paginate_keyset(
+        self,
+        select_statement: Select,
+        filters: list[ColumnElement[bool]],
+        keys: list[ColumnElement[Any]],
+        after: Sequence[Any] | None,
+        size: int,
+        descending: bool = False,
+    ) -> Sequence[RowMapping]:
+        raise NotImplementedError()
+
 
 class SqlAlchemyRepository(Repository):
     def __init__(self, db: AsyncConnection, table: Table):
         super().__init__()
         self.db = db
         self.table = table
+        self.statements = get_table_statements(table)
 
     async def commit(self):
+        # The error still goes to the caller, so nothing that assumes the change was saved (like a cache) runs
         try:
             await self.db.commit()
         except Exception:
             await self.db.rollback()
+            raise
+
+    async def rollback(self):
+        # Undo everything done since the last commit
+        await self.db.rollback()
 
     async def insert(self, data: dict) -> RowMapping:
-        # Use the table object to help identify the columns to be inserted
-        # Dump our model to a dictionary for SQLAlchemy to map the attributes to columns
-        # Then return all columns
-        insert_statement: ReturningInsert[Tuple] = self.table.insert().values(data).returning(literal_column("*"))
-        self._get_compiled_query(insert_statement)
+        # The statement was built once for the table, see TableStatements.
+        # Our model dumped to a dictionary is its parameters, which SQLAlchemy maps to the columns to insert.
+        # It returns all columns.
         # Run the insert. Don't forget to await!
-        result_records: CursorResult = await self.db.execute(insert_statement)
+        result_records: CursorResult = await self.db.execute(self.statements.insert, data)
         # mappings() to map the results back to a dictionary
         # first() because we want the first (only) result
         return result_records.mappings().first()
@@ -83,23 +223,103 @@ class SqlAlchemyRepository(Repository):
         # This includes support for testing of containment of specific keys (string column names or objects),
         # as well as iteration of keys, values, and items:
 
-    async def update(self, id: int, data: dict) -> RowMapping:
-        update_statement: ReturningUpdate[Tuple] = (
-            self.table.update().where(self.table.c.id == id).values(data).returning(literal_column("*"))
+    async def insert_many(self, data: list[dict], chunk_size: int = 1000) -> Sequence[RowMapping]:
+        if not data:
+            return []
+        # PostgreSQL allows at most 32767 parameters in one statement, and every column of every row is one
+        chunk_size = max(1, min(chunk_size, 32767 // len(data[0])))
+        # Passing a list of rows makes SQLAlchemy send multi-row INSERT ... VALUES (...), (...) RETURNING statements,
+        # chunk_size rows at a time, instead of one statement per row.
+        # https://docs.sqlalchemy.org/en/20/core/connections.html#engine-insertmanyvalues
+        result_records: CursorResult = await self.db.execute(
+            self.statements.insert_many,
+            data,
+            execution_options={"insertmanyvalues_page_size": chunk_size},
+        )
+        return result_records.mappings().all()
+
+    async def create_staging_table(self, columns: list[str]) -> Table:
+        # A temporary table with the same column types, for loading a lot of rows before merging them in.
+        # Only this connection can see it, and PostgreSQL drops it when the transaction ends.
+        staging_table = Table(
+            "{name}_staging_{suffix}".format(name=self.table.name, suffix=uuid.uuid4().hex[:8]),
+            MetaData(),
+            *[Column(name, self.table.c[name].type) for name in columns],
+            prefixes=["TEMPORARY"],
+            postgresql_on_commit="DROP",
         )
-        self._get_compiled_query(update_statement)
-        result_records: CursorResult = await self.db.execute(update_statement)
+        await self.db.run_sync(staging_table.create)
+        return staging_table
+
+    async def copy_records(self, table: Table, columns: list[str], records: list[tuple]) -> None:
+        # COPY is PostgreSQL's fastest way to load rows. asyncpg sends them in the binary format,
+        # so nothing has to be turned into SQL text or parsed on the way.
+        # https://magicstack.github.io/asyncpg/current/api/index.html#asyncpg.connection.Connection.copy_records_to_table
+        raw_connection = await self.db.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table(table.name, records=records, columns=columns)
+
+    async def delete_duplicate_ids(self, staging_table: Table) -> int:
+        # Rows sharing an id would all update the same row, and which of them wins isn't defined.
+        # So none of them does: they are all removed. Returns how many rows were removed.
+        duplicate_ids = (
+            select(staging_table.c.id)
+            .where(staging_table.c.id.is_not(None))
+            .group_by(staging_table.c.id)
+            .having(func.count() > 1)
+        )
+        result: CursorResult = await self.db.execute(
+            staging_table.delete().where(staging_table.c.id.in_(duplicate_ids))
+        )
+        return result.rowcount
+
+    async def merge_staging_table(
+        self, staging_table: Table, columns: list[str], conditions: list[ColumnElement[bool]] | None = None
+    ) -> tuple[int, int, int]:
+        # Rows with an id update the existing row with that id, as long as it meets the conditions.
+        # Rows without one are inserted.
+        # Returns how many rows were updated, inserted, and held back because their row didn't meet the conditions.
+        value_columns = [name for name in columns if name != "id"]
+        updated = 0
+        held_back = 0
+        if "id" in columns:
+            if conditions:
+                held_back = (
+                    await self.db.execute(
+                        select(func.count())
+                        .select_from(staging_table.join(self.table, self.table.c.id == staging_table.c.id))
+                        .where(not_(and_(*conditions)))
+                    )
+                ).scalar_one()
+            update_statement: Update = (
+                self.table.update()
+                .where(self.table.c.id == staging_table.c.id, *(conditions or []))
+                .values({name: staging_table.c[name] for name in value_columns})
+            )
+            updated = (await self.db.execute(update_statement)).rowcount
+        insert_statement: Insert = self.table.insert().from_select(
+            value_columns,
+            select(*[staging_table.c[name] for name in value_columns]).where(
+                staging_table.c.id.is_(None) if "id" in columns else true()
+            ),
+        )
+        inserted = (await self.db.execute(insert_statement)).rowcount
+        return updated, inserted, held_back
+
+    async def update(
+        self, id: int, data: dict, conditions: list[ColumnElement[bool]] | None = None
+    ) -> RowMapping | None:
+        # With conditions, the row is only updated when it meets them. None means no row was updated.
+        update_statement = self.statements.update.where(*conditions) if conditions else self.statements.update
+        result_records: CursorResult = await self.db.execute(update_statement, {**data, "target_id": id})
         return result_records.mappings().first()
 
     async def delete(self, id: int) -> None:
-        delete_statement: Delete = self.table.delete().where(self.table.c.id == id)
-        self._get_compiled_query(delete_statement)
-        await self.db.execute(delete_statement)
+        await self.db.execute(self.statements.delete, {"target_id": id})
 
-    async def get_one(self, id: int) -> RowMapping | None:
-        select_statement: Select = self.table.select().where(self.table.c.id == id)
-        self._get_compiled_query(select_statement)
-        result_records: CursorResult = await self.db.execute(select_statement)
+    async def get_one(self, id: int, columns: list[ColumnElement[Any]] | None = None) -> RowMapping | None:
+        # Only the given columns are fetched when there are some, otherwise the whole row
+        select_statement = self.statements.get_one_with(tuple(columns)) if columns else self.statements.get_one
+        result_records: CursorResult = await self.db.execute(select_statement, {"target_id": id})
         return result_records.mappings().first()
 
     async def paginate(
@@ -115,18 +335,121 @@ class SqlAlchemyRepository(Repository):
         if ordering:
             select_statement = select_statement.order_by(*ordering)
         select_statement = select_statement.offset(offset).limit(size)
-        self._get_compiled_query(select_statement)
         result_records: CursorResult = await self.db.execute(select_statement)
         return result_records.mappings().all()
 
-    async def get_count(self, select_statement: Select, filters: list) -> int:
+    async def paginate_keyset(
+        self,
+        select_statement: Select,
+        filters: list[ColumnElement[bool]],
+        keys: list[ColumnElement[Any]],
+        after: Sequence[Any] | None,
+        size: int,
+        descending: bool = False,
+    ) -> Sequence[RowMapping]:
+        # Keyset ("seek") pagination: instead of making the database skip over OFFSET rows,
+        # we continue from the sort key of the last row we have seen. With an index on the keys,
+        # every page costs the same no matter how deep it is.
+        # The last key should be unique (like the id) so that rows with equal sort values aren't skipped.
+        if filters:
+            select_statement = select_statement.where(*filters)
+        if after is not None:
+            # The cursor values come from JSON, so convert them back to the types of the keys
+            values = [coerce_key_value(key, value) for key, value in zip(keys, after, strict=True)]
+            # Row value comparison: WHERE (key, id) > (:key, :id)
+            if descending:
+                select_statement = select_statement.where(tuple_(*keys) < tuple_(*values))
+            else:
+                select_statement = select_statement.where(tuple_(*keys) > tuple_(*values))
+            if len(keys) > 1:
+                # Only an index on all the keys can find a row value. Bounding the first key on its own as well
+                # lets an index on just that column find where to start.
+                first_key_bound = keys[0] <= values[0] if descending else keys[0] >= values[0]
+                select_statement = select_statement.where(first_key_bound)
+        if descending:
+            select_statement = select_statement.order_by(*[key.desc() for key in keys])
+        else:
+            select_statement = select_statement.order_by(*[key.asc() for key in keys])
+        select_statement = select_statement.limit(size)
+        result_records: CursorResult = await self.db.execute(select_statement)
+        return result_records.mappings().all()
+
+    async def stream(
+        self,
+        select_statement: Select,
+        filters: list[ColumnElement[bool]],
+        ordering: list[UnaryExpression[Any]],
+        batch_size: int,
+    ) -> AsyncIterator[Sequence[RowMapping]]:
+        # Reads the results through a server-side cursor, batch_size rows at a time,
+        # so we never hold more than one batch in memory however many rows match.
+        # This needs a transaction, which PostgreSQL keeps the cursor open in.
+        # https://docs.sqlalchemy.org/en/20/core/connections.html#engine-stream-results
+        if filters:
+            select_statement = select_statement.where(*filters)
+        if ordering:
+            select_statement = select_statement.order_by(*ordering)
+        result = await self.db.stream(select_statement.execution_options(yield_per=batch_size))
+        async for partition in result.mappings().partitions():
+            yield partition
+
+    async def get_count(
+        self,
+        select_statement: Select,
+        filters: list,
+        strategy: CountStrategy = CountStrategy.EXACT,
+    ) -> Count:
+        if strategy == CountStrategy.NONE:
+            return Count(None)
+        if strategy == CountStrategy.ESTIMATED:
+            return Count(await self._get_estimated_count(select_statement, filters), estimated=True)
+
         count_select_statement: Select[Tuple[int]] = select(func.count()).select_from(
             select_statement.where(*filters).subquery()
         )
-        self._get_compiled_query(count_select_statement)
+        if strategy == CountStrategy.CACHED:
+            # The SQL and the values of its parameters identify the filter set
+            cache_key = await self._compile(count_select_statement)
+            count = count_cache.get(cache_key)
+            if count is not None:
+                return Count(count, estimated=True)
+            result: CursorResult = await self.db.execute(count_select_statement)
+            count = result.scalar_one_or_none()
+            count_cache.set(cache_key, count)
+            return Count(count)
+
         result: CursorResult = await self.db.execute(count_select_statement)
-        return result.scalar_one_or_none()
+        return Count(result.scalar_one_or_none())
+
+    async def _compile(self, statement: Select) -> tuple[str, tuple[Any, ...]]:
+        """
+        The SQL of a statement and its parameters in order, for running it with exec_driver_sql().
+        It's compiled with the dialect of the connection it will run on, once that's connected:
+        until then, the dialect doesn't know the server's settings, like how it wants backslashes in strings.
+        """
+        dialect = await self.db.run_sync(lambda connection: connection.dialect)
+        # IN lists are written out in full, with one parameter per value
+        compiled = statement.compile(dialect=dialect, compile_kwargs={"render_postcompile": True})
+        return str(compiled), tuple(compiled.params[name] for name in compiled.positiontup)
+
+    async def _get_estimated_count(self, select_statement: Select, filters: list) -> int:
+        if not filters:
+            # For the whole table, the row count kept up to date by VACUUM and ANALYZE is good enough
+            # https://www.postgresql.org/docs/current/catalog-pg-class.html
+            table_name = self.db.dialect.identifier_preparer.format_table(self.table)
+            result: CursorResult = await self.db.execute(table_estimate_statement, {"table_name": table_name})
+            estimate = result.scalar_one_or_none()
+            # The table has never been analyzed (-1, or 0 before PostgreSQL 14), so ask the planner instead
+            if estimate is not None and estimate > 0:
+                return int(estimate)
 
-    def _get_compiled_query(self, statement: Select | Insert | Update | Delete):
-        compiled_query = str(statement.compile(compile_kwargs={"literal_binds": True}))
-        print(compiled_query)
+        # Otherwise, use the number of rows the planner expects the query to return.
+        # EXPLAIN only plans the query, it doesn't run it.
+        # The values the client sent stay parameters, they're never written into the SQL.
+        sql, parameters = await self._compile(select_statement.where(*filters))
+        result: CursorResult = await self.db.exec_driver_sql("EXPLAIN (FORMAT JSON) " + sql, parameters)
+        plan = result.scalar_one()
+        # asyncpg hands back json columns as text
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
@@ -1,23 +1,337 @@
-from sqlalchemy.ext.asyncio import create_async_engine
+import asyncio
+import itertools
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from http.cookies import SimpleCookie
+from typing import Any, AsyncIterator, Awaitable, Callable
 
+from fastapi import Request
+from sqlalchemy import Dialect, exc
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncTransaction, create_async_engine
+
+from app.database.instrumentation import query_instrumentation
+from app.metrics import db_pool_timeouts_total, db_pool_wait_seconds, install_pool_metrics
 from app.settings import Settings
 
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+# Set on responses to writes. Until the time it holds, the client's reads go to the primary.
+READ_YOUR_WRITES_COOKIE = "read_primary_until"
+# Lets clients ask for the primary explicitly, for when they can't keep cookies
+READ_CONSISTENCY_HEADER = "X-Read-Consistency"
+
 # We use this as a hidden, module-level object to ensure we re-use it.
-__engine = None
+__engine: AsyncEngine | None = None
+# The same goes for the replicas. Each replica has its own engine, and so its own pool.
+__replica_engines: list[AsyncEngine] | None = None
+# When each replica can be tried again after failing. 0 means it's healthy.
+__replica_retry_at: list[float] = []
+# Hands out replicas in turn
+__replica_counter = itertools.count()
+
+
+def prepared_statement_name() -> str:
+    # Unique names, so a server connection that PgBouncer hands to us after another client never has one already
+    return "__asyncpg_{id}__".format(id=uuid.uuid4().hex)
+
+
+def get_connect_args(settings: Settings) -> dict[str, Any]:
+    # https://docs.sqlalchemy.org/en/20/dialects/postgresql.html#prepared-statement-cache
+    connect_args: dict[str, Any] = {"prepared_statement_cache_size": settings.db_statement_cache_size}
+    if settings.db_statement_cache_size == 0:
+        # Behind PgBouncer in transaction mode, each transaction can run on a different server connection,
+        # so statements prepared on one aren't there on the next. asyncpg's own cache has to go too,
+        # and the statements it still prepares for each query need names that can't clash.
+        # https://docs.sqlalchemy.org/en/20/dialects/postgresql.html#prepared-statement-name-with-pgbouncer
+        connect_args["statement_cache_size"] = 0
+        connect_args["prepared_statement_name_func"] = prepared_statement_name
+    return connect_args
 
 
-async def database_connection():
+def create_engine(url: str, settings: Settings, name: str = "primary") -> AsyncEngine:
+    # https://docs.sqlalchemy.org/en/20/core/pooling.html#setting-pool-options
+    # Each worker process creates its own engine, so this is the pool of one worker
+    pool_size, max_overflow = settings.get_pool_limits()
+    engine = create_async_engine(
+        url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings.db_pool_timeout_seconds,
+        pool_pre_ping=settings.db_pool_pre_ping,
+        pool_recycle=settings.db_pool_recycle_seconds,
+        connect_args=get_connect_args(settings),
+    )
+    if settings.db_instrumentation_enabled:
+        query_instrumentation.install(engine)
+    install_pool_metrics(engine, name=name)
+    return engine
+
+
+def get_engine() -> AsyncEngine:
     # Make sure we use the module-level object.
     global __engine
     if __engine is None:
-        settings = Settings()
-        connection_string = settings.get_db_url()
         # This stores the SQLAlchemy engine back in the module-level object.
         # This ensures we don't accidentally create multiple connection pools.
-        __engine = create_async_engine(connection_string)
+        __engine = create_engine(settings.get_db_url(), settings)
+    return __engine
+
+
+def get_replica_engines() -> list[AsyncEngine]:
+    global __replica_engines, __replica_retry_at
+    if __replica_engines is None:
+        __replica_engines = [
+            create_engine(url, settings, name="replica{index}".format(index=index))
+            for index, url in enumerate(settings.db_replica_urls)
+        ]
+        __replica_retry_at = [0.0] * len(__replica_engines)
+    return __replica_engines
+
+
+async def warm_engine(engine: AsyncEngine, connection_count: int) -> None:
+    # Open the connections all at once, then hand them back so they wait in the pool
+    connections = await asyncio.gather(*[engine.connect() for _ in range(connection_count)])
+    for connection in connections:
+        await connection.close()
+
+
+async def start_engine(settings: Settings) -> AsyncEngine:
+    """
+    Creates the engines and opens some connections ahead of time.
+    Called when the application starts, so the first requests don't pay for connecting.
+    """
+    global __engine
+    if __engine is None:
+        __engine = create_engine(settings.get_db_url(), settings)
+    # Any more than the pool size would be closed again as soon as they are handed back
+    connection_count = min(settings.db_pool_warm_connections, settings.get_pool_limits()[0])
+    if connection_count > 0:
+        await warm_engine(__engine, connection_count)
+        for replica_engine in get_replica_engines():
+            await warm_engine(replica_engine, connection_count)
+    return __engine
+
+
+async def dispose_engine() -> None:
+    # Close every pooled connection. Called when the application shuts down.
+    global __engine, __replica_engines
+    if __engine is not None:
+        await __engine.dispose()
+        __engine = None
+    if __replica_engines is not None:
+        for replica_engine in __replica_engines:
+            await replica_engine.dispose()
+        __replica_engines = None
+
+
+async def _checkout(engine: AsyncEngine) -> AsyncConnection:
+    # Getting the connection is where we wait for the pool when every connection is in use
+    started = time.perf_counter()
+    try:
+        connection = await engine.connect()
+    except exc.TimeoutError:
+        db_pool_timeouts_total.inc()
+        raise
+    db_pool_wait_seconds.observe(time.perf_counter() - started)
+    return connection
+
+
+async def _checkout_for_read(use_primary: bool) -> AsyncConnection:
+    replica_engines = get_replica_engines()
+    if use_primary or not replica_engines:
+        return await _checkout(get_engine())
+
+    # Start with the next replica in turn, and move on to the others if it doesn't answer
+    start = next(__replica_counter)
+    now = time.monotonic()
+    for offset in range(len(replica_engines)):
+        index = (start + offset) % len(replica_engines)
+        if __replica_retry_at[index] > now:
+            continue
+        try:
+            connection = await _checkout(replica_engines[index])
+        except exc.TimeoutError:
+            # Every connection to it is busy. It's healthy, so it isn't skipped, but this read goes elsewhere.
+            logger.warning("The pool of replica %s is exhausted, trying the next one", index)
+            continue
+        except (OSError, exc.DBAPIError) as error:
+            logger.warning("Can't connect to replica %s, skipping it for now: %s", index, error)
+            __replica_retry_at[index] = now + settings.db_replica_retry_seconds
+            continue
+        __replica_retry_at[index] = 0.0
+        return connection
+
+    # Every replica is down, but the primary can answer reads too
+    return await _checkout(get_engine())
+
+
+@asynccontextmanager
+async def read_only_connection(use_primary: bool = False, snapshot: bool = False) -> AsyncIterator[AsyncConnection]:
+    """
+    A connection for reading, from one of the replicas when there are any.
+    This can be used outside of a request, where we can't depend on read_only_database_connection.
+
+    With snapshot, every statement in the transaction sees the database as it was when the first one started.
+    """
+    connection = await _checkout_for_read(use_primary)
+    try:
+        if snapshot:
+            # https://www.postgresql.org/docs/current/transaction-iso.html#XACT-REPEATABLE-READ
+            await connection.execution_options(isolation_level="REPEATABLE READ", postgresql_readonly=True)
+        async with connection.begin():
+            yield connection
+    finally:
+        await connection.close()
+
+
+class LazyConnection:
+    """
+    Stands in for an AsyncConnection in a request, and only takes a connection from the pool
+    when the first statement runs. Requests that never reach the database (like a product served
+    from the cache) don't hold a connection at all.
+
+    Committing or rolling back hands the connection straight back to the pool instead of keeping it
+    until the end of the request. A statement after that takes a new one.
+
+    It has the methods of AsyncConnection that the repositories use. Repository.stream() needs a transaction,
+    so it doesn't work with autocommit. Use read_only_connection() for that.
+    """
+
+    def __init__(
+        self,
+        checkout: Callable[[], Awaitable[AsyncConnection]],
+        dialect: Dialect,
+        autocommit: bool = False,
+    ):
+        self._checkout = checkout
+        self._connection: AsyncConnection | None = None
+        self.dialect = dialect
+        self.autocommit = autocommit
+
+    async def get_connection(self) -> AsyncConnection:
+        if self._connection is None:
+            connection = await self._checkout()
+            if self.autocommit:
+                # Every statement is its own transaction, so reads don't pay for BEGIN and COMMIT round trips.
+                # The pool puts the isolation level back when the connection is returned.
+                await connection.execution_options(isolation_level="AUTOCOMMIT")
+            self._connection = connection
+        return self._connection
+
+    async def execute(self, *args: Any, **kwargs: Any):
+        return await (await self.get_connection()).execute(*args, **kwargs)
+
+    async def exec_driver_sql(self, *args: Any, **kwargs: Any):
+        return await (await self.get_connection()).exec_driver_sql(*args, **kwargs)
+
+    async def stream(self, *args: Any, **kwargs: Any):
+        return await (await self.get_connection()).stream(*args, **kwargs)
+
+    async def run_sync(self, *args: Any, **kwargs: Any):
+        return await (await self.get_connection()).run_sync(*args, **kwargs)
+
+    async def get_raw_connection(self):
+        return await (await self.get_connection()).get_raw_connection()
+
+    async def begin_nested(self) -> AsyncTransaction:
+        return await (await self.get_connection()).begin_nested()
+
+    async def commit(self):
+        await self.release(commit=True)
+
+    async def rollback(self):
+        await self.release(commit=False)
+
+    async def release(self, commit: bool) -> None:
+        # Ends the transaction, if there is one, and hands the connection back. Does nothing without a connection.
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        try:
+            if connection.in_transaction():
+                if commit:
+                    await connection.commit()
+                else:
+                    await connection.rollback()
+        finally:
+            await connection.close()
+
+
+class ReadYourWritesMiddleware:
+    """
+    Sets the read-your-writes cookie on the responses of requests that used a connection that can write.
+
+    Handlers that return a Response of their own (like idempotent replays) don't get the headers FastAPI
+    collects from dependencies, so the cookie is added here, on its way out.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            # request.state is kept in the scope, so this sees what database_connection set
+            read_primary_until = scope.get("state", {}).get("read_primary_until")
+            if message["type"] == "http.response.start" and read_primary_until is not None:
+                cookie = SimpleCookie()
+                cookie[READ_YOUR_WRITES_COOKIE] = str(read_primary_until)
+                cookie[READ_YOUR_WRITES_COOKIE]["max-age"] = int(settings.db_read_your_writes_seconds) + 1
+                cookie[READ_YOUR_WRITES_COOKIE]["path"] = "/"
+                cookie[READ_YOUR_WRITES_COOKIE]["httponly"] = True
+                cookie[READ_YOUR_WRITES_COOKIE]["samesite"] = "lax"
+                header = cookie.output(header="").strip().encode("latin-1")
+                message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", header)]}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def _wants_primary(request: Request) -> bool:
+    if request.headers.get(READ_CONSISTENCY_HEADER, "").lower() == "primary":
+        return True
+    try:
+        return float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+async def database_connection(request: Request):
+    engine = get_engine()
+    connection = LazyConnection(lambda: _checkout(engine), dialect=engine.dialect)
+
+    # This connection can write, so send the client's next reads to the primary as well.
+    # Otherwise, they might not see their change until the replicas catch up.
+    # ReadYourWritesMiddleware puts the cookie on the response, whichever way the handler sends it.
+    if settings.db_replica_urls and settings.db_read_your_writes_seconds > 0:
+        request.state.read_primary_until = time.time() + settings.db_read_your_writes_seconds
 
     # https://docs.sqlalchemy.org/en/20/tutorial/dbapi_transactions.html#committing-changes
-    # Automatically create a transaction. Rollback on error. Commit on completion of the context.
-    async with __engine.begin() as connection:
+    # The transaction starts with the first statement. Rollback on error. Commit when the handler is done,
+    # unless the service committed already. Either way, the connection goes back to the pool.
+    try:
         # Yield to ensure we return back to this context in order to commit properly.
         yield connection
+    except BaseException:
+        await connection.release(commit=False)
+        raise
+    await connection.release(commit=True)
+
+
+async def read_only_database_connection(request: Request):
+    # Like database_connection, but for handlers that only read, so their reads can be served by a replica.
+    # The services' read_only() constructors depend on it. Their statements run in autocommit mode,
+    # which gives each one the same view of the database as the READ COMMITTED transaction they used to share.
+    use_primary = _wants_primary(request)
+    connection = LazyConnection(lambda: _checkout_for_read(use_primary), dialect=get_engine().dialect, autocommit=True)
+    try:
+        yield connection
+    finally:
+        await connection.release(commit=False)
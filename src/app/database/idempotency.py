@@ -0,0 +1,90 @@
+import abc
+from datetime import timedelta
+
+from sqlalchemy import CursorResult, RowMapping, func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.models.idempotency import idempotency_key_table
+
+
+class IdempotencyRepository(abc.ABC):
+    @abc.abstractmethod
+    async def claim(self, scope: str, key: str, request_hash: str, ttl: timedelta) -> RowMapping | None:
+        """
+        Records that a request with this key is being handled, and returns None.
+        When the key was already used, returns its record instead. A request still being handled with the same key
+        has its record locked, so this waits for it to finish first.
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def save(self, scope: str, key: str, status_code: int, response: bytes) -> None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def delete_expired(self, limit: int) -> int:
+        raise NotImplementedError()
+
+
+class SqlAlchemyIdempotencyRepository(IdempotencyRepository):
+    def __init__(self, db: AsyncConnection):
+        self.db = db
+
+    async def claim(self, scope: str, key: str, request_hash: str, ttl: timedelta) -> RowMapping | None:
+        table = idempotency_key_table
+        # The primary key makes a second INSERT of the same key wait until the first one's transaction ends.
+        # That's what holds back a retry sent while the first request is still running.
+        # An expired key is taken over as if it was never used.
+        claim_statement = (
+            insert(table)
+            .values(scope=scope, key=key, request_hash=request_hash, expires_at=func.now() + ttl)
+            .on_conflict_do_update(
+                index_elements=[table.c.scope, table.c.key],
+                set_={
+                    "request_hash": request_hash,
+                    "status_code": None,
+                    "response": None,
+                    "created_at": func.now(),
+                    "expires_at": func.now() + ttl,
+                },
+                where=table.c.expires_at <= func.now(),
+            )
+            .returning(table.c.key)
+        )
+        while True:
+            result: CursorResult = await self.db.execute(claim_statement)
+            if result.first() is not None:
+                return None
+            result = await self.db.execute(
+                select(table.c.request_hash, table.c.status_code, table.c.response).where(
+                    table.c.scope == scope, table.c.key == key
+                )
+            )
+            found = result.mappings().first()
+            # Unless it was deleted in between for having expired, in which case it's ours to claim after all
+            if found is not None:
+                return found
+
+    async def save(self, scope: str, key: str, status_code: int, response: bytes) -> None:
+        table = idempotency_key_table
+        await self.db.execute(
+            table.update()
+            .where(table.c.scope == scope, table.c.key == key)
+            .values(status_code=status_code, response=response)
+        )
+
+    async def delete_expired(self, limit: int) -> int:
+        table = idempotency_key_table
+        # A limited batch at a time, so the delete never holds a lot of locks for long
+        expired = (
+            select(table.c.scope, table.c.key)
+            .where(table.c.expires_at <= func.now())
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        result: CursorResult = await self.db.execute(
+            table.delete().where(tuple_(table.c.scope, table.c.key).in_(expired))
+        )
+        await self.db.commit()
+        return result.rowcount
@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import random
+import re
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Anything that looks like a value in a SQL statement: 'strings', numbers and bind parameters ($1, %(name)s, :name)
+_VALUE_PATTERN = re.compile(r"'(?:[^']|'')*'|\$\d+|%\(\w+\)s|(?<![\w:]):\w+|\b\d+(?:\.\d+)?\b")
+# Lists of values, like IN (?, ?, ?) or VALUES (?, ?), (?, ?)
+_LIST_PATTERN = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*")
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def normalize_statement(statement: str) -> str:
+    """
+    Turns a SQL statement into its "shape", so that the same query with different values
+    (or a different number of values in a list) is counted as the same query.
+    """
+    normalized = _VALUE_PATTERN.sub("?", statement)
+    normalized = _LIST_PATTERN.sub("(...)", normalized)
+    return _WHITESPACE_PATTERN.sub(" ", normalized).strip()
+
+
+@lru_cache(maxsize=1024)
+def fingerprint_statement(normalized_statement: str) -> str:
+    # A short, stable name for a query shape that is easy to search for in logs
+    return hashlib.blake2b(normalized_statement.encode(), digest_size=8).hexdigest()
+
+
+@dataclass
+class QueryStats:
+    statement: str
+    calls: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+    rows: int = 0
+
+
+# Called with (fingerprint, normalized statement, duration in seconds, row count) for every recorded query
+QueryListener = Callable[[str, str, float, int | None], None]
+
+
+class QueryInstrumentation:
+    """
+    Times the statements run through an engine using SQLAlchemy's engine events.
+    https://docs.sqlalchemy.org/en/20/faq/performance.html#query-profiling
+
+    Nothing is compiled or printed on the way, we only look at the SQL the engine already produced.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, slow_query_threshold_seconds: float | None = None):
+        self.sample_rate = sample_rate
+        self.slow_query_threshold_seconds = slow_query_threshold_seconds
+        # fingerprint -> stats
+        self.stats: dict[str, QueryStats] = {}
+        self.listeners: list[QueryListener] = []
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "QueryInstrumentation":
+        threshold = settings.db_slow_query_threshold_ms
+        return cls(
+            sample_rate=settings.db_instrumentation_sample_rate,
+            slow_query_threshold_seconds=threshold / 1000 if threshold > 0 else None,
+        )
+
+    def install(self, engine: AsyncEngine) -> None:
+        # Events are registered on the synchronous engine that the AsyncEngine wraps
+        event.listen(engine.sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine.sync_engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine.sync_engine, "handle_error", self._handle_error)
+
+    def uninstall(self, engine: AsyncEngine) -> None:
+        event.remove(engine.sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(engine.sync_engine, "after_cursor_execute", self._after_cursor_execute)
+        event.remove(engine.sync_engine, "handle_error", self._handle_error)
+
+    def add_listener(self, listener: QueryListener) -> None:
+        self.listeners.append(listener)
+
+    def reset(self) -> None:
+        self.stats.clear()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # None marks a statement we decided not to sample, so the start times always pair up with their statement
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter() if sampled else None)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_start_time"].pop()
+        if started is None:
+            return
+        duration = time.perf_counter() - started
+
+        # The asyncpg adapter takes the count from PostgreSQL's command tag ("SELECT 20", "UPDATE 1"),
+        # so it's there for SELECTs too. It's -1 when there's no count, like for server side cursors.
+        rowcount = cursor.rowcount if cursor.rowcount >= 0 else None
+
+        self.record(statement, duration, rowcount)
+
+    def _handle_error(self, exception_context):
+        # The statement failed, so after_cursor_execute won't run for it
+        start_times = (
+            exception_context.connection.info.get("query_start_time") if exception_context.connection else None
+        )
+        if start_times:
+            start_times.pop()
+
+    def record(self, statement: str, duration: float, rowcount: int | None) -> None:
+        normalized = normalize_statement(statement)
+        fingerprint = fingerprint_statement(normalized)
+
+        stats = self.stats.get(fingerprint)
+        if stats is None:
+            stats = self.stats[fingerprint] = QueryStats(statement=normalized)
+        stats.calls += 1
+        stats.total_seconds += duration
+        stats.max_seconds = max(stats.max_seconds, duration)
+        if rowcount is not None:
+            stats.rows += rowcount
+
+        if self.slow_query_threshold_seconds is not None and duration >= self.slow_query_threshold_seconds:
+            logger.warning(
+                "Slow query %s took %.1f ms (%s rows): %s",
+                fingerprint,
+                duration * 1000,
+                rowcount,
+                normalized,
+            )
+
+        for listener in self.listeners:
+            listener(fingerprint, normalized, duration, rowcount)
+
+
+# We use one instance for the whole process, so the stats of every engine end up in the same place
+query_instrumentation = QueryInstrumentation.from_settings(Settings())
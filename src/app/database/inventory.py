@@ -0,0 +1,256 @@
+import abc
+from decimal import Decimal
+
+from sqlalchemy import (
+    BigInteger,
+    CursorResult,
+    Integer,
+    bindparam,
+    case,
+    column,
+    func,
+    literal_column,
+    select,
+)
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.models.product import product_stock_bucket_table, product_table
+
+
+def _unnest_wanted():
+    # The products and quantities to reserve come in as two arrays, so the statements are the same SQL
+    # however many items an order has. That lets PostgreSQL and asyncpg re-use their prepared plans.
+    return (
+        func.unnest(
+            bindparam("product_ids", type_=ARRAY(BigInteger)),
+            bindparam("quantities", type_=ARRAY(Integer)),
+        )
+        .table_valued(column("product_id", BigInteger), column("quantity", Integer))
+        .render_derived(name="wanted")
+    )
+
+
+# Products with their stock in one place (stock_buckets = 0).
+# Lock the rows first, in id order. Two orders for the same products then always lock them in the same order,
+# so neither can end up holding a row the other is waiting for (a deadlock).
+# MATERIALIZED makes sure this runs on its own, before the update, instead of being merged into it.
+# NO KEY UPDATE still lets other orders check that the product exists when they add an order_item for it.
+_wanted = _unnest_wanted()
+_locked = (
+    select(product_table.c.id, _wanted.c.quantity)
+    .join_from(product_table, _wanted, product_table.c.id == _wanted.c.product_id)
+    .where(product_table.c.stock_buckets == 0)
+    .order_by(product_table.c.id)
+    .with_for_update(of=product_table, key_share=True)
+    .cte("locked")
+    .prefix_with("MATERIALIZED")
+)
+
+# Only rows with enough stock are updated, so stock can never go below 0, however many orders race for it.
+# When another order changed a row first, PostgreSQL checks the condition again against its new stock.
+# https://www.postgresql.org/docs/current/transaction-iso.html#XACT-READ-COMMITTED
+RESERVE_STATEMENT = (
+    product_table.update()
+    .where(product_table.c.id == _locked.c.id, product_table.c.stock >= _locked.c.quantity)
+    .values(stock=product_table.c.stock - _locked.c.quantity)
+    .returning(product_table.c.id, product_table.c.price)
+)
+
+# Products with their stock split into buckets. Each order takes its whole quantity from a single bucket,
+# picked at random among those with enough stock. SKIP LOCKED passes over buckets other orders are busy with,
+# so orders for the same product don't queue up behind each other, and never wait here at all.
+_bucket = product_stock_bucket_table.alias("bucket")
+_bucket_wanted = _unnest_wanted()
+_bucket_choice = (
+    select(_bucket.c.bucket)
+    .where(_bucket.c.product_id == _bucket_wanted.c.product_id, _bucket.c.stock >= _bucket_wanted.c.quantity)
+    .order_by(func.random())
+    .limit(1)
+    .with_for_update(key_share=True, skip_locked=True)
+    .lateral("choice")
+)
+_picked = (
+    select(_bucket_wanted.c.product_id, _bucket_wanted.c.quantity, _bucket_choice.c.bucket)
+    .select_from(_bucket_wanted.join(_bucket_choice, literal_column("true")))
+    .cte("picked")
+    .prefix_with("MATERIALIZED")
+)
+RESERVE_BUCKET_STATEMENT = (
+    product_stock_bucket_table.update()
+    .where(
+        product_stock_bucket_table.c.product_id == _picked.c.product_id,
+        product_stock_bucket_table.c.bucket == _picked.c.bucket,
+        product_stock_bucket_table.c.stock >= _picked.c.quantity,
+        product_table.c.id == _picked.c.product_id,
+    )
+    .values(stock=product_stock_bucket_table.c.stock - _picked.c.quantity)
+    .returning(product_stock_bucket_table.c.product_id, product_table.c.price)
+)
+
+# For when no single free bucket has enough: wait for every bucket of the product, then take what's needed
+# from them in bucket order. Products are locked in id order and buckets in bucket order, like above.
+_drain_wanted = _unnest_wanted()
+_all_buckets = (
+    select(
+        product_stock_bucket_table.c.product_id,
+        product_stock_bucket_table.c.bucket,
+        product_stock_bucket_table.c.stock,
+        _drain_wanted.c.quantity,
+    )
+    .join_from(
+        product_stock_bucket_table,
+        _drain_wanted,
+        product_stock_bucket_table.c.product_id == _drain_wanted.c.product_id,
+    )
+    .where(product_stock_bucket_table.c.stock > 0)
+    .order_by(product_stock_bucket_table.c.product_id, product_stock_bucket_table.c.bucket)
+    .with_for_update(of=product_stock_bucket_table, key_share=True)
+    .cte("all_buckets")
+    .prefix_with("MATERIALIZED")
+)
+# The stock of the buckets before each one, and of all of them together
+_before = (
+    func.sum(_all_buckets.c.stock).over(partition_by=_all_buckets.c.product_id, order_by=_all_buckets.c.bucket)
+    - _all_buckets.c.stock
+)
+_total = func.sum(_all_buckets.c.stock).over(partition_by=_all_buckets.c.product_id)
+_taken = (
+    select(
+        _all_buckets.c.product_id,
+        _all_buckets.c.bucket,
+        func.least(_all_buckets.c.stock, _all_buckets.c.quantity - _before).label("amount"),
+        (_total >= _all_buckets.c.quantity).label("enough"),
+    )
+).cte("taken")
+DRAIN_BUCKETS_STATEMENT = (
+    product_stock_bucket_table.update()
+    .where(
+        product_stock_bucket_table.c.product_id == _taken.c.product_id,
+        product_stock_bucket_table.c.bucket == _taken.c.bucket,
+        _taken.c.enough,
+        _taken.c.amount > 0,
+        product_table.c.id == _taken.c.product_id,
+    )
+    .values(stock=product_stock_bucket_table.c.stock - _taken.c.amount)
+    .returning(product_stock_bucket_table.c.product_id, product_table.c.price)
+)
+
+
+class InventoryRepository(abc.ABC):
+    @abc.abstractmethod
+    async def commit(self):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def reserve(self, quantities: dict[int, int]) -> dict[int, Decimal | None]:
+        """
+        Takes the quantities (by product id) out of stock.
+        Returns the price of every product that had enough stock. Products missing from the result
+        were left as they were, and it's up to the caller to roll back the ones that weren't.
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def get_stock(self, product_id: int) -> tuple[int, int] | None:
+        """The number of buckets of a product and its stock, or None when there's no such product."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def set_buckets(self, product_id: int, buckets: int, stock: int | None = None) -> tuple[int, int] | None:
+        """
+        Spreads the stock of a product over this many buckets, or puts it back in one place with 0.
+        The stock is set to the given value on the way, or kept as it is without one.
+        """
+        raise NotImplementedError()
+
+
+class SqlAlchemyInventoryRepository(InventoryRepository):
+    def __init__(self, db: AsyncConnection):
+        self.db = db
+
+    async def commit(self):
+        await self.db.commit()
+
+    async def reserve(self, quantities: dict[int, int]) -> dict[int, Decimal | None]:
+        if not quantities:
+            return {}
+        # One statement, and so one round trip, for all of the products that aren't split up
+        result: CursorResult = await self.db.execute(
+            RESERVE_STATEMENT,
+            {"product_ids": list(quantities), "quantities": list(quantities.values())},
+        )
+        prices = {row.id: row.price for row in result}
+        if len(prices) == len(quantities):
+            return prices
+
+        # The rest either have their stock in buckets, don't have enough, or don't exist
+        rest = {product_id: quantity for product_id, quantity in sorted(quantities.items()) if product_id not in prices}
+        parameters = {"product_ids": list(rest), "quantities": list(rest.values())}
+        # The buckets picked here are locked without any waiting, but the fallback below waits.
+        # Waiting while holding buckets picked out of order could deadlock, so they're let go first.
+        savepoint = await self.db.begin_nested()
+        result = await self.db.execute(RESERVE_BUCKET_STATEMENT, parameters)
+        bucket_prices = {row.product_id: row.price for row in result}
+        if len(bucket_prices) == len(rest):
+            await savepoint.commit()
+            return {**prices, **bucket_prices}
+
+        await savepoint.rollback()
+        result = await self.db.execute(DRAIN_BUCKETS_STATEMENT, parameters)
+        return {**prices, **{row.product_id: row.price for row in result}}
+
+    async def get_stock(self, product_id: int) -> tuple[int, int] | None:
+        bucket_stock = (
+            select(func.coalesce(func.sum(product_stock_bucket_table.c.stock), 0))
+            .where(product_stock_bucket_table.c.product_id == product_table.c.id)
+            .scalar_subquery()
+        )
+        result: CursorResult = await self.db.execute(
+            select(
+                product_table.c.stock_buckets,
+                case((product_table.c.stock_buckets > 0, bucket_stock), else_=product_table.c.stock),
+            ).where(product_table.c.id == product_id)
+        )
+        row = result.first()
+        return (row[0], row[1]) if row is not None else None
+
+    async def set_buckets(self, product_id: int, buckets: int, stock: int | None = None) -> tuple[int, int] | None:
+        # Locking the product first makes orders for it wait until the stock has moved.
+        # NO KEY UPDATE, like the other locks here: an order that already holds a bucket still has to add its
+        # order_item, whose foreign key check takes KEY SHARE on this row. A plain FOR UPDATE would block that
+        # while we wait for the order's bucket below, and the two would deadlock.
+        result: CursorResult = await self.db.execute(
+            select(product_table.c.stock, product_table.c.stock_buckets)
+            .where(product_table.c.id == product_id)
+            .with_for_update(key_share=True)
+        )
+        row = result.first()
+        if row is None:
+            return None
+        current_stock = row.stock
+        if row.stock_buckets > 0:
+            # Deleting the buckets waits for the orders still holding one of them
+            result = await self.db.execute(
+                product_stock_bucket_table.delete()
+                .where(product_stock_bucket_table.c.product_id == product_id)
+                .returning(product_stock_bucket_table.c.stock)
+            )
+            current_stock = sum(bucket_stock for (bucket_stock,) in result)
+
+        if stock is None:
+            stock = current_stock
+        if buckets > 0:
+            # As even as it gets. The first buckets get one more when it doesn't divide evenly.
+            share, remainder = divmod(stock, buckets)
+            await self.db.execute(
+                product_stock_bucket_table.insert(),
+                [
+                    {"product_id": product_id, "bucket": bucket, "stock": share + (1 if bucket < remainder else 0)}
+                    for bucket in range(buckets)
+                ],
+            )
+        await self.db.execute(
+            product_table.update().where(product_table.c.id == product_id).values(stock=stock, stock_buckets=buckets)
+        )
+        return buckets, stock
@@ -2,9 +2,47 @@ from fastapi import Depends
 from sqlalchemy.ext.asyncio.engine import AsyncConnection
 
 from app.database import Repository, SqlAlchemyRepository
-from app.database.connection_provider import database_connection
+from app.database.connection_provider import database_connection, read_only_database_connection
+from app.database.idempotency import IdempotencyRepository, SqlAlchemyIdempotencyRepository
+from app.database.inventory import InventoryRepository, SqlAlchemyInventoryRepository
+from app.models.order import order_item_table, order_table
 from app.models.product import product_table
 
 
 def get_product_repository(db: AsyncConnection = Depends(database_connection)) -> Repository:
     return SqlAlchemyRepository(db=db, table=product_table)
+
+
+# For handlers that only read. The connection may come from a replica, so don't write with it.
+def get_product_read_repository(db: AsyncConnection = Depends(read_only_database_connection)) -> Repository:
+    return SqlAlchemyRepository(db=db, table=product_table)
+
+
+def get_order_repository(db: AsyncConnection = Depends(database_connection)) -> Repository:
+    return SqlAlchemyRepository(db=db, table=order_table)
+
+
+def get_order_read_repository(db: AsyncConnection = Depends(read_only_database_connection)) -> Repository:
+    return SqlAlchemyRepository(db=db, table=order_table)
+
+
+def get_order_item_repository(db: AsyncConnection = Depends(database_connection)) -> Repository:
+    return SqlAlchemyRepository(db=db, table=order_item_table)
+
+
+def get_order_item_read_repository(db: AsyncConnection = Depends(read_only_database_connection)) -> Repository:
+    return SqlAlchemyRepository(db=db, table=order_item_table)
+
+
+# FastAPI hands every dependency of a request the same connection,
+# so stock is reserved in the same transaction as the order that needs it
+def get_inventory_repository(db: AsyncConnection = Depends(database_connection)) -> InventoryRepository:
+    return SqlAlchemyInventoryRepository(db=db)
+
+
+def get_inventory_read_repository(db: AsyncConnection = Depends(read_only_database_connection)) -> InventoryRepository:
+    return SqlAlchemyInventoryRepository(db=db)
+
+
+def get_idempotency_repository(db: AsyncConnection = Depends(database_connection)) -> IdempotencyRepository:
+    return SqlAlchemyIdempotencyRepository(db=db)
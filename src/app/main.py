@@ -1,14 +1,41 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+
 import uvicorn
 from fastapi import FastAPI
 
+from app.database import connection_provider
+from app.metrics import MetricsMiddleware
+from app.routes.metrics import router as metrics_router
 from app.routes.order import router as order_router
 from app.routes.product import router as product_router
+from app.services.idempotency import purge_expired_keys
+from app.services.product import product_list_cache
 from app.settings import Settings
 
 # Don't forget to create your Settings object to use it!
 settings = Settings()
+
+
+# Everything before the yield runs before the server accepts requests, everything after it when the server stops.
+# https://fastapi.tiangolo.com/advanced/events/#lifespan
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await connection_provider.start_engine(settings)
+    purge_task = None
+    if settings.idempotency_purge_interval_seconds > 0:
+        purge_task = asyncio.create_task(purge_expired_keys(settings.idempotency_purge_interval_seconds))
+    yield
+    if purge_task is not None:
+        purge_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await purge_task
+    await product_list_cache.close()
+    await connection_provider.dispose_engine()
+
+
 # We'll store our main FastAPI application in this app variable
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 # We can define routes on the FastAPI application directly, or
 # we can create a separate router that can be included in the app
 # logic. Note that we can define a prefix and organize routers by
@@ -16,15 +43,43 @@ app = FastAPI()
 app.include_router(product_router, prefix="/products")
 app.include_router(order_router, prefix="/orders")
 
+if settings.db_replica_urls and settings.db_read_your_writes_seconds > 0:
+    app.add_middleware(connection_provider.ReadYourWritesMiddleware)
+
+if settings.metrics_enabled:
+    # Middleware wraps every request, so this is where we time them all
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(metrics_router, prefix="/metrics")
+
 
 # From our pyproject.toml, we define this main function as our entrypoint.
 def main():
     # Here, we run the FastAPI application under the Uvicorn ASGI server.
     # Note that we could also run uvicorn via the CLI directly:
     #   uvicorn --host 0.0.0.0 --port 5000 "app.main:app"
+    if settings.server_mode != "production":
+        uvicorn.run(
+            "app.main:app",
+            host=settings.host_address,
+            port=settings.port,
+            log_level="debug",
+        )
+        return
+
+    # A Python process only ever runs on one CPU at a time, so we start one worker process per CPU.
+    # Each worker imports the app on its own, and so gets its own connection pool (see Settings.get_pool_limits).
+    # uvloop and httptools are faster, compiled versions of the event loop and the HTTP parser.
+    # On SIGTERM, the server stops accepting connections and lets running requests finish before shutting down.
     uvicorn.run(
         "app.main:app",
         host=settings.host_address,
         port=settings.port,
-        log_level="debug",
+        workers=settings.get_workers(),
+        loop="uvloop",
+        http="httptools",
+        log_level=settings.server_log_level,
+        access_log=settings.server_access_log,
+        timeout_keep_alive=settings.server_keep_alive_seconds,
+        backlog=settings.server_backlog,
+        timeout_graceful_shutdown=settings.server_graceful_shutdown_seconds,
     )
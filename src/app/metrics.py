@@ -0,0 +1,373 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.cache import PageCache, TTLCache
+from app.database import count_cache
+from app.database.instrumentation import query_instrumentation
+
+# https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+# Database work is usually a lot quicker than a whole request
+DATABASE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join('{name}="{value}"'.format(name=name, value=_escape(value)) for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [
+            "# HELP {name} {documentation}".format(name=self.name, documentation=self.documentation),
+            "# TYPE {name} {type}".format(name=self.name, type=self.type),
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self._values.items():
+            yield "{name}{labels} {value}".format(
+                name=self.name, labels=_format_labels(self.labelnames, labels), value=_format_value(value)
+            )
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, *labels: str, value: float) -> None:
+        self._values[labels] = value
+
+
+class CallbackGauge(Metric):
+    """A gauge that is only worked out when the metrics are scraped, so keeping it up to date costs nothing."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], Iterable[tuple[tuple[str, ...], float]]],
+        labelnames: Iterable[str] = (),
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.callback():
+            yield "{name}{labels} {value}".format(
+                name=self.name, labels=_format_labels(self.labelnames, labels), value=_format_value(value)
+            )
+
+
+class CallbackCounter(CallbackGauge):
+    type = "counter"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # labels -> (count per bucket, sum of observed values)
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = ([0] * len(self.buckets), [0.0])
+        # Only the first bucket that fits is counted here. They are added up when rendering.
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def samples(self) -> Iterable[str]:
+        labelnames = self.labelnames + ("le",)
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "{name}_bucket{labels} {value}".format(
+                    name=self.name,
+                    labels=_format_labels(labelnames, labels + (_format_value(bound),)),
+                    value=cumulative,
+                )
+            yield "{name}_sum{labels} {value}".format(
+                name=self.name, labels=_format_labels(self.labelnames, labels), value=_format_value(total[0])
+            )
+            yield "{name}_count{labels} {value}".format(
+                name=self.name, labels=_format_labels(self.labelnames, labels), value=cumulative
+            )
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+# Every worker process keeps its own numbers
+registry = Registry()
+
+http_request_duration_seconds: Histogram = registry.register(
+    Histogram("http_request_duration_seconds", "Time spent handling HTTP requests.", ("method", "route"))
+)
+http_requests_in_flight: Gauge = registry.register(
+    Gauge("http_requests_in_flight", "HTTP requests currently being handled.", ("method",))
+)
+http_request_errors_total: Counter = registry.register(
+    Counter(
+        "http_request_errors_total",
+        "HTTP requests that ended in a server error or an unhandled exception.",
+        ("method", "route", "status"),
+    )
+)
+db_query_duration_seconds: Histogram = registry.register(
+    Histogram(
+        "db_query_duration_seconds",
+        "Time spent running database statements. Only recorded when query instrumentation is enabled.",
+        ("operation",),
+        buckets=DATABASE_BUCKETS,
+    )
+)
+db_pool_checkouts_total: Counter = registry.register(
+    Counter("db_pool_checkouts_total", "Connections handed out by the database connection pool.")
+)
+db_pool_wait_seconds: Histogram = registry.register(
+    Histogram(
+        "db_pool_wait_seconds",
+        "Time spent waiting for a connection from the database connection pool.",
+        buckets=DATABASE_BUCKETS,
+    )
+)
+db_pool_timeouts_total: Counter = registry.register(
+    Counter("db_pool_timeouts_total", "Requests that gave up waiting for a database connection.")
+)
+
+# The pools we report on. Set up by install_pool_metrics() when an engine is created.
+_engines: dict[str, AsyncEngine] = {}
+
+
+def _pool_stats(get_value: Callable) -> Callable[[], Iterable[tuple[tuple[str, ...], float]]]:
+    def collect():
+        for name, engine in _engines.items():
+            yield (name,), get_value(engine.pool)
+
+    return collect
+
+
+registry.register(
+    CallbackGauge("db_pool_size", "Connections the pool keeps open.", _pool_stats(lambda pool: pool.size()), ("pool",))
+)
+registry.register(
+    CallbackGauge(
+        "db_pool_checked_out",
+        "Connections currently in use.",
+        _pool_stats(lambda pool: pool.checkedout()),
+        ("pool",),
+    )
+)
+registry.register(
+    CallbackGauge(
+        "db_pool_overflow",
+        "Connections opened beyond the pool size. Negative when the pool isn't full yet.",
+        _pool_stats(lambda pool: pool.overflow()),
+        ("pool",),
+    )
+)
+
+
+def _query_stats(get_value: Callable) -> Callable[[], Iterable[tuple[tuple[str, ...], float]]]:
+    def collect():
+        for fingerprint, stats in query_instrumentation.stats.items():
+            yield (fingerprint,), get_value(stats)
+
+    return collect
+
+
+registry.register(
+    CallbackGauge(
+        "db_statement_calls",
+        "Times each statement has run, by statement fingerprint.",
+        _query_stats(lambda stats: stats.calls),
+        ("fingerprint",),
+    )
+)
+registry.register(
+    CallbackGauge(
+        "db_statement_seconds",
+        "Total time spent running each statement, by statement fingerprint.",
+        _query_stats(lambda stats: stats.total_seconds),
+        ("fingerprint",),
+    )
+)
+
+
+def _observe_query(fingerprint: str, statement: str, duration: float, rowcount: int | None) -> None:
+    operation, _, _ = statement.partition(" ")
+    db_query_duration_seconds.observe(duration, operation.upper())
+
+
+query_instrumentation.add_listener(_observe_query)
+
+
+# The caches we report on, by name
+_caches: dict[str, TTLCache | PageCache] = {}
+
+
+def _cache_stats(get_value: Callable) -> Callable[[], Iterable[tuple[tuple[str, ...], float]]]:
+    def collect():
+        for name, cache in _caches.items():
+            value = get_value(cache)
+            # Not every cache can tell, like a cache shared through a server
+            if value is not None:
+                yield (name,), value
+
+    return collect
+
+
+registry.register(
+    CallbackCounter(
+        "cache_hits_total", "Lookups answered by the cache.", _cache_stats(lambda cache: cache.stats.hits), ("cache",)
+    )
+)
+registry.register(
+    CallbackCounter(
+        "cache_misses_total",
+        "Lookups the cache couldn't answer.",
+        _cache_stats(lambda cache: cache.stats.misses),
+        ("cache",),
+    )
+)
+registry.register(
+    CallbackCounter(
+        "cache_evictions_total",
+        "Entries thrown away to make room for new ones.",
+        _cache_stats(lambda cache: cache.stats.evictions),
+        ("cache",),
+    )
+)
+registry.register(
+    CallbackCounter(
+        "cache_expirations_total",
+        "Entries thrown away because they were too old.",
+        _cache_stats(lambda cache: cache.stats.expirations),
+        ("cache",),
+    )
+)
+registry.register(
+    CallbackGauge(
+        "cache_entries",
+        "Entries currently in the cache.",
+        _cache_stats(lambda cache: len(cache) if isinstance(cache, TTLCache) else None),
+        ("cache",),
+    )
+)
+
+
+def register_cache(name: str, cache: TTLCache | PageCache) -> None:
+    _caches[name] = cache
+
+
+register_cache("count", count_cache)
+
+
+def install_pool_metrics(engine: AsyncEngine, name: str = "primary") -> None:
+    _engines[name] = engine
+    event.listen(engine.sync_engine.pool, "checkout", lambda *args: db_pool_checkouts_total.inc())
+
+
+class MetricsMiddleware:
+    """
+    Records how long every request takes, per route.
+
+    This is a plain ASGI middleware rather than a BaseHTTPMiddleware,
+    so it doesn't add another task or copy the response body.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc(method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - started
+            http_requests_in_flight.dec(method)
+            # FastAPI puts the matched route in the scope. Using its path template (like /products/{id})
+            # instead of the actual path keeps the number of different labels small.
+            route = scope.get("route")
+            route_path = route.path if route is not None else "unmatched"
+            http_request_duration_seconds.observe(duration, method, route_path)
+            if status >= 500:
+                http_request_errors_total.inc(method, route_path, str(status))
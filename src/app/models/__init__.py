@@ -1,3 +1,9 @@
-from sqlalchemy import MetaData
+from sqlalchemy import Column, MetaData, Table
 
 metadata = MetaData()
+
+
+def readable_columns(table: Table) -> list[Column]:
+    # Columns marked with info={"internal": True} only exist for the database's own use, like search vectors.
+    # They are left out when we read whole rows.
+    return [column for column in table.c if not column.info.get("internal")]
@@ -0,0 +1,22 @@
+import sqlalchemy as sa
+
+from app.models import metadata
+
+# The responses to requests sent with an Idempotency-Key header, so a retry of the same request gets the same answer
+# instead of creating the same thing twice.
+# https://datatracker.ietf.org/doc/draft-ietf-httpapi-idempotency-key-header/
+idempotency_key_table = sa.Table(
+    "idempotency_key",
+    metadata,
+    # The same key sent to different endpoints means different requests, like "POST /products"
+    sa.Column("scope", sa.String(255), primary_key=True),
+    sa.Column("key", sa.String(255), primary_key=True),
+    # A hash of the request body, to catch a key being re-used for a different request
+    sa.Column("request_hash", sa.String(64), nullable=False),
+    sa.Column("status_code", sa.SmallInteger),
+    sa.Column("response", sa.LargeBinary),
+    # Times are in UTC, the time zone our database runs in
+    sa.Column("created_at", sa.TIMESTAMP, server_default=sa.func.now()),
+    # Old keys are deleted by expires_at, so it gets an index
+    sa.Column("expires_at", sa.TIMESTAMP, nullable=False, index=True),
+)
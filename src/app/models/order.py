@@ -15,7 +15,27 @@ order_table = sa.Table(
     "order",
     metadata,
     sa.Column("id", sa.BigInteger, primary_key=True, autoincrement=True),
-    sa.Column("customer_name", sa.Unicode(255), index=True, nullable=False),
+    sa.Column("customer_name", sa.Unicode(255), nullable=False),
     sa.Column("address", sa.Text(), nullable=False),
     sa.Column("contents", sa.String(1024)),
+    # Times are in UTC, the time zone our database runs in
+    sa.Column("created_at", sa.TIMESTAMP, server_default=sa.func.now()),
+    sa.Column("updated_at", sa.TIMESTAMP, server_default=sa.func.now(), onupdate=sa.func.now()),
+    # A customer's order history, newest first, straight from the index however many orders there are.
+    # It also serves anything the index on customer_name alone used to.
+    sa.Index("ix_order_customer_name_created_at_id", "customer_name", "created_at", "id"),
+)
+
+
+# One row per product in an order. The quantities are taken out of product.stock when the order is placed.
+order_item_table = sa.Table(
+    "order_item",
+    metadata,
+    sa.Column("id", sa.BigInteger, primary_key=True, autoincrement=True),
+    sa.Column("order_id", sa.BigInteger, sa.ForeignKey("order.id", ondelete="CASCADE"), index=True, nullable=False),
+    # Deleting a product keeps the orders it was part of, just without the link back to it
+    sa.Column("product_id", sa.BigInteger, sa.ForeignKey("product.id", ondelete="SET NULL"), index=True),
+    sa.Column("quantity", sa.Integer, sa.CheckConstraint("quantity > 0"), nullable=False),
+    # The price when the order was placed, so later price changes don't rewrite history
+    sa.Column("unit_price", sa.Numeric(12, 2)),
 )
@@ -2,9 +2,17 @@ from decimal import Decimal
 
 import sqlalchemy as sa
 from pydantic import BaseModel, Field, HttpUrl
+from sqlalchemy.dialects.postgresql import TSVECTOR
 
 from app.models import metadata
 
+# The text search configuration decides how words are split up and reduced to their stem ("running" -> "run")
+SEARCH_CONFIG = "english"
+SEARCH_VECTOR_EXPRESSION = (
+    "setweight(to_tsvector('{config}', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('{config}', coalesce(description, '')), 'B')"
+).format(config=SEARCH_CONFIG)
+
 
 class Product(BaseModel):
     id: int
@@ -12,6 +20,7 @@ class Product(BaseModel):
     description: str | None
     image: HttpUrl | None
     price: Decimal | None = Field(max_digits=12, decimal_places=2)
+    # For a product with stock buckets, the stock when it was last split up (see product_stock_bucket_table)
     stock: int = 0
 
 
@@ -24,4 +33,40 @@ product_table = sa.Table(
     sa.Column("image", sa.String(1024)),
     sa.Column("price", sa.Numeric(12, 2), index=True),
     sa.Column("stock", sa.Integer, index=True, nullable=False, server_default="0"),
+    # How many rows of product_stock_bucket the stock is spread over. 0 means it's all in the stock column.
+    sa.Column("stock_buckets", sa.SmallInteger, nullable=False, server_default="0", info={"internal": True}),
+    # Times are in UTC, the time zone our database runs in.
+    # SQLAlchemy sets updated_at on every UPDATE it runs, as the database has no trigger for it.
+    sa.Column("created_at", sa.TIMESTAMP, server_default=sa.func.now()),
+    sa.Column("updated_at", sa.TIMESTAMP, server_default=sa.func.now(), onupdate=sa.func.now()),
+    # The words of the name and description, kept up to date by the database itself.
+    # Words in the name count for more (weight A) than words in the description (weight B).
+    # https://www.postgresql.org/docs/current/textsearch-tables.html
+    sa.Column(
+        "search_vector",
+        TSVECTOR,
+        sa.Computed(SEARCH_VECTOR_EXPRESSION, persisted=True),
+        info={"internal": True},
+    ),
+    sa.Index("ix_product_search_vector", "search_vector", postgresql_using="gin"),
+)
+
+# Lets name prefix filters (lower(name) LIKE 'abc%') use an index, whatever the collation of the database is
+sa.Index(
+    "ix_product_name_prefix",
+    sa.func.lower(product_table.c.name).label("name_lower"),
+    postgresql_ops={"name_lower": "text_pattern_ops"},
+)
+
+
+# For products so popular that every order waiting its turn to update one stock value is too slow, like in a flash sale.
+# Their stock is split into buckets, and each order only has to lock one of them.
+# While a product's stock is in buckets, product.stock keeps the stock it had when it was split up.
+# Nothing else may write it then, or the next split would overwrite that write with the bucket total.
+product_stock_bucket_table = sa.Table(
+    "product_stock_bucket",
+    metadata,
+    sa.Column("product_id", sa.BigInteger, sa.ForeignKey("product.id", ondelete="CASCADE"), primary_key=True),
+    sa.Column("bucket", sa.SmallInteger, primary_key=True),
+    sa.Column("stock", sa.Integer, sa.CheckConstraint("stock >= 0"), nullable=False, server_default="0"),
 )
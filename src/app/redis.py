@@ -0,0 +1,115 @@
+import asyncio
+from typing import Any
+from urllib.parse import unquote, urlsplit
+
+
+class RedisError(Exception):
+    """An error reply sent back by the server, like a wrong command or a failed AUTH."""
+
+
+def encode_command(*args: str | bytes | int | float) -> bytes:
+    # Every command is sent as an array of bulk strings: *<count>, then $<length> and the bytes of each argument
+    # https://redis.io/docs/latest/develop/reference/protocol-spec/#sending-commands-to-a-redis-server
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader) -> Any:
+    line = await reader.readuntil(b"\r\n")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode()
+    if kind == b"-":
+        raise RedisError(payload.decode())
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise RedisError("Unexpected reply from server: {line!r}".format(line=line))
+
+
+class RedisClient:
+    """
+    A tiny client for servers that speak the Redis protocol (Redis, Valkey, KeyDB, ...).
+    We only need a handful of commands, so this saves us from adding another dependency.
+
+    Connections are opened the first time they're needed and reused afterwards.
+    A connection that fails in any way is thrown away instead of being put back.
+    """
+
+    def __init__(self, url: str, max_connections: int = 10, timeout: float = 1.0):
+        # redis://[:password@]host[:port][/database]
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.database = int(parts.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max_connections)
+        self._idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    async def _connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            if self.password is not None:
+                writer.write(encode_command("AUTH", self.password))
+                await read_reply(reader)
+            if self.database:
+                writer.write(encode_command("SELECT", self.database))
+                await read_reply(reader)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _execute(self, *args: str | bytes | int | float) -> Any:
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else await self._connect()
+            reader, writer = connection
+            try:
+                writer.write(encode_command(*args))
+                reply = await read_reply(reader)
+            except RedisError:
+                # The server answered, so the connection is still fine
+                self._idle.append(connection)
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            self._idle.append(connection)
+            return reply
+
+    async def execute(self, *args: str | bytes | int | float) -> Any:
+        return await asyncio.wait_for(self._execute(*args), self.timeout)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.execute("GET", key)
+
+    async def set(self, key: str, value: bytes, ttl: int | None = None) -> None:
+        if ttl is None:
+            await self.execute("SET", key, value)
+        else:
+            await self.execute("SET", key, value, "EX", ttl)
+
+    async def incr(self, key: str) -> int:
+        return await self.execute("INCR", key)
+
+    async def close(self) -> None:
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
@@ -1,23 +1,45 @@
-from fastapi import APIRouter, Depends
+from typing import Any
 
-from app.schemas.order import OrderCreateRequest, OrderDetailResponse, OrderListResponse
+from fastapi import APIRouter, Depends, HTTPException
+
+from app.schemas.order import OrderCreateRequest, OrderDetailResponse, OrderListRequest, OrderListResponse
+from app.services.idempotency import IdempotentRequest, get_idempotent_request
 from app.services.order import OrderService
+from app.settings import Settings
 
 router = APIRouter(tags=["orders"])
 
 
+settings = Settings()
+
+
 @router.get("/")  # GET /orders/
-async def list(order_service: OrderService = Depends(OrderService)) -> OrderListResponse:
-    return await order_service.list()
+async def list(
+    list_query: OrderListRequest = Depends(OrderListRequest),
+    order_service: OrderService = Depends(OrderService.read_only),
+) -> OrderListResponse:
+    return await order_service.list(
+        list_query,
+        requesting_path="{public_base_url}/orders".format(public_base_url=settings.public_base_url),
+    )
 
 
-@router.post("/")  # POST /orders/
+@router.post("/", response_model=OrderDetailResponse)  # POST /orders/
 async def create(
-    new_order_data: OrderCreateRequest, order_service: OrderService = Depends(OrderService)
-) -> OrderDetailResponse:
-    return await order_service.create(new_order_data)
+    new_order_data: OrderCreateRequest,
+    idempotency: IdempotentRequest | None = Depends(get_idempotent_request),
+    order_service: OrderService = Depends(OrderService),
+) -> Any:
+    if idempotency is not None:
+        replayed = await idempotency.replay(new_order_data)
+        if replayed is not None:
+            return replayed
+    return await order_service.create(new_order_data, idempotency=idempotency)
 
 
 @router.get("/{id}")  # GET  /orders/{id}
-async def get_detail(id: int, order_service: OrderService = Depends(OrderService)) -> OrderDetailResponse:
-    return await order_service.get(id)
+async def get_detail(id: int, order_service: OrderService = Depends(OrderService.read_only)) -> OrderDetailResponse:
+    order = await order_service.get(id)
+    if order is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return order
@@ -1,14 +1,31 @@
-from fastapi import APIRouter, Depends
+from typing import Any
 
-from app.schemas.base import BasePaginationRequest
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from app.conditional import is_conditional, not_modified, validator_headers
 from app.schemas.product import (
+    PRODUCT_FIELDS_PATTERN,
+    ProductBulkCreateResponse,
     ProductCreateRequest,
     ProductCreateResponse,
     ProductDetailResponse,
+    ProductImportResponse,
+    ProductInventoryResponse,
+    ProductInventoryUpdateRequest,
+    ProductListRequest,
     ProductListResponse,
+    ProductSearchRequest,
+    ProductSearchResponse,
     ProductUpdateRequest,
+    parse_fields,
 )
+from app.services.idempotency import IdempotentRequest, get_idempotent_request
+from app.services.inventory import InventoryService
 from app.services.product import ProductService
+from app.services.product_export import MEDIA_TYPES, ExportFormat, export_products
+from app.services.product_import import ImportFormat, ProductImportService, log_progress, parse_rows
 from app.settings import Settings
 
 router = APIRouter(tags=["products"])
@@ -17,31 +34,133 @@ router = APIRouter(tags=["products"])
 settings = Settings()
 
 
-@router.post("/", status_code=201)
+def send_model(model: BaseModel, headers: dict[str, str] | None = None) -> Response:
+    # Products read from the database are built without validation (see from_row), so FastAPI mustn't check
+    # them again against response_model either. response_model is then only there for the docs.
+    return Response(content=model.model_dump_json(warnings=False), media_type="application/json", headers=headers)
+
+
+@router.post("/", status_code=201, response_model=ProductCreateResponse)
 async def create_product(
     product: ProductCreateRequest,
+    idempotency: IdempotentRequest | None = Depends(get_idempotent_request),
     product_service: ProductService = Depends(ProductService),
-) -> ProductCreateResponse:
-    return await product_service.create(product)
+) -> Any:
+    if idempotency is not None:
+        replayed = await idempotency.replay(product)
+        if replayed is not None:
+            return replayed
+    return await product_service.create(product, idempotency=idempotency)
 
 
-@router.get("/")
-async def paginate_products(
-    pagination_query: BasePaginationRequest = Depends(BasePaginationRequest),
+# Creates many products in one go, for catalog syncs.
+# Products are checked one by one, and the response says what happened to each of them.
+@router.post("/bulk", status_code=201)
+async def create_products(
+    products: list[dict[str, Any]] = Body(max_length=settings.bulk_create_max_items),
     product_service: ProductService = Depends(ProductService),
-) -> ProductListResponse:
-    return await product_service.paginate(
-        pagination_query,
-        requesting_path="{public_base_url}/products".format(public_base_url=settings.public_base_url),
+) -> ProductBulkCreateResponse:
+    return await product_service.create_many(products)
+
+
+# Loads a whole catalog from a CSV or NDJSON (one JSON object per line) request body.
+# The body is read as it arrives instead of all at once, so files of any size can be sent.
+@router.post(
+    "/import",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "text/csv": {"schema": {"type": "string"}},
+                "application/x-ndjson": {"schema": {"type": "string"}},
+            },
+        }
+    },
+)
+async def import_products(
+    request: Request,
+    # Worked out from the Content-Type header when it isn't given
+    format: ImportFormat | None = None,
+    import_service: ProductImportService = Depends(ProductImportService),
+) -> ProductImportResponse:
+    if format is None:
+        format = ImportFormat.CSV if "csv" in request.headers.get("content-type", "") else ImportFormat.NDJSON
+    return await import_service.import_products(parse_rows(format, request.stream()), on_progress=log_progress)
+
+
+# The page comes back already serialized (and possibly straight from the cache),
+# so we send it as it is and only use response_model for the docs
+@router.get("/", response_model=ProductListResponse)
+async def paginate_products(
+    request: Request,
+    pagination_query: ProductListRequest = Depends(ProductListRequest),
+    product_service: ProductService = Depends(ProductService.read_only),
+) -> Response:
+    requesting_path = "{public_base_url}/products".format(public_base_url=settings.public_base_url)
+    # Only If-None-Match is checked for pages. Removing a product changes a page without making anything newer,
+    # so If-Modified-Since can't tell.
+    if "if-none-match" in request.headers:
+        etag, last_modified = await product_service.get_list_validators(pagination_query, requesting_path)
+        if not_modified(request, etag):
+            return Response(status_code=304, headers=validator_headers(etag, last_modified))
+
+    page = await product_service.paginate_cached(pagination_query, requesting_path)
+    return Response(
+        content=page.content,
+        media_type="application/json",
+        headers=validator_headers(page.etag, page.last_modified),
+    )
+
+
+# Finds products by the words in their name and description, best matches first.
+# Like /export, this has to come before /{id}.
+@router.get("/search", response_model=ProductSearchResponse)
+async def search_products(
+    search_query: ProductSearchRequest = Depends(ProductSearchRequest),
+    product_service: ProductService = Depends(ProductService.read_only),
+) -> Response:
+    results = await product_service.search(
+        search_query,
+        requesting_path="{public_base_url}/products/search".format(public_base_url=settings.public_base_url),
+    )
+    return send_model(results)
+
+
+# Streams the whole catalog for downstream systems, like our search indexer.
+# This has to come before /{id}, or "export" would be taken as an id.
+@router.get("/export", response_class=StreamingResponse)
+async def export_catalog(
+    format: ExportFormat = ExportFormat.NDJSON,
+    # Only export these fields, separated by commas
+    fields: str | None = Query(default=None, pattern=PRODUCT_FIELDS_PATTERN),
+) -> StreamingResponse:
+    return StreamingResponse(
+        export_products(format, parse_fields(fields)),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": 'attachment; filename="products.{format}"'.format(format=format.value)},
     )
 
 
-@router.get("/{id}")
+@router.get("/{id}", response_model=ProductDetailResponse)
 async def get_product_detail(
     id: int,
-    product_service: ProductService = Depends(ProductService),
-) -> ProductDetailResponse:
-    return await product_service.get_detail(id)
+    request: Request,
+    # Only return these fields, separated by commas
+    fields: str | None = Query(default=None, pattern=PRODUCT_FIELDS_PATTERN),
+    product_service: ProductService = Depends(ProductService.read_only),
+) -> Response:
+    selected_fields = parse_fields(fields)
+    # When the client already has a version of the product, we only look up which version is current
+    if is_conditional(request):
+        validators = await product_service.get_validators(id, selected_fields)
+        if validators is not None and not_modified(request, *validators):
+            return Response(status_code=304, headers=validator_headers(*validators))
+
+    versioned = await product_service.get_versioned(id, selected_fields)
+    if versioned is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    # The slim model of ?fields= is sent the same way, as it wouldn't match response_model anyway
+    return send_model(versioned.product, validator_headers(versioned.etag, versioned.last_modified))
 
 
 @router.patch("/{id}")
@@ -59,3 +178,22 @@ async def delete_product(
     product_service: ProductService = Depends(ProductService),
 ):
     await product_service.delete(id)
+
+
+# The stock of a product, counted across its buckets when it has been split up
+@router.get("/{id}/inventory")
+async def get_inventory(
+    id: int,
+    inventory_service: InventoryService = Depends(InventoryService.read_only),
+) -> ProductInventoryResponse:
+    return await inventory_service.get(id)
+
+
+# Splits the stock of a product that's about to get very busy (a flash sale) into buckets, or puts it back together
+@router.put("/{id}/inventory")
+async def update_inventory(
+    id: int,
+    inventory: ProductInventoryUpdateRequest,
+    inventory_service: InventoryService = Depends(InventoryService),
+) -> ProductInventoryResponse:
+    return await inventory_service.update(id, inventory)
@@ -1,12 +1,43 @@
+import base64
+import binascii
+import json
+from enum import StrEnum
+from typing import Any, Mapping, TypeVar
+
 from fastapi import Query
 from pydantic import BaseModel
 
+from app.counting import CountStrategy
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+
+def from_row(model: type[ModelT], record: Mapping[str, Any]) -> ModelT:
+    """
+    Builds a response model from a row of our own database without validating it.
+    The row already has the right types, as everything in it was validated on its way in.
+    Only use it for rows, never for anything a client sent. Serialize the result with warnings=False,
+    as the image stays the plain string it is in the database instead of becoming an HttpUrl.
+    """
+    return model.model_construct(**{name: record[name] for name in model.model_fields})
+
 
 class BaseListResponse(BaseModel):
     results: list
     page: int
     size: int
-    count: int
+    # None when the client asked us not to count
+    count: int | None
+    # True when the count is the planner's estimate or a cached value, rather than a fresh count(*)
+    count_estimated: bool = False
+    # Links to the neighbouring pages. These are None when there is no such page.
+    next: str | None = None
+    previous: str | None = None
+
+
+class SortOrder(StrEnum):
+    ASC = "asc"
+    DESC = "desc"
 
 
 class BasePaginationRequest(BaseModel):
@@ -14,3 +45,33 @@ class BasePaginationRequest(BaseModel):
     page: int = Query(ge=0, default=0)
     # Let's not allow more than 200 results per page
     size: int = Query(ge=1, le=200, default=20)
+    # Opaque token taken from the next/previous links of a previous response.
+    # When given, the page is found by seeking past the cursor instead of using OFFSET.
+    cursor: str | None = Query(default=None)
+    # Counting every matching row can cost more than fetching the page, so clients can choose how it's done
+    count: CountStrategy = Query(default=CountStrategy.EXACT)
+
+
+class PageCursor(BaseModel):
+    # The sort key values (ending with the id) of the row the page starts after
+    values: list[Any]
+    # True when the cursor points to the page before the row instead of after it
+    backwards: bool = False
+
+    def encode(self) -> str:
+        payload = json.dumps(
+            {"v": self.values, "b": self.backwards},
+            separators=(",", ":"),
+            default=str,
+        )
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+    @classmethod
+    def decode(cls, token: str) -> "PageCursor":
+        # The padding is stripped when encoding to keep the token URL friendly
+        padded = token + "=" * (-len(token) % 4)
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            return cls(values=payload["v"], backwards=payload["b"])
+        except (binascii.Error, ValueError, KeyError, TypeError) as error:
+            raise ValueError("Invalid pagination cursor") from error
@@ -1,27 +1,55 @@
-from pydantic import BaseModel
+from datetime import datetime
+from decimal import Decimal
 
-from app.schemas.base import BaseListResponse
+from fastapi import Query
+from pydantic import BaseModel, Field
+
+from app.schemas.base import BaseListResponse, BasePaginationRequest
+
+# Every item is one more row to lock while the order is placed, so orders can't grow without limit
+MAX_ORDER_ITEMS = 100
+
+
+class OrderItemRequest(BaseModel):
+    product_id: int
+    quantity: int = Field(gt=0, le=10000)
+
+
+class OrderItemResponse(BaseModel):
+    product_id: int | None
+    quantity: int
+    unit_price: Decimal | None
 
 
 class OrderListItem(BaseModel):
     id: int
     customer_name: str
     address: str
-    contents: str
+    contents: str | None
+    created_at: datetime | None = None
 
 
 class OrderListResponse(BaseListResponse):
     results: list[OrderListItem]
 
 
+class OrderListRequest(BasePaginationRequest):
+    # Only the orders of this customer, newest first
+    customer_name: str | None = Query(default=None, min_length=1, max_length=255)
+
+
 class OrderDetailResponse(BaseModel):
     id: int
     customer_name: str
     address: str
-    contents: str
+    contents: str | None
+    created_at: datetime | None = None
+    items: list[OrderItemResponse] = []
 
 
 class OrderCreateRequest(BaseModel):
     customer_name: str
     address: str
-    contents: str
+    # Free text, such as delivery notes. The products go in items.
+    contents: str | None = None
+    items: list[OrderItemRequest] = Field(default=[], max_length=MAX_ORDER_ITEMS)
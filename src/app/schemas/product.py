@@ -1,9 +1,48 @@
 from decimal import Decimal
+from enum import StrEnum
+from functools import lru_cache
+from typing import Any
 
-from pydantic import BaseModel, Field, HttpUrl
+from fastapi import Query
+from pydantic import BaseModel, Field, HttpUrl, create_model, field_serializer
 
+from app.counting import CountStrategy
 from app.models.product import Product
-from app.schemas.base import BaseListResponse
+from app.schemas.base import BaseListResponse, BasePaginationRequest, SortOrder
+
+# The fields clients can pick from with ?fields=, like ?fields=name,price,image
+PRODUCT_FIELDS = tuple(Product.model_fields)
+PRODUCT_FIELDS_PATTERN = "^({names})(,({names}))*$".format(names="|".join(PRODUCT_FIELDS))
+
+
+def parse_fields(fields: str | None) -> tuple[str, ...] | None:
+    """
+    Turns ?fields=price,name into the fields to return, in their usual order. None means all of them.
+    The id is always included, as it identifies the product.
+    """
+    if fields is None:
+        return None
+    wanted = set(fields.split(",")) | {"id"}
+    return tuple(name for name in PRODUCT_FIELDS if name in wanted)
+
+
+# There are only so many combinations of fields, so each slim model is only built once
+@lru_cache(maxsize=128)
+def get_partial_product_model(fields: tuple[str, ...]) -> type[BaseModel]:
+    # A model with just the requested fields of Product, with the same types and checks
+    return create_model(
+        "Product_" + "_".join(fields),
+        **{name: (Product.model_fields[name].annotation, Product.model_fields[name]) for name in fields},
+    )
+
+
+@lru_cache(maxsize=128)
+def get_partial_list_model(fields: tuple[str, ...]) -> type[BaseListResponse]:
+    return create_model(
+        "ProductListResponse_" + "_".join(fields),
+        __base__=BaseListResponse,
+        results=(list[get_partial_product_model(fields)], ...),
+    )
 
 
 class ProductCreateRequest(BaseModel):
@@ -13,11 +52,31 @@ class ProductCreateRequest(BaseModel):
     price: Decimal = Field(max_digits=12, decimal_places=2)
     stock: int | None = 0
 
+    # The database driver only accepts plain strings for the image column
+    @field_serializer("image")
+    def serialize_image(self, image: HttpUrl | None) -> str | None:
+        return str(image) if image is not None else None
+
 
 class ProductCreateResponse(Product):
     pass
 
 
+class ProductBulkCreateResult(BaseModel):
+    # The position of the product in the request
+    index: int
+    created: bool
+    product: ProductCreateResponse | None = None
+    # Why the product couldn't be created, in the same format as FastAPI's validation errors
+    errors: list[dict[str, Any]] | None = None
+
+
+class ProductBulkCreateResponse(BaseModel):
+    created: int
+    failed: int
+    results: list[ProductBulkCreateResult]
+
+
 class ProductListResponseItem(Product):
     pass
 
@@ -26,13 +85,96 @@ class ProductListResponse(BaseListResponse):
     results: list[ProductListResponseItem]
 
 
+# Only columns with an index can be sorted on, so every sort stays cheap
+class ProductSortField(StrEnum):
+    ID = "id"
+    PRICE = "price"
+    STOCK = "stock"
+    NAME = "name"
+
+
+class ProductListRequest(BasePaginationRequest):
+    min_price: Decimal | None = Query(default=None, ge=0)
+    max_price: Decimal | None = Query(default=None, ge=0)
+    # Leave out products that are sold out
+    in_stock: bool = Query(default=False)
+    # Products whose name starts with this, ignoring case
+    name_prefix: str | None = Query(default=None, min_length=1, max_length=255)
+    sort: ProductSortField = Query(default=ProductSortField.ID)
+    order: SortOrder = Query(default=SortOrder.ASC)
+    # Only return these fields, separated by commas. Leaving out the description makes pages a lot smaller.
+    fields: str | None = Query(default=None, pattern=PRODUCT_FIELDS_PATTERN)
+
+
 class ProductDetailResponse(Product):
     pass
 
 
+class ProductSearchRequest(BasePaginationRequest):
+    # The words to look for. The last one also matches the start of longer words, so results show up while typing.
+    q: str = Query(min_length=1, max_length=200)
+    # A common word matches a large part of the catalog, and counting all of those costs far more than
+    # finding the best few. So searches use the planner's estimate unless the client asks for an exact count.
+    count: CountStrategy = Query(default=CountStrategy.ESTIMATED)
+
+
+class ProductSearchResponseItem(Product):
+    # How well the product matches the search, higher is better
+    rank: float
+
+
+class ProductSearchResponse(BaseListResponse):
+    results: list[ProductSearchResponseItem]
+
+
 class ProductUpdateRequest(ProductCreateRequest):
     name: str | None = None
     description: str | None = None
     image: HttpUrl | None = None
     price: Decimal | None = Field(default=None, max_digits=12, decimal_places=2)
     stock: int | None = None
+
+
+class ProductImportRow(ProductCreateRequest):
+    # Rows with an id replace the existing product with that id, the others are created
+    id: int | None = None
+
+
+class ProductImportError(BaseModel):
+    # 1 is the first product in the file, not counting a CSV header
+    row: int
+    errors: list[dict[str, Any]]
+
+
+class ProductImportResponse(BaseModel):
+    received: int
+    inserted: int
+    updated: int
+    # Rows with an id that didn't match any product
+    unmatched: int
+    # Rows for products with their stock split into buckets, which were left as they were.
+    # Change those with PUT /products/{id}/inventory and PATCH /products/{id}.
+    bucketed: int
+    # Rows whose id came up more than once in the file. None of them were imported.
+    duplicated: int
+    failed: int
+    # Only the first few failed rows are reported, so a bad file can't make the response huge
+    errors: list[ProductImportError]
+    errors_truncated: bool
+
+
+# Orders lock one bucket each, so more buckets means more orders for the product can go through at the same time
+MAX_STOCK_BUCKETS = 64
+
+
+class ProductInventoryUpdateRequest(BaseModel):
+    # How many buckets to split the stock into. 0 keeps it all in the product row, which is the default.
+    buckets: int = Field(ge=0, le=MAX_STOCK_BUCKETS)
+    # The new stock. Leave it out to keep the stock the product has.
+    stock: int | None = Field(default=None, ge=0)
+
+
+class ProductInventoryResponse(BaseModel):
+    product_id: int
+    buckets: int
+    stock: int
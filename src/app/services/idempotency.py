@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+import logging
+from datetime import timedelta
+
+from fastapi import Depends, Header, HTTPException, Request, Response
+from pydantic import BaseModel
+
+from app.database import connection_provider
+from app.database.idempotency import IdempotencyRepository, SqlAlchemyIdempotencyRepository
+from app.database.repository_factory import get_idempotency_repository
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+# Sent on responses that were stored from an earlier request with the same key
+REPLAYED_HEADER = "Idempotent-Replayed"
+# How many expired keys are deleted in one go
+PURGE_BATCH_SIZE = 1000
+
+
+def hash_request(payload: BaseModel) -> str:
+    # The parsed body rather than the raw one, so the same request with different whitespace still matches
+    return hashlib.blake2b(payload.model_dump_json().encode(), digest_size=32).hexdigest()
+
+
+class IdempotentRequest:
+    """
+    A create request sent with an Idempotency-Key header, which makes retrying it safe:
+    a retry with the same key gets the first response back instead of creating anything again.
+    Call replay() before doing anything. It waits for a request with the same key that's still running.
+    When it returns a response, send that back instead.
+    Otherwise, call save() with the response before committing, so the response is only kept if the change is.
+    """
+
+    def __init__(self, repository: IdempotencyRepository, scope: str, key: str):
+        self.repository = repository
+        self.scope = scope
+        self.key = key
+
+    async def replay(self, payload: BaseModel) -> Response | None:
+        request_hash = hash_request(payload)
+        found = await self.repository.claim(
+            self.scope, self.key, request_hash, ttl=timedelta(seconds=settings.idempotency_key_ttl_seconds)
+        )
+        if found is None:
+            return None
+        if found["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="This Idempotency-Key was already used for a different request")
+        if found["status_code"] is None:
+            # Only possible if the first request committed without saving its response
+            raise HTTPException(status_code=409, detail="The request with this Idempotency-Key didn't finish")
+        return Response(
+            content=found["response"],
+            status_code=found["status_code"],
+            media_type="application/json",
+            headers={REPLAYED_HEADER: "true"},
+        )
+
+    async def save(self, status_code: int, response: BaseModel) -> None:
+        await self.repository.save(self.scope, self.key, status_code, response.model_dump_json().encode())
+
+
+def get_idempotent_request(
+    request: Request,
+    idempotency_key: str | None = Header(default=None, min_length=1, max_length=255),
+    repository: IdempotencyRepository = Depends(get_idempotency_repository),
+) -> IdempotentRequest | None:
+    # Only requests with the header are idempotent. Everything else works like it always has.
+    if idempotency_key is None:
+        return None
+    scope = "{method} {path}".format(method=request.method, path=request.scope["route"].path)
+    return IdempotentRequest(repository=repository, scope=scope, key=idempotency_key)
+
+
+async def purge_expired_keys(interval_seconds: float) -> None:
+    # Runs for as long as the application does, see the lifespan in main.py
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            async with connection_provider.get_engine().connect() as connection:
+                repository = SqlAlchemyIdempotencyRepository(db=connection)
+                while await repository.delete_expired(limit=PURGE_BATCH_SIZE) == PURGE_BATCH_SIZE:
+                    pass
+        except Exception:
+            # Expired keys are taken over when they're sent again anyway, so this can wait until next time
+            logger.exception("Couldn't delete expired idempotency keys")
@@ -0,0 +1,34 @@
+from fastapi import Depends, HTTPException
+
+from app.database.inventory import InventoryRepository
+from app.database.repository_factory import get_inventory_read_repository, get_inventory_repository
+from app.models.product import product_table
+from app.schemas.product import ProductInventoryResponse, ProductInventoryUpdateRequest
+from app.services.product import product_cache, product_list_cache
+
+
+class InventoryService:
+    def __init__(self, repository: InventoryRepository = Depends(get_inventory_repository)):
+        self.repository = repository
+
+    @classmethod
+    def read_only(cls, repository: InventoryRepository = Depends(get_inventory_read_repository)) -> "InventoryService":
+        return cls(repository=repository)
+
+    async def get(self, product_id: int) -> ProductInventoryResponse:
+        found = await self.repository.get_stock(product_id)
+        if found is None:
+            raise HTTPException(status_code=404, detail="Product not found")
+        buckets, stock = found
+        return ProductInventoryResponse(product_id=product_id, buckets=buckets, stock=stock)
+
+    async def update(self, product_id: int, inventory: ProductInventoryUpdateRequest) -> ProductInventoryResponse:
+        found = await self.repository.set_buckets(product_id, buckets=inventory.buckets, stock=inventory.stock)
+        if found is None:
+            raise HTTPException(status_code=404, detail="Product not found")
+        await self.repository.commit()
+        buckets, stock = found
+        # The stock moved, and so did updated_at
+        product_cache.delete(product_id)
+        await product_list_cache.invalidate(product_table.name)
+        return ProductInventoryResponse(product_id=product_id, buckets=buckets, stock=stock)
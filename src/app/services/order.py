@@ -1,33 +1,151 @@
-from fastapi import Depends
-from sqlalchemy import literal_column
-from sqlalchemy.ext.asyncio.engine import AsyncConnection
+from collections import Counter
 
-from app.database.connection_provider import database_connection
-from app.models.order import order_table
-from app.schemas.order import OrderCreateRequest, OrderDetailResponse, OrderListResponse
+from fastapi import Depends, HTTPException
+from sqlalchemy import select
+
+from app.database import Repository, get_table_statements
+from app.database.inventory import InventoryRepository
+from app.database.repository_factory import (
+    get_inventory_repository,
+    get_order_item_read_repository,
+    get_order_item_repository,
+    get_order_read_repository,
+    get_order_repository,
+)
+from app.models.order import order_item_table, order_table
+from app.models.product import product_table
+from app.schemas.order import (
+    MAX_ORDER_ITEMS,
+    OrderCreateRequest,
+    OrderDetailResponse,
+    OrderItemResponse,
+    OrderListItem,
+    OrderListRequest,
+    OrderListResponse,
+)
+from app.services.idempotency import IdempotentRequest
+from app.services.pagination import fetch_page
+from app.services.product import product_cache, product_list_cache
+
+ORDER_SELECT = get_table_statements(order_table).select
+ORDER_ID_SELECT = select(order_table.c.id)
+ITEM_SELECT = select(order_item_table.c.product_id, order_item_table.c.quantity, order_item_table.c.unit_price)
 
 
 class OrderService:
-    def __init__(self, db: AsyncConnection = Depends(database_connection)):
-        # It's not exactly a Connection, but this will help our auto-complete
-        self.db = db
-
-    async def create(self, order: OrderCreateRequest) -> OrderDetailResponse:
-        # Use the table object to help identify the columns to be inserted
-        # Dump our model to a dictionary for SQLAlchemy to map the attributes to columns
-        # Then return all columns
-        insert_statement = order_table.insert().values(order.model_dump()).returning(literal_column("*"))
-        # Run the insert. Don't forget to await!
-        result_records = await self.db.execute(insert_statement)
-        # mappings() to map the results back to a dictionary
-        # first() because we want the first (only) result
-        result = result_records.mappings().first()
+    def __init__(
+        self,
+        repository: Repository = Depends(get_order_repository),
+        item_repository: Repository = Depends(get_order_item_repository),
+        inventory_repository: InventoryRepository | None = Depends(get_inventory_repository),
+    ):
+        self.repository = repository
+        self.item_repository = item_repository
+        self.inventory_repository = inventory_repository
+
+    @classmethod
+    def read_only(
+        cls,
+        repository: Repository = Depends(get_order_read_repository),
+        item_repository: Repository = Depends(get_order_item_read_repository),
+    ) -> "OrderService":
+        return cls(repository=repository, item_repository=item_repository, inventory_repository=None)
+
+    async def create(
+        self, order: OrderCreateRequest, idempotency: IdempotentRequest | None = None
+    ) -> OrderDetailResponse:
+        # The same product twice in one order is one reservation of the total quantity
+        quantities: Counter[int] = Counter()
+        for item in order.items:
+            quantities[item.product_id] += item.quantity
+
+        # Reserving stock locks the product rows until we commit, and other orders for the same products wait.
+        # So the order row goes in first, and the locks are only held for the reservation and the items.
+        result = await self.repository.insert(order.model_dump(exclude={"items"}))
+        prices = await self.inventory_repository.reserve(dict(quantities))
+        if len(prices) < len(quantities):
+            # Either every item is reserved or none of them are
+            await self.repository.rollback()
+            raise HTTPException(
+                status_code=409,
+                detail={
+                    "message": "Some products don't exist or don't have enough stock",
+                    "product_ids": sorted(set(quantities) - set(prices)),
+                },
+            )
+        items = await self.item_repository.insert_many(
+            [
+                {
+                    "order_id": result["id"],
+                    "product_id": product_id,
+                    "quantity": quantity,
+                    "unit_price": prices[product_id],
+                }
+                for product_id, quantity in quantities.items()
+            ]
+        )
         # ** unpacks the dictionary items to key-value parameters
-        response = OrderDetailResponse(**result)
+        response = OrderDetailResponse(**result, items=[OrderItemResponse(**item) for item in items])
+        if idempotency is not None:
+            # In the same transaction as the order, so retries find either both or neither
+            await idempotency.save(200, response)
+        await self.repository.commit()
+
+        if quantities:
+            # The stock of these products changed, so cached copies of them are out of date
+            for product_id in quantities:
+                product_cache.delete(product_id)
+            await product_list_cache.invalidate(product_table.name)
+
         return response
 
-    async def list() -> OrderListResponse:
-        raise NotImplementedError()
+    async def list(self, list_query: OrderListRequest, requesting_path: str) -> OrderListResponse:
+        filters = []
+        if list_query.customer_name is not None:
+            # A customer's history, newest first. The (customer_name, created_at, id) index has the orders
+            # in exactly this order, so a page is a short walk through the index wherever it starts.
+            filters.append(order_table.c.customer_name == list_query.customer_name)
+            keys = [order_table.c.created_at, order_table.c.id]
+        else:
+            # Ids only go up, so newest first is the primary key backwards
+            keys = [order_table.c.id]
+
+        page = await fetch_page(
+            repository=self.repository,
+            select_statement=ORDER_SELECT,
+            filters=filters,
+            keys=keys,
+            list_query=list_query,
+            requesting_path=requesting_path,
+            descending=True,
+            link_params={"customer_name": list_query.customer_name},
+        )
+
+        count = await self.repository.get_count(
+            select_statement=ORDER_ID_SELECT,
+            filters=filters,
+            strategy=list_query.count,
+        )
+
+        return OrderListResponse(
+            results=[OrderListItem(**record) for record in page.records],
+            page=list_query.page,
+            size=list_query.size,
+            count=count.value,
+            count_estimated=count.estimated,
+            next=page.next,
+            previous=page.previous,
+        )
 
-    async def get(id: int) -> OrderDetailResponse:
-        raise NotImplementedError()
+    async def get(self, id: int) -> OrderDetailResponse | None:
+        result = await self.repository.get_one(id)
+        if result is None:
+            return result
+        items = await self.item_repository.paginate(
+            select_statement=ITEM_SELECT,
+            filters=[order_item_table.c.order_id == id],
+            ordering=[order_item_table.c.id.asc()],
+            offset=0,
+            size=MAX_ORDER_ITEMS,
+        )
+        return OrderDetailResponse(**result, items=[OrderItemResponse(**item) for item in items])
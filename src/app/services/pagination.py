@@ -0,0 +1,116 @@
+from typing import Any, NamedTuple, Sequence
+from urllib.parse import urlencode
+
+from fastapi import HTTPException
+from sqlalchemy import ColumnElement, RowMapping, Select
+
+from app.database import Repository, coerce_key_value
+from app.schemas.base import BasePaginationRequest, PageCursor
+
+
+class Page(NamedTuple):
+    records: Sequence[RowMapping]
+    next: str | None
+    previous: str | None
+
+
+def build_link(requesting_path: str, params: dict[str, Any]) -> str:
+    # Leave out parameters that weren't given so the links stay short
+    query = urlencode({key: value for key, value in params.items() if value is not None})
+    return "{path}?{query}".format(path=requesting_path, query=query)
+
+
+def get_cursor(record: RowMapping, keys: list[ColumnElement[Any]], backwards: bool = False) -> str:
+    return PageCursor(values=[record[key.name] for key in keys], backwards=backwards).encode()
+
+
+async def fetch_page(
+    repository: Repository,
+    select_statement: Select,
+    filters: list[ColumnElement[bool]],
+    keys: list[ColumnElement[Any]],
+    list_query: BasePaginationRequest,
+    requesting_path: str,
+    descending: bool = False,
+    link_params: dict[str, Any] | None = None,
+) -> Page:
+    """
+    Fetches one page of records ordered by the given keys, along with the links to the neighbouring pages.
+    The last key must be unique (usually the id) so the ordering is deterministic.
+
+    Old clients that ask for a page number get OFFSET/LIMIT pagination.
+    Everyone else gets keyset pagination, where the next/previous links carry an opaque cursor.
+    """
+    size = list_query.size
+    # The links keep everything about the request the same, except where the page starts
+    link_params = {**(link_params or {}), "size": size, "count": list_query.count}
+
+    # We always fetch one extra row so we know whether there is another page after this one
+    if list_query.cursor is None and list_query.page > 0:
+        ordering = [key.desc() if descending else key.asc() for key in keys]
+        records = await repository.paginate(
+            select_statement=select_statement,
+            filters=filters,
+            ordering=ordering,
+            offset=list_query.page * size,
+            size=size + 1,
+        )
+        has_more = len(records) > size
+        return Page(
+            records=records[:size],
+            next=build_link(requesting_path, {**link_params, "page": list_query.page + 1}) if has_more else None,
+            previous=build_link(requesting_path, {**link_params, "page": list_query.page - 1}),
+        )
+
+    cursor: PageCursor | None = None
+    if list_query.cursor is not None:
+        try:
+            cursor = PageCursor.decode(list_query.cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+        if len(cursor.values) != len(keys):
+            raise HTTPException(status_code=400, detail="Pagination cursor doesn't match the sort order")
+        # A cursor from a different sort order can have the right length but the wrong types
+        try:
+            for key, value in zip(keys, cursor.values):
+                coerce_key_value(key, value)
+        except (ValueError, TypeError, ArithmeticError):
+            raise HTTPException(status_code=400, detail="Pagination cursor doesn't match the sort order")
+
+    backwards = cursor is not None and cursor.backwards
+    # Going backwards means seeking in the opposite direction, then flipping the rows back around
+    records = await repository.paginate_keyset(
+        select_statement=select_statement,
+        filters=filters,
+        keys=keys,
+        after=cursor.values if cursor is not None else None,
+        size=size + 1,
+        descending=descending != backwards,
+    )
+    has_more = len(records) > size
+    records = records[:size]
+    if backwards:
+        records = list(reversed(records))
+
+    if not records:
+        # Nothing past the cursor, but we can still point back to where the client came from
+        previous = None
+        if cursor is not None and not backwards:
+            previous = PageCursor(values=cursor.values, backwards=True).encode()
+        return Page(
+            records=records,
+            next=None,
+            previous=build_link(requesting_path, {**link_params, "cursor": previous}) if previous else None,
+        )
+
+    has_next = has_more if not backwards else True
+    has_previous = has_more if backwards else cursor is not None
+    return Page(
+        records=records,
+        next=build_link(requesting_path, {**link_params, "cursor": get_cursor(records[-1], keys)})
+        if has_next
+        else None,
+        previous=build_link(requesting_path, {**link_params, "cursor": get_cursor(records[0], keys, backwards=True)})
+        if has_previous
+        else None,
+    )
@@ -0,0 +1,70 @@
+import csv
+import io
+import json
+from enum import StrEnum
+from typing import AsyncIterator, Sequence
+
+from sqlalchemy import RowMapping, select
+
+from app.database import SqlAlchemyRepository
+from app.database.connection_provider import read_only_connection
+from app.models.product import Product, product_table
+from app.settings import Settings
+
+settings = Settings()
+
+# Only the columns that are part of the API, in the same order as the API
+EXPORT_COLUMNS = list(Product.model_fields)
+
+
+class ExportFormat(StrEnum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+
+MEDIA_TYPES = {
+    ExportFormat.CSV: "text/csv",
+    ExportFormat.NDJSON: "application/x-ndjson",
+}
+
+
+def format_csv_header(columns: Sequence[str] = EXPORT_COLUMNS) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(columns)
+    return buffer.getvalue()
+
+
+def format_ndjson(records: Sequence[RowMapping]) -> str:
+    # Decimals become strings, like they do in the rest of the API
+    return "".join(json.dumps(dict(record), default=str) + "\n" for record in records)
+
+
+def format_csv(records: Sequence[RowMapping], columns: Sequence[str] = EXPORT_COLUMNS) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([record[name] for name in columns] for record in records)
+    return buffer.getvalue()
+
+
+async def export_products(format: ExportFormat, fields: Sequence[str] | None = None) -> AsyncIterator[str]:
+    """
+    Produces the whole catalog, ordered by id, one batch of rows at a time.
+    Only the given fields are read and written, or all of them when there are none.
+
+    This opens its own connection instead of depending on one, because FastAPI closes dependencies
+    before a StreamingResponse starts sending. The connection stays checked out until the export is done.
+    """
+    columns = list(fields) if fields is not None else EXPORT_COLUMNS
+    if format == ExportFormat.CSV:
+        yield format_csv_header(columns)
+
+    # A single query already sees one consistent version of the table, but a snapshot makes that explicit
+    async with read_only_connection(snapshot=True) as connection:
+        repository = SqlAlchemyRepository(db=connection, table=product_table)
+        batches = repository.stream(
+            select_statement=select(*[product_table.c[name] for name in columns]),
+            filters=[],
+            ordering=[product_table.c.id.asc()],
+            batch_size=settings.export_batch_size,
+        )
+        async for batch in batches:
+            yield format_csv(batch, columns) if format == ExportFormat.CSV else format_ndjson(batch)
@@ -0,0 +1,211 @@
+import codecs
+import csv
+import json
+import logging
+from enum import StrEnum
+from typing import Any, AsyncIterable, AsyncIterator, Callable
+
+from fastapi import Depends
+from pydantic import ValidationError
+
+from app.database import Repository
+from app.database.repository_factory import get_product_repository
+from app.models.product import product_table
+from app.schemas.product import ProductImportError, ProductImportResponse, ProductImportRow
+from app.services.product import product_cache, product_list_cache
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+settings = Settings()
+
+# The order of the values in each COPY record
+IMPORT_COLUMNS = ["id", "name", "description", "image", "price", "stock"]
+
+
+class ImportFormat(StrEnum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+
+async def iter_lines(chunks: AsyncIterable[bytes], max_length: int) -> AsyncIterator[str | None]:
+    # Splits a stream of bytes into lines without reading the whole stream first.
+    # The incremental decoder copes with characters that are split between two chunks.
+    # A line longer than max_length comes out as None, and the rest of it is thrown away as it arrives.
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    skipping = False
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            if skipping:
+                # The end of the line that was too long
+                skipping = False
+                continue
+            yield line.rstrip("\r") if len(line) <= max_length else None
+        if len(buffer) > max_length:
+            if not skipping:
+                yield None
+            skipping = True
+            buffer = ""
+    buffer += decoder.decode(b"", final=True)
+    if buffer.strip() and not skipping:
+        yield buffer.rstrip("\r") if len(buffer) <= max_length else None
+
+
+async def iter_ndjson_rows(
+    chunks: AsyncIterable[bytes], max_length: int = settings.import_max_row_length
+) -> AsyncIterator[dict[str, Any] | None]:
+    # One JSON object per line. Lines that aren't an object come out as None, so they can be reported.
+    async for line in iter_lines(chunks, max_length):
+        if line is None:
+            yield None
+            continue
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield row if isinstance(row, dict) else None
+
+
+async def iter_csv_rows(
+    chunks: AsyncIterable[bytes], max_length: int = settings.import_max_row_length
+) -> AsyncIterator[dict[str, Any] | None]:
+    # The first line names the columns. Empty cells count as missing, so the defaults apply.
+    header: list[str] | None = None
+    # The lines of the record so far, with their length and number of quotes, which are kept count of as
+    # lines come in, so nothing has to go over the whole record again for each one
+    lines: list[str] = []
+    length = 0
+    quotes = 0
+    async for line in iter_lines(chunks, max_length):
+        if line is None:
+            # Too long on its own, so the record it's part of fails too
+            lines, length, quotes = [], 0, 0
+            yield None
+            continue
+        lines.append(line)
+        length += len(line) + 1
+        quotes += line.count('"')
+        # A quoted value can contain line breaks. Quotes inside values are doubled,
+        # so an odd number of quotes means the record continues on the next line.
+        if quotes % 2:
+            if length > max_length:
+                # Most likely a closing quote that never comes. Start again from the next line.
+                lines, length, quotes = [], 0, 0
+                yield None
+            continue
+        values = next(csv.reader(["\n".join(lines)]), [])
+        lines, length, quotes = [], 0, 0
+        if not values:
+            continue
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        if len(values) != len(header):
+            yield None
+            continue
+        yield {name: value for name, value in zip(header, values) if value != ""}
+    if lines:
+        # The file ended in the middle of a quoted value
+        yield None
+
+
+def parse_rows(format: ImportFormat, chunks: AsyncIterable[bytes]) -> AsyncIterator[dict[str, Any] | None]:
+    if format == ImportFormat.CSV:
+        return iter_csv_rows(chunks)
+    return iter_ndjson_rows(chunks)
+
+
+class ProductImportService:
+    """
+    Loads a whole catalog from a stream of rows.
+
+    Valid rows are sent to a temporary staging table with COPY, a batch at a time, so memory use stays the same
+    whatever the size of the file. Once every row is in, they are merged into the product table in one go.
+    Rows that don't pass the same checks as POST /products, or are longer than IMPORT_MAX_ROW_LENGTH,
+    are skipped and reported. Rows sharing an id are all skipped, as there'd be no telling which one is meant.
+    """
+
+    def __init__(self, repository: Repository = Depends(get_product_repository)):
+        self.repository = repository
+
+    async def import_products(
+        self,
+        rows: AsyncIterable[dict[str, Any] | None],
+        on_progress: Callable[[int, int], None] | None = None,
+    ) -> ProductImportResponse:
+        staging_table = await self.repository.create_staging_table(IMPORT_COLUMNS)
+
+        received = 0
+        loaded = 0
+        loaded_with_id = 0
+        failed = 0
+        errors: list[ProductImportError] = []
+        batch: list[tuple] = []
+
+        async for row in rows:
+            received += 1
+            row_errors: list[dict[str, Any]] | None = None
+            if row is None:
+                row_errors = [{"type": "parsing", "msg": "Row couldn't be read"}]
+            else:
+                try:
+                    product = ProductImportRow.model_validate(row)
+                except ValidationError as error:
+                    row_errors = error.errors(include_url=False, include_context=False, include_input=False)
+            if row_errors is not None:
+                failed += 1
+                if len(errors) < settings.import_max_reported_errors:
+                    errors.append(ProductImportError(row=received, errors=row_errors))
+                continue
+
+            data = product.model_dump()
+            # The stock column can't be empty
+            data["stock"] = data["stock"] or 0
+            batch.append(tuple(data[name] for name in IMPORT_COLUMNS))
+            if product.id is not None:
+                loaded_with_id += 1
+
+            if len(batch) >= settings.import_batch_size:
+                await self.repository.copy_records(staging_table, IMPORT_COLUMNS, batch)
+                loaded += len(batch)
+                batch = []
+                if on_progress is not None:
+                    on_progress(received, failed)
+
+        if batch:
+            await self.repository.copy_records(staging_table, IMPORT_COLUMNS, batch)
+            loaded += len(batch)
+        if on_progress is not None:
+            on_progress(received, failed)
+
+        duplicated = await self.repository.delete_duplicate_ids(staging_table)
+        # Orders take the stock of a product with buckets from the buckets, so a row setting product.stock
+        # would go nowhere. Those products are left alone and counted, their stock goes through /inventory.
+        updated, inserted, bucketed = await self.repository.merge_staging_table(
+            staging_table, IMPORT_COLUMNS, conditions=[product_table.c.stock_buckets == 0]
+        )
+        await self.repository.commit()
+        # We don't know which products changed, so start the detail cache over
+        product_cache.clear()
+        await product_list_cache.invalidate(product_table.name)
+
+        return ProductImportResponse(
+            received=received,
+            inserted=inserted,
+            updated=updated,
+            unmatched=loaded_with_id - duplicated - updated - bucketed,
+            bucketed=bucketed,
+            duplicated=duplicated,
+            failed=failed,
+            errors=errors,
+            errors_truncated=failed > len(errors),
+        )
+
+
+def log_progress(received: int, failed: int) -> None:
+    logger.info("Importing products: %s rows read, %s failed", received, failed)
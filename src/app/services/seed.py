@@ -0,0 +1,253 @@
+import asyncio
+import itertools
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from functools import lru_cache, partial
+from typing import Callable
+
+from sqlalchemy import Table, func, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.database import SqlAlchemyRepository
+from app.models.order import order_item_table, order_table
+from app.models.product import product_table
+
+# Put in front of the description of every generated product and the address of every generated order,
+# so they can be told apart from real data and deleted again
+SEED_MARKER = "[seed]"
+
+# The order of the values in each COPY record
+PRODUCT_COLUMNS = ["id", "name", "description", "image", "price", "stock"]
+ORDER_COLUMNS = ["id", "customer_name", "address", "contents", "created_at", "updated_at"]
+ORDER_ITEM_COLUMNS = ["order_id", "product_id", "quantity", "unit_price"]
+
+# Earlier words come up a lot more often than later ones (a Zipf distribution), like in real catalogs
+ADJECTIVES = [
+    "wireless", "cotton", "classic", "portable", "organic", "steel", "smart", "mini", "leather", "vintage",
+    "compact", "bamboo", "ceramic", "waterproof", "folding", "ergonomic", "glass", "wool", "solar", "quiet",
+]  # fmt: skip
+NOUNS = [
+    "headphones", "shirt", "lamp", "backpack", "kettle", "chair", "camera", "blender", "jacket", "speaker",
+    "keyboard", "mug", "notebook", "pillow", "charger", "bottle", "sneakers", "watch", "tent", "drill",
+]  # fmt: skip
+WORD_WEIGHTS = list(itertools.accumulate(1 / rank for rank in range(1, len(NOUNS) + 1)))
+STREETS = ["Main", "Oak", "Maple", "Cedar", "Elm", "Pine", "Lake", "Hill", "Park", "River"]
+
+# How many different prices there are. Each product takes one of them, picked from its id.
+PRICE_POINTS = 4096
+
+
+def skewed_index(rng: random.Random, count: int, skew: float) -> int:
+    # Low indexes come up far more often than high ones. 1 is even, higher is more lopsided.
+    return min(count - 1, int(count * rng.random() ** skew))
+
+
+@lru_cache(maxsize=8)
+def get_price_points(seed: int) -> list[Decimal]:
+    # Log-normal, like real prices: most products are cheap and a few are very expensive
+    rng = random.Random("{seed}-prices".format(seed=seed))
+    return [
+        Decimal(min(max(round(rng.lognormvariate(3.2, 1.1) * 100), 50), 99_999_999)).scaleb(-2)
+        for _ in range(PRICE_POINTS)
+    ]
+
+
+def product_price(seed: int, product_id: int) -> Decimal:
+    # Worked out from the id, so order items get the price of their product without looking it up
+    return get_price_points(seed)[(product_id * 2654435761) % PRICE_POINTS]
+
+
+def make_products(seed: int, batch: int, first_id: int, count: int) -> list[tuple]:
+    """
+    The records of one batch of products, in PRODUCT_COLUMNS order.
+    The same seed and batch always give the same products.
+    """
+    rng = random.Random("{seed}-product-{batch}".format(seed=seed, batch=batch))
+    # Picking all of the words in one go is a lot quicker than one at a time
+    adjectives = rng.choices(ADJECTIVES, cum_weights=WORD_WEIGHTS, k=count)
+    nouns = rng.choices(NOUNS, cum_weights=WORD_WEIGHTS, k=count)
+    records = []
+    for id, adjective, noun in zip(range(first_id, first_id + count), adjectives, nouns):
+        # Some products are sold out, most have a few dozen, and a few have thousands (Pareto)
+        stock = 0 if rng.random() < 0.1 else min(int(20 * (rng.paretovariate(1.2) - 1)), 100_000)
+        records.append(
+            (
+                id,
+                "{adjective} {noun} {model}".format(adjective=adjective, noun=noun, model=rng.randrange(100, 10_000)),
+                "{marker} A {adjective} {noun} made for everyday use.".format(
+                    marker=SEED_MARKER, adjective=adjective, noun=noun
+                ),
+                None,
+                product_price(seed, id),
+                stock,
+            )
+        )
+    return records
+
+
+def make_orders(seed: int, batch: int, first_id: int, count: int, customers: int, now: datetime) -> list[tuple]:
+    # A few customers place most of the orders, and recent orders are more common than old ones
+    rng = random.Random("{seed}-order-{batch}".format(seed=seed, batch=batch))
+    records = []
+    for id in range(first_id, first_id + count):
+        created_at = now - timedelta(days=365 * rng.random() ** 2)
+        records.append(
+            (
+                id,
+                "customer {number}".format(number=skewed_index(rng, customers, 3)),
+                "{marker} {number} {street} Street".format(
+                    marker=SEED_MARKER, number=rng.randrange(1, 1000), street=rng.choice(STREETS)
+                ),
+                None,
+                created_at,
+                created_at,
+            )
+        )
+    return records
+
+
+def make_order_items(
+    seed: int, batch: int, first_order_id: int, count: int, first_product_id: int, products: int
+) -> list[tuple]:
+    # 1 to 5 items per order, mostly 1, and the popular products are in far more orders than the rest
+    rng = random.Random("{seed}-item-{batch}".format(seed=seed, batch=batch))
+    records = []
+    for order_id in range(first_order_id, first_order_id + count):
+        for product_id in {
+            first_product_id + skewed_index(rng, products, 4) for _ in range(min(5, 1 + int(rng.expovariate(1.5))))
+        }:
+            records.append(
+                (order_id, product_id, min(int(rng.expovariate(0.7)) + 1, 20), product_price(seed, product_id))
+            )
+    return records
+
+
+async def reserve_ids(engine: AsyncEngine, table: Table, count: int) -> int:
+    """
+    Takes count ids from the sequence of the table at once, so rows can be generated with their ids
+    in parallel, and order items can point at products and orders that aren't loaded yet.
+    Returns the first of them.
+    """
+    sequence = func.pg_get_serial_sequence('"{name}"'.format(name=table.name), "id")
+    async with engine.connect() as connection:
+        # Stops anything else from inserting, and so taking an id, until the range is reserved
+        await connection.exec_driver_sql('LOCK TABLE "{name}" IN SHARE ROW EXCLUSIVE MODE'.format(name=table.name))
+        last_id = (
+            await connection.execute(select(func.setval(sequence, func.nextval(sequence) + count - 1)))
+        ).scalar_one()
+        await connection.commit()
+    return last_id - count + 1
+
+
+async def load_batches(
+    engine: AsyncEngine,
+    pool: ProcessPoolExecutor,
+    table: Table,
+    columns: list[str],
+    make_batches: list[Callable[[], list[tuple]]],
+    slots: asyncio.Semaphore,
+    on_progress: Callable[[str, int], None],
+) -> int:
+    """
+    Generates each batch in a worker process and copies it in on a connection of its own.
+    A batch waits for one of the slots first, so there's never more work going on than there are workers.
+    """
+    loop = asyncio.get_running_loop()
+    loaded = 0
+
+    async def load(make_batch: Callable[[], list[tuple]]):
+        nonlocal loaded
+        async with slots:
+            records = await loop.run_in_executor(pool, make_batch)
+            async with engine.connect() as connection:
+                await SqlAlchemyRepository(db=connection, table=table).copy_records(table, columns, records)
+                await connection.commit()
+        loaded += len(records)
+        on_progress(table.name, loaded)
+
+    await asyncio.gather(*[load(make_batch) for make_batch in make_batches])
+    return loaded
+
+
+def split(total: int, batch_size: int) -> list[tuple[int, int]]:
+    # (batch number, row count) for each batch
+    return [(batch, min(batch_size, total - batch * batch_size)) for batch in range(math.ceil(total / batch_size))]
+
+
+async def seed_database(
+    engine: AsyncEngine,
+    products: int,
+    orders: int,
+    customers: int,
+    seed: int = 42,
+    batch_size: int = 50_000,
+    jobs: int | None = None,
+    on_progress: Callable[[str, int], None] = lambda table, loaded: None,
+) -> dict[str, int]:
+    """
+    Adds generated products, orders and order items to the database. The same seed gives the same rows,
+    apart from their ids, which continue from whatever the tables already have.
+    Returns how many rows went into each table.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    first_product_id = await reserve_ids(engine, product_table, products) if products else 0
+    first_order_id = await reserve_ids(engine, order_table, orders) if orders else 0
+    # Only the order dates depend on when it runs
+    now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+
+    # One batch per worker process at a time, each with its own connection. The engine needs jobs connections.
+    slots = asyncio.Semaphore(jobs)
+    # Each batch is a partial of a module-level function, so it can be sent to a worker process
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        # Products and orders don't depend on each other, so they load at the same time
+        product_batches = [
+            partial(make_products, seed, batch, first_product_id + batch * batch_size, count)
+            for batch, count in split(products, batch_size)
+        ]
+        order_batches = [
+            partial(make_orders, seed, batch, first_order_id + batch * batch_size, count, customers, now)
+            for batch, count in split(orders, batch_size)
+        ]
+        loaded_products, loaded_orders = await asyncio.gather(
+            load_batches(engine, pool, product_table, PRODUCT_COLUMNS, product_batches, slots, on_progress),
+            load_batches(engine, pool, order_table, ORDER_COLUMNS, order_batches, slots, on_progress),
+        )
+
+        # The items point at both, so they go last
+        loaded_items = 0
+        if products and orders:
+            item_batches = [
+                partial(
+                    make_order_items,
+                    seed,
+                    batch,
+                    first_order_id + batch * batch_size,
+                    count,
+                    first_product_id,
+                    products,
+                )
+                for batch, count in split(orders, batch_size)
+            ]
+            loaded_items = await load_batches(
+                engine, pool, order_item_table, ORDER_ITEM_COLUMNS, item_batches, slots, on_progress
+            )
+
+    async with engine.connect() as connection:
+        # Fresh statistics, so the planner (and ?count=estimated) knows how big the tables are now
+        for table in (product_table, order_table, order_item_table):
+            await connection.exec_driver_sql('ANALYZE "{name}"'.format(name=table.name))
+        await connection.commit()
+
+    return {product_table.name: loaded_products, order_table.name: loaded_orders, order_item_table.name: loaded_items}
+
+
+async def delete_seeded(engine: AsyncEngine) -> None:
+    async with engine.connect() as connection:
+        # The items of the orders go with them (ON DELETE CASCADE)
+        await connection.execute(order_table.delete().where(order_table.c.address.startswith(SEED_MARKER)))
+        await connection.execute(product_table.delete().where(product_table.c.description.startswith(SEED_MARKER)))
+        await connection.commit()
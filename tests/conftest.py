@@ -15,6 +15,7 @@ from app.database import SqlAlchemyRepository
 from app.main import app
 from app.models import metadata
 from app.models.product import Product, product_table
+from app.services.product import product_cache
 from app.settings import Settings
 
 
@@ -92,6 +93,8 @@ async def test_conn(test_engine: AsyncEngine) -> AsyncGenerator[AsyncConnection]
                     for table in reversed(metadata.sorted_tables):
                         await cleanup_conn.execute(table.delete())
                     await cleanup_conn.commit()
+            # The product detail cache lives as long as the process, so it must not leak into the next test
+            product_cache.clear()
 
 
 @pytest_asyncio.fixture
@@ -1,5 +1,8 @@
 import pytest
 
+from app.main import app
+from app.services.product import ProductService
+
 
 @pytest.mark.skip
 async def test_list_products(client, seed_product):
@@ -9,3 +12,25 @@ async def test_list_products(client, seed_product):
     assert response_data["next"] == "http://localhost:5000/products?page=1&count_per_page=200"
     assert response_data["previous"] == ""
     assert response_data["results"][-1] == seed_product
+
+
+class MissingProductService:
+    # Knows no products at all, so the route doesn't need a database
+    async def get_validators(self, id: int, fields=None):
+        return None
+
+    async def get_versioned(self, id: int, fields=None):
+        return None
+
+
+def test_get_missing_product(client):
+    app.dependency_overrides[ProductService.read_only] = MissingProductService
+    try:
+        response = client.get("/products/12345")
+        conditional = client.get("/products/12345", headers={"If-None-Match": 'W/"abc"'})
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Product not found"}
+    assert conditional.status_code == 404
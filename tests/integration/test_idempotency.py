@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.database import SqlAlchemyRepository
+from app.database.idempotency import SqlAlchemyIdempotencyRepository
+from app.models.product import product_table
+from app.schemas.product import ProductCreateRequest
+from app.services.idempotency import IdempotentRequest
+from app.services.product import ProductService
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_idempotency_key_waits_for_the_first_request(test_engine: AsyncEngine, product_data: dict):
+    # GIVEN
+    product = ProductCreateRequest(**product_data)
+    first_connection = await test_engine.connect()
+    second_connection = await test_engine.connect()
+    first = IdempotentRequest(SqlAlchemyIdempotencyRepository(db=first_connection), "POST /products/", "retry-me")
+    second = IdempotentRequest(SqlAlchemyIdempotencyRepository(db=second_connection), "POST /products/", "retry-me")
+
+    # WHEN
+    assert await first.replay(product) is None
+    # The retry arrives while the first request is still running
+    retry = asyncio.create_task(second.replay(product))
+    await asyncio.sleep(0.2)
+    waited = not retry.done()
+    created = await ProductService(repository=SqlAlchemyRepository(db=first_connection, table=product_table)).create(
+        product, idempotency=first
+    )
+    replayed = await retry
+
+    # THEN
+    assert waited
+    assert replayed is not None
+    assert replayed.status_code == 201
+    assert replayed.body == created.model_dump_json().encode()
+    with pytest.raises(HTTPException) as error:
+        await second.replay(ProductCreateRequest(**{**product_data, "stock": product.stock + 1}))
+    assert error.value.status_code == 422
+
+    await second_connection.close()
+    await first_connection.close()
@@ -0,0 +1,37 @@
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio.engine import AsyncConnection
+
+from app.database import SqlAlchemyRepository
+from app.database.instrumentation import QueryInstrumentation
+from app.models.product import product_table
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_instrumentation_counts_selected_rows(
+    test_engine: AsyncEngine,
+    test_conn: AsyncConnection,
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    await product_repository.insert_many([product_data, product_data, product_data])
+    await product_repository.commit()
+    instrumentation = QueryInstrumentation()
+    recorded = []
+    instrumentation.add_listener(lambda *args: recorded.append(args))
+    instrumentation.install(test_engine)
+
+    # WHEN
+    try:
+        async with test_engine.connect() as connection:
+            await connection.execute(select(product_table.c.id))
+    finally:
+        instrumentation.uninstall(test_engine)
+
+    # THEN
+    # The count comes from the driver's public rowcount, which asyncpg fills in for SELECTs as well
+    _, statement, _, rowcount = recorded[-1]
+    assert statement.startswith("SELECT")
+    assert rowcount == 3
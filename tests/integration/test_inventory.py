@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio.engine import AsyncConnection
+
+from app.database import SqlAlchemyRepository
+from app.database.inventory import SqlAlchemyInventoryRepository
+from app.schemas.product import ProductUpdateRequest
+from app.services.product import ProductService
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_inventory_buckets_never_oversell(
+    test_engine: AsyncEngine,
+    test_conn: AsyncConnection,
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    product = await product_repository.insert({**product_data, "stock": 30})
+    inventory = SqlAlchemyInventoryRepository(db=test_conn)
+    await inventory.set_buckets(product["id"], buckets=4)
+    await inventory.commit()
+
+    async def checkout() -> bool:
+        async with test_engine.connect() as connection:
+            reserved = await SqlAlchemyInventoryRepository(db=connection).reserve({product["id"]: 1})
+            await asyncio.sleep(0.01)
+            await connection.commit()
+            return product["id"] in reserved
+
+    # WHEN
+    results = await asyncio.gather(*[checkout() for _ in range(60)])
+
+    # THEN
+    assert sum(results) == 30
+    assert await inventory.get_stock(product["id"]) == (4, 0)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_inventory_buckets_take_from_several_buckets(
+    test_conn: AsyncConnection,
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    plain, sharded = await product_repository.insert_many([{**product_data, "stock": 5}, product_data])
+    inventory = SqlAlchemyInventoryRepository(db=test_conn)
+    # 5 in each bucket, so no single bucket has enough for 12
+    await inventory.set_buckets(sharded["id"], buckets=4, stock=20)
+    await inventory.commit()
+
+    # WHEN
+    reserved = await inventory.reserve({plain["id"]: 2, sharded["id"]: 12})
+    too_many = await inventory.reserve({sharded["id"]: 9})
+    await inventory.commit()
+
+    # THEN
+    assert set(reserved) == {plain["id"], sharded["id"]}
+    assert too_many == {}
+    assert await inventory.get_stock(plain["id"]) == (0, 3)
+    assert await inventory.get_stock(sharded["id"]) == (4, 8)
+    # Putting the stock back in the product row keeps what's left
+    assert await inventory.set_buckets(sharded["id"], buckets=0) == (0, 8)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_inventory_buckets_refuse_other_stock_writes(
+    test_conn: AsyncConnection,
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    product = await product_repository.insert({**product_data, "stock": 10})
+    inventory = SqlAlchemyInventoryRepository(db=test_conn)
+    await inventory.set_buckets(product["id"], buckets=2)
+    await inventory.commit()
+    service = ProductService(repository=product_repository)
+
+    # WHEN
+    with pytest.raises(HTTPException) as refused:
+        await service.update(id=product["id"], product=ProductUpdateRequest(**{**product_data, "stock": 50}))
+
+    # THEN
+    assert refused.value.status_code == 409
+    # The buckets still have all of the stock, and putting them back together doesn't lose anything
+    assert await inventory.get_stock(product["id"]) == (2, 10)
+    assert await inventory.set_buckets(product["id"], buckets=0) == (0, 10)
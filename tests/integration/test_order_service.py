@@ -0,0 +1,188 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import CursorResult, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio.engine import AsyncConnection
+
+from app.database import SqlAlchemyRepository
+from app.database.inventory import SqlAlchemyInventoryRepository
+from app.models.order import order_item_table, order_table
+from app.models.product import product_table
+from app.schemas.order import OrderCreateRequest, OrderItemRequest, OrderListRequest
+from app.services.order import OrderService
+
+
+def get_order_service(db: AsyncConnection) -> OrderService:
+    return OrderService(
+        repository=SqlAlchemyRepository(db=db, table=order_table),
+        item_repository=SqlAlchemyRepository(db=db, table=order_item_table),
+        inventory_repository=SqlAlchemyInventoryRepository(db=db),
+    )
+
+
+async def get_stock(db: AsyncConnection, id: int) -> int:
+    result: CursorResult = await db.execute(select(product_table.c.stock).where(product_table.c.id == id))
+    return result.scalar_one()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_order_customer_history(test_conn: AsyncConnection):
+    # GIVEN
+    service = get_order_service(test_conn)
+    created = []
+    for i in range(5):
+        created.append(
+            await service.create(OrderCreateRequest(customer_name="alice", address="1 Main St", contents=str(i)))
+        )
+        await service.create(OrderCreateRequest(customer_name="bob", address="2 Main St", contents=str(i)))
+    list_query = OrderListRequest(page=0, size=2, cursor=None, customer_name="alice")
+
+    # WHEN
+    ids = []
+    response = await service.list(list_query, "/orders")
+    ids.extend(x.id for x in response.results)
+    while response.next is not None:
+        cursor = response.next.split("cursor=")[1].split("&")[0]
+        response = await service.list(list_query.model_copy(update={"cursor": cursor}), "/orders")
+        ids.extend(x.id for x in response.results)
+
+    # THEN
+    # Only alice's orders, newest first
+    assert ids == [order.id for order in reversed(created)]
+    assert response.count == 5
+    assert "customer_name=alice" in response.previous
+    assert await service.get(created[0].id) == created[0]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_order_reserves_all_items_or_none(
+    test_conn: AsyncConnection,
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    service = get_order_service(test_conn)
+    plenty, scarce = await product_repository.insert_many([{**product_data, "stock": 10}, {**product_data, "stock": 1}])
+    await product_repository.commit()
+
+    # WHEN
+    order = await service.create(
+        OrderCreateRequest(
+            customer_name="alice",
+            address="1 Main St",
+            items=[
+                OrderItemRequest(product_id=plenty["id"], quantity=2),
+                OrderItemRequest(product_id=scarce["id"], quantity=1),
+                OrderItemRequest(product_id=plenty["id"], quantity=1),
+            ],
+        )
+    )
+    with pytest.raises(HTTPException) as error:
+        await service.create(
+            OrderCreateRequest(
+                customer_name="bob",
+                address="2 Main St",
+                items=[
+                    OrderItemRequest(product_id=plenty["id"], quantity=1),
+                    OrderItemRequest(product_id=scarce["id"], quantity=1),
+                ],
+            )
+        )
+
+    # THEN
+    assert {(item.product_id, item.quantity) for item in order.items} == {(plenty["id"], 3), (scarce["id"], 1)}
+    assert (await service.get(order.id)).items == order.items
+    assert error.value.status_code == 409
+    assert error.value.detail["product_ids"] == [scarce["id"]]
+    # bob's order took nothing, not even the product that had enough stock
+    assert await get_stock(test_conn, plenty["id"]) == 7
+    assert await get_stock(test_conn, scarce["id"]) == 0
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_order_concurrent_checkouts_never_oversell(
+    test_engine: AsyncEngine,
+    test_conn: AsyncConnection,
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    first, second = await product_repository.insert_many([{**product_data, "stock": 20}, {**product_data, "stock": 20}])
+    await product_repository.commit()
+
+    async def checkout(i: int) -> bool:
+        # Each checkout has its own connection, like concurrent requests would.
+        # Half of them list the products the other way around, which would deadlock without the lock order.
+        items = [
+            OrderItemRequest(product_id=first["id"], quantity=1),
+            OrderItemRequest(product_id=second["id"], quantity=1),
+        ]
+        async with test_engine.connect() as connection:
+            service = get_order_service(connection)
+            try:
+                await service.create(
+                    OrderCreateRequest(
+                        customer_name="customer {i}".format(i=i),
+                        address="1 Main St",
+                        items=items[:: 1 if i % 2 else -1],
+                    )
+                )
+            except HTTPException:
+                return False
+            return True
+
+    # WHEN
+    results = await asyncio.gather(*[checkout(i) for i in range(50)])
+
+    # THEN
+    assert sum(results) == 20
+    assert await get_stock(test_conn, first["id"]) == 0
+    assert await get_stock(test_conn, second["id"]) == 0
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_order_checkouts_while_stock_buckets_change(
+    test_engine: AsyncEngine,
+    test_conn: AsyncConnection,
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    product = await product_repository.insert({**product_data, "stock": 100})
+    inventory = SqlAlchemyInventoryRepository(db=test_conn)
+    await inventory.set_buckets(product["id"], buckets=4)
+    await inventory.commit()
+
+    async def checkout(i: int) -> bool:
+        async with test_engine.connect() as connection:
+            try:
+                await get_order_service(connection).create(
+                    OrderCreateRequest(
+                        customer_name="customer {i}".format(i=i),
+                        address="1 Main St",
+                        items=[OrderItemRequest(product_id=product["id"], quantity=1)],
+                    )
+                )
+            except HTTPException:
+                return False
+            return True
+
+    async def split(buckets: int) -> None:
+        # Orders holding a bucket insert their order_item while this holds the product row
+        async with test_engine.connect() as connection:
+            await SqlAlchemyInventoryRepository(db=connection).set_buckets(product["id"], buckets=buckets)
+            await connection.commit()
+
+    # WHEN
+    # A deadlock would make one of these raise
+    results = await asyncio.gather(
+        *[checkout(i) for i in range(40)],
+        *[split(buckets) for buckets in [2, 8, 4, 0, 4] * 2],
+    )
+
+    # THEN
+    sold = sum(result is True for result in results)
+    assert sold == 40
+    assert (await inventory.get_stock(product["id"]))[1] == 100 - sold
@@ -1,3 +1,4 @@
+import json
 from decimal import Decimal
 from typing import Sequence
 
@@ -7,8 +8,16 @@ from sqlalchemy.ext.asyncio.engine import AsyncConnection
 
 from app.database import SqlAlchemyRepository
 from app.models.product import product_table
-from app.schemas.product import ProductCreateRequest, ProductCreateResponse, ProductDetailResponse, ProductUpdateRequest
-from app.services.product import ProductService
+from app.schemas.product import (
+    ProductCreateRequest,
+    ProductCreateResponse,
+    ProductDetailResponse,
+    ProductListRequest,
+    ProductSearchRequest,
+    ProductUpdateRequest,
+)
+from app.services.product import ProductService, product_cache
+from app.services.product_import import ImportFormat, ProductImportService, parse_rows
 
 # here, we show how tests can be useful in terms of refactoring existing code
 # and to demonstrate the concept of DI
@@ -100,3 +109,259 @@ async def test_product_get_one(
     # THEN
     assert found is not None
     assert found.id == product.id
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_product_detail_cache(
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    service = ProductService(repository=product_repository)
+    product: ProductCreateResponse = await service.create(product=ProductCreateRequest(**product_data))
+    await service.get_detail(id=product.id)
+
+    # WHEN
+    hits = product_cache.stats.hits
+    cached = await service.get_detail(id=product.id)
+    updated = await service.update(id=product.id, product=ProductUpdateRequest(**{**product_data, "stock": 0}))
+    after_update = await service.get_detail(id=product.id)
+    await service.delete(id=product.id)
+    after_delete = await service.get_detail(id=product.id)
+
+    # THEN
+    assert cached is not None and cached.id == product.id
+    assert product_cache.stats.hits == hits + 2
+    assert after_update == updated
+    assert after_delete is None
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_product_validators_change_on_update(
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    service = ProductService(repository=product_repository)
+    product: ProductCreateResponse = await service.create(product=ProductCreateRequest(**product_data))
+    etag, _ = await service.get_validators(id=product.id)
+
+    # WHEN
+    await service.update(id=product.id, product=ProductUpdateRequest(**{**product_data, "stock": 0}))
+    product_cache.clear()
+    new_etag, last_modified = await service.get_validators(id=product.id)
+
+    # THEN
+    assert new_etag != etag
+    assert last_modified is not None
+    assert (await service.get_versioned(id=product.id)).etag == new_etag
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_product_paginate_filters_and_sort(
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    service = ProductService(repository=product_repository)
+    await service.create_many(
+        products=[
+            {**product_data, "name": "Apple", "price": 3, "stock": 5},
+            {**product_data, "name": "apricot", "price": 3, "stock": 1},
+            {**product_data, "name": "Avocado", "price": 5, "stock": 0},
+            {**product_data, "name": "Banana", "price": 1, "stock": 9},
+            {**product_data, "name": "Ap_ple", "price": 10, "stock": 2},
+        ]
+    )
+    list_query = ProductListRequest(
+        page=0,
+        size=1,
+        cursor=None,
+        min_price=2,
+        max_price=None,
+        in_stock=True,
+        name_prefix="ap",
+        sort="price",
+        order="desc",
+    )
+
+    # WHEN
+    names = []
+    response = await service.paginate(list_query, "/products")
+    names.extend(x.name for x in response.results)
+    while response.next is not None:
+        cursor = response.next.split("cursor=")[1].split("&")[0]
+        response = await service.paginate(list_query.model_copy(update={"cursor": cursor}), "/products")
+        names.extend(x.name for x in response.results)
+
+    # THEN
+    # Apple and apricot cost the same, so the one with the higher id comes first
+    assert names == ["Ap_ple", "apricot", "Apple"]
+    assert response.count == 3
+    assert "name_prefix=ap" in response.previous
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_product_list_validators_match_the_page(
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    service = ProductService(repository=product_repository)
+    await service.create_many([product_data, {**product_data, "name": "other"}])
+    list_query = ProductListRequest(page=0, size=20, cursor=None, count="exact")
+
+    # WHEN
+    page = await service.paginate_cached(list_query, "/products")
+    etag, last_modified = await service.get_list_validators(list_query, "/products")
+
+    # THEN
+    # The validators skip the count, so it can't be part of the ETag of the page either
+    assert etag == page.etag
+    assert last_modified == page.last_modified
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_product_fields(
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    service = ProductService(repository=product_repository)
+    product: ProductCreateResponse = await service.create(product=ProductCreateRequest(**product_data))
+    list_query = ProductListRequest(page=0, size=20, cursor=None, sort="price", fields="name,price")
+
+    # WHEN
+    page = await service.paginate(list_query, "/products")
+    versioned = await service.get_versioned(id=product.id, fields=("id", "stock"))
+
+    # THEN
+    assert page.results[0].model_dump() == {"id": product.id, "name": product.name, "price": product.price}
+    assert versioned.product.model_dump() == {"id": product.id, "stock": product.stock}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_product_search(
+    product_repository: SqlAlchemyRepository,
+    product_data: dict,
+):
+    # GIVEN
+    service = ProductService(repository=product_repository)
+    await service.create_many(
+        products=[
+            {**product_data, "name": "Wireless headphones", "description": "Noise cancelling"},
+            {**product_data, "name": "Headphone stand", "description": "For wireless headphones"},
+            {**product_data, "name": "Wired keyboard", "description": None},
+        ]
+    )
+
+    # WHEN
+    first = await service.search(
+        ProductSearchRequest(q="wireless head", page=0, size=1, cursor=None, count="exact"), "/search"
+    )
+    cursor = first.next.split("cursor=")[1].split("&")[0]
+    second = await service.search(ProductSearchRequest(q="wireless head", page=0, size=1, cursor=cursor), "/search")
+
+    # THEN
+    # A match in the name ranks higher than a match in the description
+    assert [x.name for x in first.results] == ["Wireless headphones"]
+    assert [x.name for x in second.results] == ["Headphone stand"]
+    assert second.next is None
+    assert first.count == 2
+    # Searches only estimate the count unless they're asked for an exact one
+    assert second.count_estimated
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_product_create_many(
+    product_repository: SqlAlchemyRepository,
+    test_conn: AsyncConnection,
+    product_data: dict,
+):
+    # GIVEN
+    service = ProductService(repository=product_repository)
+    products = [product_data, {"name": "no price"}, {**product_data, "name": "another product"}]
+
+    # WHEN
+    response = await service.create_many(products=products)
+
+    # THEN
+    assert response.created == 2
+    assert response.failed == 1
+    assert [x.created for x in response.results] == [True, False, True]
+    assert response.results[1].errors[0]["loc"] == ("price",)
+    query: Select = product_table.select()
+    execution: CursorResult = await test_conn.execute(query)
+    found: Sequence[RowMapping] = execution.mappings().all()
+    assert len(found) == 2
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_product_import(
+    product_repository: SqlAlchemyRepository,
+    test_conn: AsyncConnection,
+    product_data: dict,
+):
+    # GIVEN
+    service = ProductService(repository=product_repository)
+    existing: ProductCreateResponse = await service.create(product=ProductCreateRequest(**product_data))
+    csv_file = "\n".join(
+        [
+            "id,name,description,price,stock",
+            '{id},renamed product,"now with\na line break",12.50,5'.format(id=existing.id),
+            ",new product,,3,",
+            ",broken product,,not a price,1",
+        ]
+    ).encode()
+
+    async def chunks():
+        # Small chunks, so rows are split between them like they would be on the network
+        for start in range(0, len(csv_file), 16):
+            yield csv_file[start : start + 16]
+
+    # WHEN
+    import_service = ProductImportService(repository=product_repository)
+    result = await import_service.import_products(parse_rows(ImportFormat.CSV, chunks()))
+
+    # THEN
+    assert result.received == 3
+    assert result.updated == 1
+    assert result.inserted == 1
+    assert result.failed == 1
+    assert result.errors[0].row == 3
+    query: Select = product_table.select().order_by(product_table.c.id)
+    execution: CursorResult = await test_conn.execute(query)
+    found: Sequence[RowMapping] = execution.mappings().all()
+    assert [(x["name"], x["stock"]) for x in found] == [("renamed product", 5), ("new product", 0)]
+    assert found[0]["description"] == "now with\na line break"
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_product_import_skips_duplicate_ids(
+    product_repository: SqlAlchemyRepository,
+    test_conn: AsyncConnection,
+    product_data: dict,
+):
+    # GIVEN
+    service = ProductService(repository=product_repository)
+    existing: ProductCreateResponse = await service.create(product=ProductCreateRequest(**product_data))
+    rows = [
+        {"id": existing.id, "name": "first", "price": "1"},
+        {"id": existing.id, "name": "second", "price": "2"},
+        {"name": "new product", "price": "3"},
+    ]
+
+    async def chunks():
+        yield "\n".join(json.dumps(row) for row in rows).encode()
+
+    # WHEN
+    import_service = ProductImportService(repository=product_repository)
+    result = await import_service.import_products(parse_rows(ImportFormat.NDJSON, chunks()))
+
+    # THEN
+    assert result.duplicated == 2
+    assert result.updated == 0
+    assert result.unmatched == 0
+    assert result.inserted == 1
+    found = await service.get_detail(id=existing.id)
+    assert found.name == product_data["name"]
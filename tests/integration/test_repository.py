@@ -8,7 +8,8 @@ from sqlalchemy import CursorResult, RowMapping, Select
 from sqlalchemy.ext.asyncio.engine import AsyncConnection
 from sqlalchemy.sql.elements import ColumnElement, UnaryExpression
 
-from app.database import SqlAlchemyRepository
+from app.counting import Count, CountStrategy
+from app.database import SqlAlchemyRepository, count_cache
 from app.models.product import Product, product_table
 
 
@@ -125,12 +126,163 @@ async def test_paginate(product_repository: SqlAlchemyRepository):
         size=20,
     )
 
-    count: int = await product_repository.get_count(
+    count: Count = await product_repository.get_count(
         select_statement=query,
         filters=filters,
     )
 
     # THEN
     expected: list[Product] = [x for x in products if x.price < 1500 and x.stock > 45]
-    assert count == len(expected)
+    assert count.value == len(expected)
     assert set([x["id"] for x in res]) == set([x.id for x in expected])
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_paginate_keyset(product_repository: SqlAlchemyRepository):
+    # GIVEN
+    products: list[Product] = []
+    for _ in range(30):
+        test_product = {
+            "name": "test product {rand}".format(rand=math.floor(random.random() * 10000)),
+            "description": "best product",
+            "price": random.randrange(1000, 1010),
+            "stock": random.randrange(10, 100),
+        }
+        res = await product_repository.insert(test_product)
+        products.append(Product(**res))
+    await product_repository.commit()
+
+    # WHEN
+    # Walk every page by seeking past the last (price, id) we've seen
+    query: Select = product_table.select()
+    keys = [product_table.c.price, product_table.c.id]
+    found: list[RowMapping] = []
+    after = None
+    while True:
+        res: Sequence[RowMapping] = await product_repository.paginate_keyset(
+            select_statement=query,
+            filters=[],
+            keys=keys,
+            after=after,
+            size=7,
+        )
+        if not res:
+            break
+        found.extend(res)
+        # cursors travel through JSON, so the values come back as plain strings and numbers
+        after = [str(res[-1]["price"]), res[-1]["id"]]
+
+    # THEN
+    expected: list[Product] = sorted(products, key=lambda x: (x.price, x.id))
+    assert [x["id"] for x in found] == [x.id for x in expected]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_count_strategies(product_repository: SqlAlchemyRepository, product_data: dict):
+    # GIVEN
+    for _ in range(5):
+        await product_repository.insert(product_data)
+    await product_repository.commit()
+    count_cache.clear()
+    query: Select = product_table.select()
+    filters: list[ColumnElement[bool]] = [product_table.c.stock >= 0]
+
+    # WHEN
+    exact = await product_repository.get_count(select_statement=query, filters=filters)
+    estimated = await product_repository.get_count(
+        select_statement=query, filters=filters, strategy=CountStrategy.ESTIMATED
+    )
+    cached = await product_repository.get_count(select_statement=query, filters=filters, strategy=CountStrategy.CACHED)
+    # This one isn't counted yet, so it should come from the cache
+    await product_repository.insert(product_data)
+    await product_repository.commit()
+    cached_again = await product_repository.get_count(
+        select_statement=query, filters=filters, strategy=CountStrategy.CACHED
+    )
+    omitted = await product_repository.get_count(select_statement=query, filters=filters, strategy=CountStrategy.NONE)
+
+    # THEN
+    assert exact == Count(5, estimated=False)
+    # The planner's estimate is only a guess, but it should be a number
+    assert isinstance(estimated.value, int)
+    assert estimated.estimated
+    # Counted for real the first time, re-used the second
+    assert cached == Count(5, estimated=False)
+    assert cached_again == Count(5, estimated=True)
+    assert omitted == Count(None)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_repository_insert_many(test_conn: AsyncConnection):
+    # GIVEN
+    repository = SqlAlchemyRepository(db=test_conn, table=product_table)
+    products = [
+        {"name": "bulk product {index}".format(index=index), "description": None, "price": 1000 + index, "stock": index}
+        for index in range(25)
+    ]
+
+    # WHEN
+    # A small chunk size, so the rows are split over several statements
+    created: Sequence[RowMapping] = await repository.insert_many(data=products, chunk_size=10)
+    await repository.commit()
+
+    # THEN
+    assert [x["name"] for x in created] == [x["name"] for x in products]
+    query: Select = product_table.select()
+    execution: CursorResult = await test_conn.execute(query)
+    found: Sequence[RowMapping] = execution.mappings().all()
+    assert len(found) == len(products)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_repository_stream(test_conn: AsyncConnection, product_data: dict):
+    # GIVEN
+    repository = SqlAlchemyRepository(db=test_conn, table=product_table)
+    created = await repository.insert_many([product_data] * 25)
+    await repository.commit()
+
+    # WHEN
+    # Server-side cursors need a transaction to live in
+    batches: list[Sequence[RowMapping]] = []
+    async with test_conn.begin():
+        async for batch in repository.stream(
+            select_statement=product_table.select(),
+            filters=[],
+            ordering=[product_table.c.id.asc()],
+            batch_size=10,
+        ):
+            batches.append(batch)
+
+    # THEN
+    assert [len(x) for x in batches] == [10, 10, 5]
+    assert [x["id"] for batch in batches for x in batch] == [x["id"] for x in created]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_count_keeps_client_values_as_parameters(
+    product_repository: SqlAlchemyRepository, product_data: dict
+):
+    # GIVEN
+    await product_repository.insert({**product_data, "name": "it's_50% off"})
+    await product_repository.commit()
+    count_cache.clear()
+    query: Select = product_table.select()
+    # Quotes, backslashes and LIKE wildcards, like a name_prefix typed by a client
+    filters: list[ColumnElement[bool]] = [product_table.c.name.like("it's\\_50\\%%", escape="\\")]
+
+    # WHEN
+    estimated = await product_repository.get_count(
+        select_statement=query, filters=filters, strategy=CountStrategy.ESTIMATED
+    )
+    cached = await product_repository.get_count(select_statement=query, filters=filters, strategy=CountStrategy.CACHED)
+    other = await product_repository.get_count(
+        select_statement=query,
+        filters=[product_table.c.name.like("nothing%", escape="\\")],
+        strategy=CountStrategy.CACHED,
+    )
+
+    # THEN
+    assert isinstance(estimated.value, int)
+    assert cached == Count(1, estimated=False)
+    # Different values are counted on their own, even though the SQL is the same
+    assert other == Count(0, estimated=False)
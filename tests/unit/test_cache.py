@@ -0,0 +1,41 @@
+import time
+
+from app.cache import NOT_FOUND, TTLCache
+
+
+def test_cache_evicts_least_recently_used():
+    # GIVEN
+    cache = TTLCache(max_entries=2, ttl=60)
+    cache.set(1, "one")
+    cache.set(2, "two")
+
+    # WHEN
+    # Reading 1 makes 2 the least recently used entry
+    cache.get(1)
+    cache.set(3, "three")
+
+    # THEN
+    assert cache.get(1) == "one"
+    assert cache.get(2) is None
+    assert cache.get(3) == "three"
+    assert cache.stats.evictions == 1
+    assert cache.stats.hits == 3
+    assert cache.stats.misses == 1
+
+
+def test_cache_expires_entries(monkeypatch):
+    # GIVEN
+    cache = TTLCache(max_entries=10, ttl=5)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache.set("product", "value")
+    cache.set("missing", NOT_FOUND, ttl=1)
+
+    # WHEN
+    monkeypatch.setattr(time, "monotonic", lambda: now + 2)
+
+    # THEN
+    assert cache.get("product") == "value"
+    assert cache.get("missing") is None
+    assert cache.stats.expirations == 1
+    assert len(cache) == 1
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from starlette.requests import Request
+
+from app.conditional import etag_matches, make_etag, not_modified, validator_headers
+
+
+def _request(**headers: str) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "headers": [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()],
+        }
+    )
+
+
+def test_etag_matches_weakly():
+    etag = make_etag(1, datetime(2025, 1, 2))
+
+    assert etag.startswith('W/"')
+    assert etag_matches(etag, etag)
+    assert etag_matches('"other", ' + etag.removeprefix("W/"), etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('W/"other"', etag)
+
+
+def test_not_modified():
+    # GIVEN
+    updated_at = datetime(2025, 1, 2, 3, 4, 5, 600)
+    etag = make_etag(1, updated_at)
+    last_modified = validator_headers(etag, updated_at)["Last-Modified"]
+
+    # THEN
+    assert last_modified == "Thu, 02 Jan 2025 03:04:05 GMT"
+    assert not_modified(_request(if_modified_since=last_modified), etag, updated_at)
+    assert not not_modified(_request(if_modified_since="Wed, 01 Jan 2025 00:00:00 GMT"), etag, updated_at)
+    # If-None-Match wins over If-Modified-Since
+    assert not not_modified(_request(if_none_match='W/"other"', if_modified_since=last_modified), etag, updated_at)
+    assert not not_modified(_request(), etag, updated_at)
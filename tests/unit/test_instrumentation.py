@@ -0,0 +1,41 @@
+from app.database.instrumentation import QueryInstrumentation, fingerprint_statement, normalize_statement
+
+
+def test_normalize_statement_ignores_values():
+    # GIVEN
+    first = "SELECT product.id FROM product WHERE product.id = $1::BIGINT AND product.name = 'a' LIMIT 20"
+    second = "SELECT product.id FROM product WHERE product.id = $1::BIGINT AND product.name = 'it''s' LIMIT 200"
+
+    # WHEN
+    normalized = normalize_statement(first)
+
+    # THEN
+    assert normalized == "SELECT product.id FROM product WHERE product.id = ?::BIGINT AND product.name = ? LIMIT ?"
+    assert normalized == normalize_statement(second)
+    assert fingerprint_statement(normalized) == fingerprint_statement(normalize_statement(second))
+
+
+def test_normalize_statement_collapses_lists():
+    short = normalize_statement("INSERT INTO product (name, price) VALUES ($1, $2) RETURNING product.id")
+    long = normalize_statement("INSERT INTO product (name, price) VALUES ($1, $2), ($3, $4) RETURNING product.id")
+
+    assert short == long == "INSERT INTO product (name, price) VALUES (...) RETURNING product.id"
+
+
+def test_record_aggregates_by_fingerprint():
+    # GIVEN
+    instrumentation = QueryInstrumentation()
+    recorded = []
+    instrumentation.add_listener(lambda *args: recorded.append(args))
+
+    # WHEN
+    instrumentation.record("SELECT * FROM product WHERE id = $1", 0.002, 1)
+    instrumentation.record("SELECT * FROM product WHERE id = $1", 0.004, 0)
+
+    # THEN
+    assert len(instrumentation.stats) == 1
+    stats = next(iter(instrumentation.stats.values()))
+    assert stats.calls == 2
+    assert stats.rows == 1
+    assert stats.max_seconds == 0.004
+    assert len(recorded) == 2
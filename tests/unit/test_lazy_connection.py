@@ -0,0 +1,145 @@
+import time
+
+import pytest
+from fastapi import Depends, FastAPI, Response
+from fastapi.testclient import TestClient
+from sqlalchemy import exc
+from sqlalchemy.dialects.postgresql.asyncpg import PGDialect_asyncpg
+
+from app.database import connection_provider
+from app.database.connection_provider import LazyConnection
+
+
+class FakeConnection:
+    # Records what happens to it, like an AsyncConnection from the pool would go through
+    def __init__(self):
+        self.calls: list[str] = []
+        self.transaction = False
+
+    async def execution_options(self, **options):
+        self.calls.append("options {options}".format(options=options))
+        return self
+
+    async def execute(self, statement):
+        self.calls.append("execute")
+        self.transaction = True
+
+    def in_transaction(self) -> bool:
+        return self.transaction
+
+    async def commit(self):
+        self.calls.append("commit")
+        self.transaction = False
+
+    async def rollback(self):
+        self.calls.append("rollback")
+        self.transaction = False
+
+    async def close(self):
+        self.calls.append("close")
+
+
+def lazy(autocommit: bool = False) -> tuple[LazyConnection, list[FakeConnection]]:
+    checked_out: list[FakeConnection] = []
+
+    async def checkout() -> FakeConnection:
+        checked_out.append(FakeConnection())
+        return checked_out[-1]
+
+    return LazyConnection(checkout, dialect=PGDialect_asyncpg(), autocommit=autocommit), checked_out
+
+
+@pytest.mark.asyncio
+async def test_no_connection_until_the_first_statement():
+    # GIVEN
+    connection, checked_out = lazy()
+
+    # WHEN
+    await connection.commit()
+    await connection.release(commit=True)
+
+    # THEN
+    assert checked_out == []
+
+
+@pytest.mark.asyncio
+async def test_commit_hands_the_connection_back():
+    # GIVEN
+    connection, checked_out = lazy()
+
+    # WHEN
+    await connection.execute("SELECT 1")
+    await connection.execute("SELECT 2")
+    await connection.commit()
+    # A statement after the commit takes a new connection
+    await connection.execute("SELECT 3")
+    await connection.release(commit=False)
+
+    # THEN
+    assert [fake.calls for fake in checked_out] == [
+        ["execute", "execute", "commit", "close"],
+        ["execute", "rollback", "close"],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_autocommit_reads():
+    # GIVEN
+    connection, checked_out = lazy(autocommit=True)
+
+    # WHEN
+    await connection.execute("SELECT 1")
+    await connection.release(commit=False)
+
+    # THEN
+    assert checked_out[0].calls[0] == "options {'isolation_level': 'AUTOCOMMIT'}"
+    assert checked_out[0].calls[-1] == "close"
+
+
+async def test_read_fails_over_when_a_replica_pool_is_exhausted(monkeypatch: pytest.MonkeyPatch):
+    # GIVEN
+    retry_at = [0.0]
+    monkeypatch.setattr(connection_provider, "get_replica_engines", lambda: ["replica"])
+    monkeypatch.setattr(connection_provider, "get_engine", lambda: "primary")
+    monkeypatch.setattr(connection_provider, "__replica_retry_at", retry_at)
+
+    async def checkout(engine: str) -> str:
+        if engine == "replica":
+            raise exc.TimeoutError("QueuePool limit reached")
+        return "connection to {engine}".format(engine=engine)
+
+    monkeypatch.setattr(connection_provider, "_checkout", checkout)
+
+    # WHEN
+    connection = await connection_provider._checkout_for_read(use_primary=False)
+
+    # THEN
+    assert connection == "connection to primary"
+    # A busy replica isn't a broken one, so the next read tries it again
+    assert retry_at == [0.0]
+
+
+def test_read_your_writes_cookie_on_responses_made_by_the_handler(monkeypatch: pytest.MonkeyPatch):
+    # GIVEN
+    monkeypatch.setattr(connection_provider.settings, "db_replica_urls", ["postgresql+asyncpg://replica/db"])
+    monkeypatch.setattr(connection_provider.settings, "db_read_your_writes_seconds", 5)
+    app = FastAPI()
+    app.add_middleware(connection_provider.ReadYourWritesMiddleware)
+
+    # Like an idempotent replay: a Response of its own, and the connection is never used
+    @app.post("/things")
+    async def replay(db=Depends(connection_provider.database_connection)) -> Response:
+        return Response(content=b"{}", media_type="application/json")
+
+    @app.get("/things")
+    async def get_things() -> Response:
+        return Response(content=b"{}", media_type="application/json")
+
+    # WHEN
+    client = TestClient(app)
+    written = client.post("/things")
+    read = client.get("/things")
+
+    # THEN
+    assert float(written.cookies[connection_provider.READ_YOUR_WRITES_COOKIE]) > time.time()
+    assert "set-cookie" not in read.headers
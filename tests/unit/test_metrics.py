@@ -0,0 +1,49 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.metrics import Counter, Histogram, MetricsMiddleware, http_request_duration_seconds, registry
+
+
+def test_histogram_renders_cumulative_buckets():
+    # GIVEN
+    histogram = Histogram("test_seconds", "Test histogram.", ("route",), buckets=(0.1, 1.0))
+
+    # WHEN
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.1, "/a")
+    histogram.observe(5, "/a")
+
+    # THEN
+    lines = histogram.render().splitlines()
+    assert 'test_seconds_bucket{route="/a",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{route="/a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{route="/a"} 3' in lines
+
+
+def test_counter_escapes_labels():
+    counter = Counter("test_total", "Test counter.", ("path",))
+
+    counter.inc('say "hi"')
+
+    assert 'test_total{path="say \\"hi\\""} 1.0' in counter.render().splitlines()
+
+
+def test_middleware_records_route_template():
+    # GIVEN
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/things/{id}")
+    async def get_thing(id: int):
+        return {"id": id}
+
+    client = TestClient(app)
+
+    # WHEN
+    response = client.get("/things/12")
+
+    # THEN
+    assert response.status_code == 200
+    assert ("GET", "/things/{id}") in http_request_duration_seconds._values
+    assert 'route="/things/12"' not in registry.render()
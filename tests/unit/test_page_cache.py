@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+import pytest
+
+from app.cache import MemoryCacheBackend, PageCache, RedisCacheBackend
+from app.redis import encode_command, read_reply
+
+
+def test_encode_command():
+    assert encode_command("SET", "key", b"value", "EX", 30) == (
+        b"*5\r\n$3\r\nSET\r\n$3\r\nkey\r\n$5\r\nvalue\r\n$2\r\nEX\r\n$2\r\n30\r\n"
+    )
+
+
+@pytest.mark.asyncio
+async def test_page_cache_versions():
+    # GIVEN
+    cache = PageCache(backend=MemoryCacheBackend(max_entries=10), ttl=30)
+    key = await cache.key("product", {"page": 0, "size": 20})
+    await cache.set(key, b"first page")
+
+    # WHEN
+    await cache.invalidate("product")
+    new_key = await cache.key("product", {"size": 20, "page": 0})
+
+    # THEN
+    assert await cache.get(key) == b"first page"
+    assert new_key != key
+    assert await cache.get(new_key) is None
+    assert cache.stats.hits == 1
+    assert cache.stats.misses == 1
+
+
+@pytest.mark.asyncio
+async def test_page_cache_keeps_pages_briefly_after_a_change():
+    # GIVEN
+    backend = MemoryCacheBackend(max_entries=10)
+    cache = PageCache(backend=backend, ttl=30, settle_seconds=2)
+    before_key = await cache.key("product", {"page": 0})
+    await cache.set(before_key, b"before", table="product")
+
+    # WHEN
+    await cache.invalidate("product")
+    after_key = await cache.key("product", {"page": 0})
+    # Read from a replica that might not have the change yet
+    await cache.set(after_key, b"maybe stale", table="product")
+
+    # THEN
+    now = time.monotonic()
+    assert backend.entries._entries[before_key][0] - now > 2
+    assert backend.entries._entries[after_key][0] - now <= 2
+
+
+async def _serve_redis(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: dict[bytes, bytes]):
+    # Just enough of a Redis server for GET, SET and INCR
+    while not reader.at_eof():
+        try:
+            command = await read_reply(reader)
+        except asyncio.IncompleteReadError:
+            break
+        name, *args = command
+        if name == b"GET":
+            value = data.get(args[0])
+            writer.write(b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value))
+        elif name == b"SET":
+            data[args[0]] = args[1]
+            writer.write(b"+OK\r\n")
+        elif name == b"INCR":
+            data[args[0]] = b"%d" % (int(data.get(args[0], 0)) + 1)
+            writer.write(b":%s\r\n" % data[args[0]])
+        else:
+            writer.write(b"-ERR unknown command\r\n")
+        await writer.drain()
+    writer.close()
+
+
+@pytest.mark.asyncio
+async def test_page_cache_over_redis_protocol():
+    # GIVEN
+    data: dict[bytes, bytes] = {}
+    server = await asyncio.start_server(lambda r, w: _serve_redis(r, w, data), "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    cache = PageCache(backend=RedisCacheBackend("redis://127.0.0.1:{port}/0".format(port=port)), ttl=30)
+
+    # WHEN
+    key = await cache.key("product", {"page": 0})
+    await cache.set(key, b"page")
+    found = await cache.get(key)
+    await cache.invalidate("product")
+    stale = await cache.get(await cache.key("product", {"page": 0}))
+
+    # THEN
+    assert found == b"page"
+    assert stale is None
+    assert data[b"pages:product:version"] == b"1"
+
+    await cache.close()
+    server.close()
+    await server.wait_closed()
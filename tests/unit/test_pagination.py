@@ -0,0 +1,33 @@
+from decimal import Decimal
+
+import pytest
+
+from app.schemas.base import PageCursor
+
+
+def test_page_cursor_round_trip():
+    # GIVEN
+    cursor = PageCursor(values=[Decimal("12.50"), 42], backwards=True)
+
+    # WHEN
+    decoded = PageCursor.decode(cursor.encode())
+
+    # THEN
+    # Decimals are sent as strings, the repository converts them back using the column type
+    assert decoded.values == ["12.50", 42]
+    assert decoded.backwards is True
+
+
+def test_page_cursor_is_url_safe():
+    cursor = PageCursor(values=["name with spaces & symbols?", 1])
+
+    token = cursor.encode()
+
+    assert token.isascii()
+    for character in "=+/&? ":
+        assert character not in token
+
+
+def test_page_cursor_rejects_garbage():
+    with pytest.raises(ValueError):
+        PageCursor.decode("not a cursor")
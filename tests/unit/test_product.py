@@ -1,3 +1,121 @@
+from datetime import datetime
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+from app.counting import Count
+from app.database import SqlAlchemyRepository
+from app.models.product import product_table
+from app.schemas.base import from_row
+from app.schemas.product import (
+    ProductDetailResponse,
+    ProductListRequest,
+    ProductListResponse,
+    ProductUpdateRequest,
+    get_partial_list_model,
+    parse_fields,
+)
+from app.services.pagination import Page
+from app.services.product import ProductService, build_tsquery, escape_like, product_cache
+
+
 async def test_create_product():
     # TODO
     assert True
+
+
+def test_build_tsquery():
+    assert build_tsquery("wireless hea") == "wireless & hea:*"
+    assert build_tsquery("usb-c  cable!") == "usb & c & cable:*"
+    # Nothing that could be taken for tsquery syntax gets through
+    assert build_tsquery("a & !b | (c)") == "a & b & c:*"
+    assert build_tsquery("!?") is None
+
+
+def test_escape_like():
+    assert escape_like("50%_off\\") == "50\\%\\_off\\\\"
+
+
+def make_rows(count: int) -> list[dict]:
+    return [
+        {
+            "id": id,
+            "name": "Product {id}".format(id=id),
+            "description": "Description of product {id}".format(id=id),
+            "image": "https://example.com/images/{id}.png".format(id=id) if id % 2 else None,
+            "price": Decimal("12.50"),
+            "stock": id,
+            "updated_at": datetime(2024, 1, 1, 12, 30),
+        }
+        for id in range(1, count + 1)
+    ]
+
+
+def test_list_response_fast_path():
+    # GIVEN
+    service = ProductService(repository=None)
+    page = Page(records=make_rows(3), next="/products?cursor=x", previous=None)
+
+    for fields in (None, "name,price"):
+        list_query = ProductListRequest(page=0, size=3, cursor=None, fields=fields)
+
+        # WHEN
+        fast = service._dump_list_response(list_query, page, Count(3))
+
+        # THEN
+        # Byte for byte what validating the rows into the response model gives
+        parsed = parse_fields(fields)
+        response_model = ProductListResponse if parsed is None else get_partial_list_model(parsed)
+        validated = response_model(
+            results=page.records,
+            page=0,
+            size=3,
+            count=3,
+            next=page.next,
+            previous=None,
+        )
+        assert fast == validated.model_dump_json().encode()
+
+
+def test_from_row():
+    # GIVEN
+    row = make_rows(1)[0]
+
+    # WHEN
+    product = from_row(ProductDetailResponse, row)
+
+    # THEN
+    assert product.model_dump_json(warnings=False) == ProductDetailResponse(**row).model_dump_json()
+
+
+class FailingCommitConnection:
+    # Runs the UPDATE as if it worked, then loses the connection on COMMIT
+    def __init__(self, row: dict):
+        self.row = row
+        self.rolled_back = False
+
+    async def execute(self, statement, parameters=None):
+        return SimpleNamespace(mappings=lambda: SimpleNamespace(first=lambda: self.row))
+
+    async def commit(self):
+        raise ConnectionResetError("connection lost")
+
+    async def rollback(self):
+        self.rolled_back = True
+
+
+async def test_update_leaves_the_cache_alone_when_the_commit_fails():
+    # GIVEN
+    row = make_rows(1)[0]
+    connection = FailingCommitConnection(row)
+    service = ProductService(repository=SqlAlchemyRepository(db=connection, table=product_table))
+    product_cache.clear()
+
+    # WHEN
+    with pytest.raises(ConnectionResetError):
+        await service.update(id=row["id"], product=ProductUpdateRequest(name="renamed", price=Decimal("1")))
+
+    # THEN
+    assert connection.rolled_back
+    assert product_cache.get(row["id"]) is None
@@ -0,0 +1,39 @@
+from app.services.product_import import iter_csv_rows, iter_ndjson_rows
+
+
+async def read_all(rows) -> list:
+    return [row async for row in rows]
+
+
+def chunked(data: bytes, size: int = 64):
+    async def chunks():
+        for start in range(0, len(data), size):
+            yield data[start : start + size]
+
+    return chunks()
+
+
+async def test_csv_unterminated_quote_fails_one_row_and_moves_on():
+    # GIVEN
+    lines = ["id,name,price", '1,"never closed,1'] + ["{id},product {id},2".format(id=id) for id in range(2, 2000)]
+
+    # WHEN
+    rows = await read_all(iter_csv_rows(chunked("\n".join(lines).encode()), max_length=200))
+
+    # THEN
+    assert rows[0] is None
+    # Whatever fit in max_length went with the broken row, reading starts again after that
+    assert all(row is not None for row in rows[1:])
+    assert rows[-1] == {"id": "1999", "name": "product 1999", "price": "2"}
+    assert len(rows) > 1900
+
+
+async def test_lines_longer_than_the_limit_fail():
+    # GIVEN
+    data = '{"name": "a"}\n{"name": "' + "x" * 1000 + '"}\n{"name": "b"}'
+
+    # WHEN
+    rows = await read_all(iter_ndjson_rows(chunked(data.encode(), size=16), max_length=100))
+
+    # THEN
+    assert rows == [{"name": "a"}, None, {"name": "b"}]
@@ -0,0 +1,32 @@
+from datetime import datetime
+
+from app.services.seed import make_order_items, make_orders, make_products, product_price, split
+
+
+def test_generated_rows_are_deterministic():
+    now = datetime(2025, 1, 1)
+    assert make_products(42, 3, 1000, 50) == make_products(42, 3, 1000, 50)
+    assert make_orders(42, 3, 1000, 50, 100, now) == make_orders(42, 3, 1000, 50, 100, now)
+    # Another batch or another seed gives other rows
+    assert make_products(42, 4, 1000, 50) != make_products(42, 3, 1000, 50)
+    assert make_products(7, 3, 1000, 50) != make_products(42, 3, 1000, 50)
+
+
+def test_order_items_point_at_generated_rows():
+    # GIVEN
+    products = make_products(42, 0, 101, 200)
+
+    # WHEN
+    items = make_order_items(42, 0, 11, 100, 101, 200)
+
+    # THEN
+    product_ids = {product[0] for product in products}
+    assert {item[0] for item in items} == set(range(11, 111))
+    assert all(item[1] in product_ids for item in items)
+    # Items have the price of their product
+    assert all(item[3] == product_price(42, item[1]) for item in items)
+
+
+def test_split():
+    assert split(10, 4) == [(0, 4), (1, 4), (2, 2)]
+    assert split(0, 4) == []
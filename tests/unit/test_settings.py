@@ -0,0 +1,36 @@
+from app.database.connection_provider import get_connect_args
+from app.settings import Settings
+
+
+def test_worker_count():
+    assert Settings(server_mode="development", server_workers=8).get_workers() == 1
+    assert Settings(server_mode="production", server_workers=8).get_workers() == 8
+    # One per CPU by default
+    assert Settings(server_mode="production", server_workers=0).get_workers() >= 1
+
+
+def test_pool_limits_are_shared_between_workers():
+    # No limit: every worker gets the whole pool
+    settings = Settings(server_mode="production", server_workers=4, db_pool_size=5, db_max_overflow=10)
+    assert settings.get_pool_limits() == (5, 10)
+
+    # 4 workers sharing 24 connections get 6 each, 5 in the pool and 1 on top
+    settings = Settings(
+        server_mode="production", server_workers=4, db_pool_size=5, db_max_overflow=10, db_max_connections=24
+    )
+    assert settings.get_pool_limits() == (5, 1)
+
+    # Fewer connections than workers still leaves each worker one
+    settings = Settings(server_mode="production", server_workers=4, db_max_connections=2)
+    assert settings.get_pool_limits() == (1, 0)
+
+
+def test_connect_args_for_pgbouncer():
+    assert get_connect_args(Settings(db_statement_cache_size=100)) == {"prepared_statement_cache_size": 100}
+
+    # Transaction pooling: no statement caches at all, and statement names that can't clash
+    connect_args = get_connect_args(Settings(db_statement_cache_size=0))
+    assert connect_args["prepared_statement_cache_size"] == 0
+    assert connect_args["statement_cache_size"] == 0
+    name_statement = connect_args["prepared_statement_name_func"]
+    assert name_statement() != name_statement()